@@ -0,0 +1,69 @@
+from nmigen import *
+from nmigen.utils import bits_for
+
+class Arbiter(Elaboratable):
+    """ Chooses which of a number of requesters to grant next """
+    def __init__(self, n, mode="priority", weights=None):
+        assert mode in ("priority", "round_robin", "weighted")
+
+        # Parameters
+        self.n       = n
+        self.mode    = mode
+        self.weights = [1] * n if weights is None or mode != "weighted" else weights
+
+        assert len(self.weights) == n and min(self.weights) >= 1
+
+        # Inputs
+        self.req   = Signal(n)          # The requests, one bit per requester
+        self.next  = Signal()           # Strobe to say the grant has been taken
+
+        # Outputs
+        self.grant = Signal(range(n))   # The requester that is granted
+        self.valid = Signal()           # Set when there is any request
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.d.comb += self.valid.eq(self.req.any())
+
+        # Grant the first requester in order from 0 to n-1
+        def grant_from(first):
+            for k in reversed(range(self.n)):
+                i = (first + k) % self.n
+                with m.If(self.req[i]):
+                    m.d.comb += self.grant.eq(i)
+
+        # In priority mode, requester 0 always comes first
+        if self.mode == "priority":
+            grant_from(0)
+            return m
+
+        # Otherwise the requester at ptr comes first, and can have up to its weight
+        # of grants in a row, before ptr moves on to the next requester.
+        # A requester that is granted when it is not at ptr, moves ptr to it.
+        ptr     = Signal(range(self.n))
+        left    = Signal(bits_for(max(self.weights)), reset=self.weights[0])
+        weights = Array([C(w, left.width) for w in self.weights])
+
+        with m.Switch(ptr):
+            for p in range(self.n):
+                with m.Case(p):
+                    grant_from(p)
+
+        # The grants left for the requester granted, including this one
+        grants = Mux(self.grant == ptr, left, weights[self.grant])
+
+        with m.If(self.next & self.valid):
+            with m.If(grants > 1):
+                m.d.sync += [
+                    ptr.eq(self.grant),
+                    left.eq(grants - 1)
+                ]
+            with m.Else():
+                nxt = Mux(self.grant == self.n - 1, 0, self.grant + 1)
+                m.d.sync += [
+                    ptr.eq(nxt),
+                    left.eq(weights[nxt])
+                ]
+
+        return m
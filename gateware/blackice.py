@@ -4,6 +4,7 @@ from nmigen_boards.blackice_ii import *
 from nmigen.build import *
 
 from dispatcher import Dispatcher
+from qspi.qspi_ddr_io import QspiDdrIo
 from periph.led import Led
 from periph.hello_tx import HelloTx
 from periph.uart import Uart
@@ -20,6 +21,11 @@ qspi = [
     Resource("qd",   1, Pins("84", dir="io"), Attrs(IO_STANDARD="SB_LBCMOS")),
     Resource("qd",   2, Pins("79", dir="io"), Attrs(IO_STANDARD="SB_LBCMOS")),
     Resource("qd",   3, Pins("80", dir="io"), Attrs(IO_STANDARD="SB_LBCMOS")),
+    # The second bank of a dual-flash QUADSPI, for 8 lanes
+    Resource("qd",   4, Pins("1", dir="io", conn=("pmod", 1)), Attrs(IO_STANDARD="SB_LVCMOS")),
+    Resource("qd",   5, Pins("2", dir="io", conn=("pmod", 1)), Attrs(IO_STANDARD="SB_LVCMOS")),
+    Resource("qd",   6, Pins("3", dir="io", conn=("pmod", 1)), Attrs(IO_STANDARD="SB_LVCMOS")),
+    Resource("qd",   7, Pins("4", dir="io", conn=("pmod", 1)), Attrs(IO_STANDARD="SB_LVCMOS")),
     Resource("qdir", 0, Pins("63", dir="o"),  Attrs(IO_STANDARD="SB_LBCMOS")),
     Resource("btn", 0,  Pins("64", dir="o"),  Attrs(IO_STANDARD="SB_LBCMOS"))
 ]
@@ -34,8 +40,14 @@ oled_pmod = [
 ]
 
 class QSPITest(Elaboratable):
-    def __init__(self):
-        self.dispatcher = Dispatcher()
+    def __init__(self, capture="sync", ddr=False, qw=4):
+        # With a single lane, the STM32 sends on IO0 and receives on IO1, so the dispatcher's qd is split
+        assert not ddr or qw > 1
+
+        # Capturing with sclk needs credits, and a fifo for the packets received
+        credits = capture == "sclk"
+        self.dispatcher = Dispatcher(qw=qw, credits=credits, rx_fifo_depth=2 if credits else 0,
+                                     capture=capture, ddr=ddr)
 
         self.dispatcher.register(0, Led(), True,  False)
         self.dispatcher.register(1, HelloTx(),  False, True)
@@ -52,13 +64,15 @@ class QSPITest(Elaboratable):
         led3  = platform.request("led", 3)
         csn   = platform.request("csn")
         sclk  = platform.request("sclk")
-        qd0   = platform.request("qd", 0)
-        qd1   = platform.request("qd", 1)
-        qd2   = platform.request("qd", 2)
-        qd3   = platform.request("qd", 3)
         qdir  = platform.request("qdir")
         btn   = platform.request("btn")
 
+        # With ddr, the qd pins are driven by DDR output cells, so are requested raw.
+        # IO1 is used with a single lane, and bank 2 only with 8.
+        qw     = self.dispatcher.qw
+        qd_dir = "-" if self.dispatcher.ddr else None
+        qd     = [platform.request("qd", k, dir=qd_dir) for k in range(max(qw, 2))]
+
         m = Module()
 
         # Clock generation
@@ -75,20 +89,49 @@ class QSPITest(Elaboratable):
 
         m.submodules.dispatch = dispatch = self.dispatcher
 
+        # With sclk capture, the QSPI clock clocks the registers on the qd pins
+        if dispatch.capture == "sclk":
+            platform.add_clock_constraint(sclk.i, 100000000)
+
         # Connect the dispatcher
         m.d.comb += [
             dispatch.csn.eq(csn),
             dispatch.sclk.eq(sclk),
             qdir.eq(dispatch.qdir),
-            dispatch.qd_i.eq(Cat([qd0.i, qd1.i, qd2.i, qd3.i])),
-            Cat([qd0.o, qd1.o, qd2.o, qd3.o]).eq(dispatch.qd_o),
-            qd0.oe.eq(dispatch.qd_oe),
-            qd1.oe.eq(dispatch.qd_oe),
-            qd2.oe.eq(dispatch.qd_oe),
-            qd3.oe.eq(dispatch.qd_oe),
             Cat([led3, led2, led1, led0]).eq(dispatch.led)
         ]
 
+        # With 8 lanes, the STM32 sends even bytes on bank 1 and odd bytes on bank 2, a nibble per cycle,
+        # so bank 1 carries the high nibble of each byte here, and the host interleaves the nibbles
+        if qw == 8:
+            qd = qd[4:] + qd[:4]
+
+        if dispatch.ddr:
+            m.submodules.ddr_io = ddr_io = QspiDdrIo(qw=qw, pins=qd[:qw])
+            m.d.comb += [
+                ddr_io.sclk.eq(sclk),
+                dispatch.qd_i.eq(ddr_io.i),
+                ddr_io.o.eq(dispatch.qd_o),
+                ddr_io.o_n.eq(dispatch.qd_o_n),
+                ddr_io.oe.eq(dispatch.qd_oe)
+            ]
+            return m
+
+        # With a single lane, data is received on IO0 and sent on IO1
+        if qw == 1:
+            m.d.comb += [
+                dispatch.qd_i.eq(qd[0].i),
+                qd[1].o.eq(dispatch.qd_o),
+                qd[1].oe.eq(dispatch.qd_oe)
+            ]
+            return m
+
+        m.d.comb += [
+            dispatch.qd_i.eq(Cat([p.i for p in qd])),
+            Cat([p.o for p in qd]).eq(dispatch.qd_o)
+        ]
+        m.d.comb += [p.oe.eq(dispatch.qd_oe) for p in qd]
+
         return m
 
 if __name__ == "__main__":
@@ -1,62 +1,201 @@
 from nmigen import *
 from nmigen.utils import bits_for
 
+from nmigen.hdl.ast import Fell
 from nmigen.lib.cdc import FFSynchronizer
+from nmigen.lib.fifo import SyncFIFOBuffered
 
 from qspi.qspi_tx import QspiTx
 from qspi.qspi_rx import QspiRx
+from qspi.qspi_sclk import QspiRxSclk, QspiTxSclk
+from periph.stats import STATES
+from arbiter import Arbiter
+from pool import PacketPool
 
 #from periph.hex import Hex
 #from st7789 import ST7789
 
 class Dispatcher(Elaboratable):
     """ Interface between QSPI and peripherals """
-    def __init__(self, pkt_size=16, num_periphs=15, qw=4):
+    def __init__(self, pkt_size=16, num_periphs=15, qw=4, burst=False, merged_tx=False,
+                 rx_fifo_depth=0, tx_fifo_depth=0, arbiter="priority", credits=False, ext_addr=False,
+                 pool_bufs=0, capture="sync", ddr=False, crc=0, timestamps=False):
+        # Ids 0xF0 to 0xFF are reserved for replies and commands, and with 4-bit ids, so is 0xF
+        assert num_periphs <= (240 if ext_addr else 15)
+        # Capturing qd with sclk needs every transaction to start with a command, so it needs credits
+        assert capture in ("sync", "sclk") and (capture == "sync" or credits)
+        # 1, 2, 4 or 8 data lanes, where 8 is the two banks of a dual-flash QUADSPI
+        assert qw in (1, 2, 4, 8)
+        # Double data rate needs sclk capture, and at least a cycle per byte
+        assert not ddr or (capture == "sclk" and qw <= 4)
+        # Bursts pass packets on before the CRC at their end has been checked
+        assert crc in (0, 8, 16) and not (crc and burst)
+
         # Parameters
         self.pkt_size    = pkt_size
         self.num_periphs = num_periphs
-        self.qw          = qw
+        self.qw          = qw                      # The number of data lanes
+        self.burst       = burst                   # Allow multi-packet burst writes
+        self.merged_tx   = merged_tx or credits    # Send the event byte and the data in one read
+        self.rx_fifo_depth = rx_fifo_depth         # Default depth of rx peripheral packet fifos
+        self.tx_fifo_depth = tx_fifo_depth         # Default depth of tx peripheral packet fifos
+        self.arbiter     = arbiter                 # priority, round_robin or weighted
+        self.credits     = credits                 # Start transactions with a command, so writes need no query
+        self.ext_addr    = ext_addr                # Use 8-bit peripheral ids in a two byte header
+        self.pool_bufs   = pool_bufs               # The number of buffers in the packet pool, 0 for none
+        self.capture     = capture                 # sync samples sclk in the sync domain, sclk clocks qd with it
+        self.ddr         = ddr                     # Move data on both edges of sclk
+        self.crc         = crc                     # The width of the CRC after each packet, or 0 for none
+        self.timestamps  = timestamps              # Stamp packets with the cycle counter
         
+        # The header is the id and flags byte, or with ext_addr the id byte and the flags byte.
+        # The event is the id and length byte, or with ext_addr the id byte and the length byte.
+        self.hdr_size = 2 if ext_addr else 1
+
+        # With timestamps, packets sent have a 4-byte trailer with the time the peripheral had them
+        self.ts_size = 4 if timestamps else 0
+
+        # The send packet holds the event too in merged mode, and room for the trailer
+        self.tx_size = pkt_size + (self.hdr_size if self.merged_tx else 0) + self.ts_size
+
         # QSPI pins
         self.csn  =  Signal()                      # The chip select pin
         self.sclk =  Signal()                      # The QSPI clock pin
         self.qd_i =  Signal(qw)                    # The QSPI pins in read mode
-        self.qd_o =  Signal(qw)                    # The QSPI pins in write mode
-        self.qd_oe = Signal(reset=1)               # Output enable for qd
+        self.qd_o =  Signal(qw)                    # The QSPI pins in write mode, or with ddr, for the rising edge
+        self.qd_o_n = Signal(qw)                   # With ddr, the QSPI pins in write mode for the falling edge
+        self.qd_oe = Signal(reset=not credits)     # Output enable for qd
         self.qdir =  Signal(reset=0)               # The direction pin. Zero means STM32 -> ice40 
 
         # Outputs
-        self.led = Signal(4)
+        self.led           = Signal(4)
+        self.burst_overrun = Signal()              # Set when a burst packet was dropped
+        self.timestamp     = Signal(32)            # Free-running cycle counter, which the STM32 can set
+        self.grant_count   = [Signal(32, name="grant_count_" + str(i))
+                              for i in range(num_periphs)] # Number of times each tx peripheral has been chosen
 
         # Peripherals
         self.periph    = [None] * num_periphs # Contains all peripherals
         self.rx_periph = [None] * num_periphs # Contains only peripheral that receive data from STM32
         self.tx_periph = [None] * num_periphs # Contains only peripherals that send data  to STM32
+        self.rx_depth  = [0] * num_periphs    # The depth of the packet fifo for each rx peripheral
+        self.tx_depth  = [0] * num_periphs    # The depth of the packet fifo for each tx peripheral
+        self.weight    = [1] * num_periphs    # The weight of each tx peripheral for the weighted arbiter
+        self.pooled    = [False] * num_periphs # Set for peripherals that use the packet pool
+        self.streamed  = [False] * num_periphs # Set for rx peripherals that take packets a byte at a time
+        self.stats     = []                   # The statistics peripherals, which are fed the link events
+
+        # The packet pool, the first port of which is the dispatcher's.
+        # Credits only count fifo entries, so they cannot be used with it, and the packets of a burst are not
+        # written to buffers, so neither can bursts.
+        self.pool = None
+        if pool_bufs > 0:
+            assert not credits, "credits cannot be used with the pool"
+            assert not burst, "bursts cannot be used with the pool"
+            self.pool      = PacketPool(pool_bufs, pkt_size)
+            self.pool_port = self.pool.port()
 
-    # Register a peripheral with a specified id, and say whether it receives or sends data, or both
-    def register(self, i, mod, rx, tx):
+    # Register a peripheral with a specified id, and say whether it receives or sends data, or both.
+    # Received packets are queued in a fifo of rx_fifo_depth packets in front of the peripheral,
+    # or passed straight to it if the depth is 0.
+    # Packets to send are queued in a fifo of tx_fifo_depth packets behind the peripheral,
+    # or taken straight from it if the depth is 0.
+    # The weight is the number of packets in a row a tx peripheral can send with the weighted arbiter.
+    # Pooled peripherals are given a port on the packet pool, and exchange buffer indexes with the
+    # dispatcher instead of packets.
+    # Statistics peripherals have their link events driven by the dispatcher.
+    # Stream peripherals are passed the bytes of the packets they receive one at a time, as they arrive.
+    def register(self, i, mod, rx, tx, rx_fifo_depth=None, tx_fifo_depth=None, weight=1, pooled=False,
+                 stats=False, stream=False):
         self.periph[i] = mod
+        if (stream):
+            # The bytes go straight to the peripheral, so it has no rx fifo, and cannot be given credits
+            assert rx and not pooled and not self.credits, "stream peripherals need rx, and no pool or credits"
+            self.streamed[i] = True
+            rx_fifo_depth = 0
+        if (pooled):
+            assert self.merged_tx or not tx, "pooled tx peripherals need merged_tx"
+            mod.pool = self.pool.port()
+            self.pooled[i] = True
+        if (stats):
+            self.stats.append(mod)
         if (rx):
             self.rx_periph[i] = mod
+            self.rx_depth[i] = self.rx_fifo_depth if rx_fifo_depth is None else rx_fifo_depth
         if (tx):
             self.tx_periph[i] = mod
+            self.tx_depth[i] = self.tx_fifo_depth if tx_fifo_depth is None else tx_fifo_depth
+            self.weight[i] = weight
 
     # Elaboration
     def elaborate(self, platform):
 
         m = Module()
 
+        hb      = self.hdr_size
+        id_bits = 8 if self.ext_addr else 4
+
         # Constants
         ok_to_send = Const(0xF0, 8)
         not_ready  = Const(0xFF, 8)
+        burst_cmd  = Const(0xF1, 8)
+        status_cmd = Const(0xF8, 8)
+        read_cmd   = Const(0xF9, 8)
+        ack_cmd    = Const(0xFA, 8)
+        ts_cmd     = Const(0xFB, 8)
+        nack       = Const(0xFE, 8)
+
+        # The number of CRC bytes after each packet, and timestamp bytes after each packet sent
+        cb = self.crc // 8
+        tb = self.ts_size
+
+        # Between transactions qd is driven, as the first transaction is always a read,
+        # except with credits, when every transaction starts with a command from the STM32
+        idle_oe = 0 if self.credits else 1
+
+        # The status bitmaps are at least 16 bits
+        bm_bits = max(16, (self.num_periphs + 7) // 8 * 8)
 
         # Signals
-        tx_pkt    = Signal(self.pkt_size * 8)  # Send packet buffer
+        tx_pkt    = Signal(self.tx_size * 8)   # Send packet buffer
         rx_pkt    = Signal(self.pkt_size * 8)  # Receive packet buffer
         rx_valid  = Signal()                   # Set when data has been received from STM
-        periph_ev = Signal(4)                  # The event id for both directions
+        periph_ev = Signal(id_bits)            # The event id for both directions
         nb        = Signal(4)                  # The number of bytes received
         flags     = Signal(4)                  # Extra flags sent with write request
+        hdr       = Signal(8 * hb)             # The header of a burst
+        burst_nb  = Signal(range(self.pkt_size)) # The number of bytes in the current burst packet
+        rx_ready  = Signal()                   # Set when the selected rx peripheral, or its fifo, is ready
+        tx_nb     = Signal(4)                  # The number of bytes being sent, 0 means pkt_size
+        tx_len    = Signal(range(self.tx_size + 1)) # The number of bytes of tx_pkt sent, before any CRC
+        tx_full   = Signal()                   # Set with credits when tx_pkt holds a packet to send
+        tx_sent   = Signal()                   # Set without credits, with a CRC, when tx_pkt has been read in full
+        tx_go     = Signal()                   # Set with credits when the data of a read starts
+        use_stat  = Signal()                   # Set when the status is sent instead of tx_pkt
+        copy_buf  = Signal(range(max(self.pool_bufs, 1))) # The pool buffer being copied to tx_pkt
+        copy_nb   = Signal(range(self.pkt_size + 1)) # The number of bytes to copy
+        copy_rd   = Signal(range(self.pkt_size + 1)) # The number of bytes read from the pool
+        copy_wr   = Signal(range(self.pkt_size + 1)) # The number of bytes written to tx_pkt
+        tx_pend   = Signal(bm_bits)            # Bitmap of the tx peripherals with a packet to send
+        rx_rdy    = Signal(bm_bits)            # Bitmap of the rx peripherals that can take a packet
+        rx_nack   = Signal()                   # Set without credits when the last packet had a bad CRC
+        rx_seq    = Signal(8)                  # The number of packets received with credits, modulo 256
+        rx_errs   = Signal(8)                  # Bit 0 is set if the last packet had a bad CRC, bit 1 the one before...
+        rx_ts     = Signal(32)                 # The time the packet in rx_pkt was received
+        ct_on     = Signal()                   # Set while a packet is cut through to a stream peripheral
+        ct_ok     = Signal()                   # Set when the header received is for a stream peripheral that is ready
+        ct_end    = Signal()                   # Set when csn goes high at the end of a packet cut through
+        rp_on     = Signal()                   # Set while the packet in rx_pkt is replayed to a stream peripheral
+        rp_go     = Signal()                   # Set when periph_ev is a stream peripheral that is ready
+        rp_done   = Signal()                   # Set when the replay has ended
+        rp_left   = Signal(range(self.pkt_size + 1)) # The number of bytes left to replay
+        st_id     = Signal(id_bits)            # The stream peripheral being passed a packet
+        st_start  = Signal()                   # Strobe at the start of a streamed packet, with st_flags
+        st_valid  = Signal()                   # Strobe with each byte of it, in st_byte
+        st_end    = Signal()                   # Strobe at its end, with st_nb
+        st_byte   = Signal(8)
+        st_flags  = Signal(4)
+        st_nb     = Signal(4)
 
         # OLED
         #oled  = platform.request("oled")
@@ -89,58 +228,407 @@ class Dispatcher(Elaboratable):
         sclk = Signal()
         m.submodules += FFSynchronizer(i=self.sclk, o=sclk)
 
-        # De-glitch cs
-        csn = Signal()
-        m.submodules += FFSynchronizer(i=self.csn, o=csn)
+        # Output enable for qd, as set by the state machine
+        qd_oe = Signal(reset=not self.credits)
 
-        # QSPI send and receive modules
-        m.submodules.tx = tx = QspiTx(pkt_size = self.pkt_size, qw = self.qw)
-        m.submodules.rx = rx = QspiRx(pkt_size = self.pkt_size, qw = self.qw)
+        # QSPI send and receive modules.
+        # With sclk capture, csn is taken from the receive module, and only goes high
+        # once all the bytes of a transaction have been passed to the sync domain.
+        csn = Signal(reset=1)
+        if self.capture == "sclk":
+            m.submodules.rx = rx = QspiRxSclk(pkt_size = self.pkt_size + cb, qw = self.qw, ddr = self.ddr,
+                                              crc = self.crc)
+            m.d.comb += csn.eq(rx.sync_csn)
+        else:
+            # De-glitch cs. It is high at reset, so that we do not see a spurious transaction
+            m.submodules += FFSynchronizer(i=self.csn, o=csn, reset=1)
+            m.submodules.tx = tx = QspiTx(pkt_size = self.tx_size, qw = self.qw, crc = self.crc)
+            m.submodules.rx = rx = QspiRx(pkt_size = self.pkt_size + cb, qw = self.qw, crc = self.crc)
 
         # De-glitch qd
         qd_o = Signal(self.qw)
         #m.submodules += FFSynchronizer(i=tx.qd, o=qd_o)
-        m.d.sync += qd_o.eq(tx.qd)
 
         # Add the registered peripherals
         for p in self.periph:
             if p is not None:
                 m.submodules += p
+
+        # With the pool, received packets are written to the buffer in cur_buf as they arrive, 
+        # and only that index is passed to pooled peripherals.
+        # Another buffer is leased for cur_buf before receiving any more.
+        if self.pool is not None:
+            m.submodules.pool = self.pool
+            pp = self.pool_port
+            cur_buf = Signal(range(self.pool_bufs))
+            m.d.comb += [
+                pp.w_buf.eq(cur_buf),
+                pp.w_off.eq(rx.nb - hb - 1),
+                pp.w_data.eq(rx.pkt[:8])
+            ]
         
-        # Connect the QSPI modules
+        # Connect the QSPI modules.
+        # With credits, sending does not start until the command and dummy bytes have been received.
+        # With a CRC, it follows the data of tx_pkt, which is after the event in merged mode.
+        m.d.comb += tx_len.eq(Mux(tx_nb == 0, self.pkt_size, tx_nb) + (hb if self.merged_tx else 0) + tb)
+        if self.capture == "sclk":
+            m.d.comb += rx.csn.eq(self.csn)
+        else:
+            m.d.comb += [
+                tx.csn.eq(csn | (~tx_go if self.credits else 0)),
+                tx.sclk.eq(sclk),
+                tx.pkt.eq(tx_pkt),
+                tx.nb.eq(tx_len),
+                self.qd_o.eq(qd_o),
+                self.qd_oe.eq(qd_oe),
+                rx.csn.eq(csn)
+            ]
         m.d.comb += [
-            tx.csn.eq(csn),
-            tx.sclk.eq(sclk),
-            tx.pkt.eq(tx_pkt),
-            self.qd_o.eq(qd_o),
-            rx.csn.eq(csn),
-            rx.sclk.eq(sclk),
+            rx.sclk.eq(self.sclk if self.capture == "sclk" else sclk),
             rx.qd.eq(self.qd_i)
         ]
 
         m.d.comb += self.led.eq(self.periph[0].led)
 
-        # Set valid for the selected rx_periph and set the input packet
+        # With credits, the STM32 can send as many packets to a peripheral as there is room for in its fifo,
+        # without asking if it is OK to send. The fifo depth is the number of credits the STM32 starts with. 
+        # The status has a count, modulo 256, for each peripheral, of the packets it has taken from its fifo,
+        # which is the number of credits returned to the STM32.
+        credit_count = [Signal(8, name="credit_count_" + str(i)) for i in range(self.num_periphs)]
+        if self.credits:
+            for i in range(self.num_periphs):
+                assert self.rx_periph[i] is None or self.rx_depth[i] > 0, "credits need rx fifos"
+
+        # Set valid for the selected rx_periph and set the input packet, or buffer for pooled peripherals.
+        # For peripherals with a fifo, the packet is written to the fifo instead,
+        # and the peripheral reads it from the fifo when it is ready.
+        # rx_ready is set when the selected peripheral, or its fifo, can take the packet.
+        # With timestamps, peripherals that have an i_ts input are given the time the packet was received.
+        # Stream peripherals are passed packets a byte at a time, from the stream signals, and for them,
+        # rx_ready is set when the packet in rx_pkt has been replayed to the peripheral.
+        rx_pooled = Signal()                   # Set when the selected rx peripheral is pooled
+        hdr_id    = rx.pkt[8 * hb - id_bits:8 * hb] # The id in a header, once it has been received
         for i in range(self.num_periphs):
             p = self.rx_periph[i]
-            if p is not None:
+            if p is not None and self.streamed[i]:
                 m.d.comb += [
-                    p.i_valid.eq(rx_valid & (periph_ev == i)),
-                    p.i_pkt.eq(rx_pkt),
-                    p.i_nb.eq(nb),
-                    p.i_flags.eq(flags)
+                    p.i_start.eq(st_start & (st_id == i)),
+                    p.i_byte_valid.eq(st_valid & (st_id == i)),
+                    p.i_end.eq(st_end & (st_id == i)),
+                    p.i_byte.eq(st_byte),
+                    p.i_flags.eq(st_flags),
+                    p.i_nb.eq(st_nb),
+                    rx_rdy[i].eq(p.o_ready)
                 ]
+                with m.If(periph_ev == i):
+                    m.d.comb += [
+                        rx_ready.eq(rp_done),
+                        rp_go.eq(p.o_ready)
+                    ]
+                # Packets with a CRC are checked before they are passed on, so they are not cut through
+                if not self.crc:
+                    with m.If(hdr_id == i):
+                        m.d.comb += ct_ok.eq(p.o_ready)
+            elif p is not None:
+                data   = cur_buf if self.pooled[i] else rx_pkt
+                p_data = p.i_buf if self.pooled[i] else p.i_pkt
+                stamp  = rx_ts if self.timestamps and hasattr(p, "i_ts") else C(0, 0)
+                if self.rx_depth[i] > 0:
+                    fifo = SyncFIFOBuffered(width=len(data) + len(stamp) + 8, depth=self.rx_depth[i])
+                    m.submodules["rx_fifo_" + str(i)] = fifo
+                    m.d.comb += [
+                        fifo.w_en.eq(rx_valid & (periph_ev == i)),
+                        fifo.w_data.eq(Cat(data, stamp, nb, flags)),
+                        p.i_valid.eq(fifo.r_rdy),
+                        p_data.eq(fifo.r_data[:len(data)]),
+                        p.i_nb.eq(fifo.r_data[-8:-4]),
+                        p.i_flags.eq(fifo.r_data[-4:]),
+                        fifo.r_en.eq(p.o_ready)
+                    ]
+                    if len(stamp):
+                        m.d.comb += p.i_ts.eq(fifo.r_data[len(data):-8])
+                    with m.If(fifo.r_en & fifo.r_rdy):
+                        m.d.sync += credit_count[i].eq(credit_count[i] + 1)
+                    ready = fifo.w_rdy
+                else:
+                    m.d.comb += [
+                        p.i_valid.eq(rx_valid & (periph_ev == i)),
+                        p_data.eq(data),
+                        p.i_nb.eq(nb),
+                        p.i_flags.eq(flags)
+                    ]
+                    if len(stamp):
+                        m.d.comb += p.i_ts.eq(stamp)
+                    ready = p.o_ready
+                m.d.comb += rx_rdy[i].eq(ready)
+                with m.If(periph_ev == i):
+                    m.d.comb += [
+                        rx_ready.eq(ready),
+                        rx_pooled.eq(self.pooled[i])
+                    ]
 
-        # Set ack to false by default for all tx peripherals
-        for p in self.tx_periph:
+        # Packets received for a stream peripheral that were not cut through, because it was not ready when the
+        # header arrived, or they had a CRC, or were part of a burst, are replayed from rx_pkt, a byte a cycle,
+        # once the peripheral is ready. The first byte of the data is the top one of the nb bytes at the bottom.
+        if any(self.streamed):
+            m.d.sync += [
+                st_start.eq(0),
+                st_valid.eq(0),
+                st_end.eq(0)
+            ]
+            with m.If(rp_on):
+                with m.If(rp_left == 0):
+                    m.d.comb += rp_done.eq(1)
+                    m.d.sync += [
+                        rp_on.eq(0),
+                        st_end.eq(1),
+                        st_nb.eq(nb)
+                    ]
+                with m.Else():
+                    m.d.sync += [
+                        st_byte.eq(rx_pkt.word_select(rp_left - 1, 8)),
+                        st_valid.eq(1),
+                        rp_left.eq(rp_left - 1)
+                    ]
+            with m.Elif(rx_valid & rp_go):
+                m.d.sync += [
+                    rp_on.eq(1),
+                    rp_left.eq(nb),
+                    st_id.eq(periph_ev),
+                    st_flags.eq(flags),
+                    st_start.eq(1)
+                ]
+
+        # Build a packet from the last n bytes of a burst, with the burst header in front of them,
+        # so that it looks the same as a packet sent on its own
+        def burst_pkt(n):
+            def byte(j):
+                b = C(0, 8)
+                for k in range(hb):
+                    b = Mux(j == n + k, hdr.word_select(k, 8), b)
+                return Mux(j < n, rx.pkt.word_select(j, 8), b)
+            return Cat(*[byte(j) for j in range(self.pkt_size)])
+
+        # The packets to send for each tx peripheral come from the peripheral, or from its fifo.
+        # For peripherals with a fifo, the peripheral is acked when its packet is written to the fifo,
+        # and src_ack reads the packet from the fifo. For others, src_ack acks the peripheral.
+        # For pooled peripherals, src_pkt is the index of the buffer that holds the packet.
+        # With timestamps, src_ts is the time the peripheral first set o_valid for the packet,
+        # and src_pos the number of bytes of tx_pkt after its data, where the stamp goes.
+        src_valid = [None] * self.num_periphs
+        src_pkt   = [None] * self.num_periphs
+        src_nb    = [None] * self.num_periphs
+        src_ack   = [None] * self.num_periphs
+        src_ts    = [None] * self.num_periphs
+        src_pos   = [None] * self.num_periphs
+        for i in range(self.num_periphs):
+            p = self.tx_periph[i]
             if p is not None:
-                m.d.sync += p.i_ack.eq(0)
+                src_ack[i] = Signal(name="src_ack_" + str(i))
+                p_data = p.o_buf if self.pooled[i] else p.o_pkt
+                stamp  = C(0, 0)
+                if self.timestamps:
+                    stamp   = Signal(32, name="tx_ts_" + str(i))
+                    stamped = Signal(name="tx_stamped_" + str(i))
+                    with m.If(p.i_ack):
+                        m.d.sync += stamped.eq(0)
+                    with m.Elif(p.o_valid & ~stamped):
+                        m.d.sync += [
+                            stamp.eq(self.timestamp),
+                            stamped.eq(1)
+                        ]
+                    # The stamp is taken on the cycle o_valid is first seen
+                    stamp = Mux(stamped, stamp, self.timestamp)
+                if self.tx_depth[i] > 0:
+                    fifo = SyncFIFOBuffered(width=len(p_data) + len(stamp) + 4, depth=self.tx_depth[i])
+                    m.submodules["tx_fifo_" + str(i)] = fifo
+                    m.d.comb += [
+                        fifo.w_en.eq(p.o_valid & ~p.i_ack),
+                        fifo.w_data.eq(Cat(p_data, stamp, p.o_nb[:4])),
+                        fifo.r_en.eq(src_ack[i])
+                    ]
+                    m.d.sync += p.i_ack.eq(fifo.w_en & fifo.w_rdy)
+                    src_valid[i] = fifo.r_rdy
+                    src_pkt[i]   = fifo.r_data[:len(p_data)]
+                    src_nb[i]    = fifo.r_data[-4:]
+                    src_ts[i]    = fifo.r_data[len(p_data):-4]
+                else:
+                    m.d.comb += p.i_ack.eq(src_ack[i])
+                    src_valid[i] = p.o_valid
+                    src_pkt[i]   = p_data
+                    src_nb[i]    = p.o_nb[:4]
+                    src_ts[i]    = stamp
+                if self.timestamps:
+                    src_pos[i] = Signal(range(self.tx_size), name="src_pos_" + str(i))
+                    m.d.comb += src_pos[i].eq(self.tx_size - (hb if self.merged_tx else 0) -
+                                              Mux(src_nb[i] == 0, self.pkt_size, src_nb[i]))
+
+        # The arbiter chooses which tx peripheral with a packet to send goes next
+        m.submodules.arb = arb = Arbiter(self.num_periphs, self.arbiter, self.weight)
+        m.d.comb += arb.req.eq(Cat(*[v if v is not None else 0 for v in src_valid]))
+
+        # A packet is pending from the time the peripheral has it, until it has all been sent
+        m.d.comb += tx_pend.eq(arb.req | (self.qdir << periph_ev))
+
+        with m.If(arb.next & arb.valid):
+            with m.Switch(arb.grant):
+                for i in range(self.num_periphs):
+                    if self.tx_periph[i] is not None:
+                        with m.Case(i):
+                            m.d.sync += self.grant_count[i].eq(self.grant_count[i] + 1)
+
+        # Set the reply to the read transaction that asks if it is OK to send.
+        # With ext_addr, the reply is the same size as an event, and its second byte is 0.
+        # There is no such transaction with credits, and tx_pkt is left as it is.
+        def reply(r):
+            if not self.credits:
+                m.d.sync += [
+                    tx_pkt[-8 * hb:].eq(Cat(C(0, 8 * (hb - 1)), r)),
+                    use_stat.eq(1)
+                ]
+
+        # The event for tx peripheral i: the id and the length, with the length in the low nibble
+        def event(i):
+            return Cat(src_nb[i], C(0, 4 * (hb - 1)), C(i, id_bits))
+
+        # With timestamps, put the stamp of the packet of tx peripheral i in tx_pkt, after its data,
+        # most significant byte first. The data is loaded with room for it, so that it fits after a full packet.
+        def trailer(i):
+            if self.timestamps:
+                for j in range(tb):
+                    m.d.sync += tx_pkt.word_select(src_pos[i] - 1 - j, 8).eq(src_ts[i].word_select(tb - 1 - j, 8))
+
+        # Select tx peripheral i to send its packet to the STM32, and set qdir=1 to interrupt the STM32.
+        # In merged mode the packet is loaded after its event byte straight away, and the peripheral acked.
+        # Otherwise the event byte is sent like a reply, so the status still follows it.
+        # With credits we stay in the same state, as the STM32 can still send data.
+        def tx_event(i):
+            m.d.sync += [
+                periph_ev.eq(i),
+                self.qdir.eq(1)
+            ]
+            if self.merged_tx:
+                m.d.sync += [
+                    use_stat.eq(0),
+                    tx_nb.eq(src_nb[i]),
+                    src_ack[i].eq(1),
+                    tx_full.eq(1)
+                ]
+                # The packet of a pooled peripheral has already been copied to tx_pkt
+                if self.pooled[i]:
+                    m.d.sync += tx_pkt[-8 * hb:].eq(event(i))
+                else:
+                    m.d.sync += tx_pkt.eq(Cat(C(0, 8 * tb), src_pkt[i], event(i)))
+                trailer(i)
+                if not self.credits:
+                    m.next = "SEND_DATA"
+            else:
+                m.d.sync += [
+                    tx_pkt[-8 * hb:].eq(event(i)),
+                    tx_nb.eq(src_nb[i]),
+                    use_stat.eq(1)
+                ]
+                m.next = "SEND_EVENT"
+
+        # Start sending the packet of tx peripheral i. 
+        # For pooled peripherals, the packet is first copied from its buffer to tx_pkt, in the COPY state.
+        def tx_start(i):
+            if self.pooled[i]:
+                m.d.sync += [
+                    periph_ev.eq(i),
+                    copy_buf.eq(src_pkt[i]),
+                    copy_nb.eq(Mux(src_nb[i] == 0, self.pkt_size, src_nb[i])),
+                    copy_rd.eq(0),
+                    copy_wr.eq(0)
+                ]
+                m.next = "COPY"
+            else:
+                tx_event(i)
+
+        # When a packet has been sent, we set the direction back to STM32 -> ice40.
+        # But if the peripheral has a fifo with more packets, we leave the direction
+        # as it is and send the next packet.
+        def tx_done():
+            reply(ok_to_send)
+            m.d.sync += [
+                self.qdir.eq(0),
+                tx_full.eq(0),
+                tx_sent.eq(0)
+            ]
+            m.next = "IDLE"
+            for i in range(self.num_periphs):
+                if self.tx_periph[i] is not None and self.tx_depth[i] > 0:
+                    with m.If((periph_ev == i) & src_valid[i]):
+                        tx_start(i)
+
+        # The cycle counter, and the time the packet in rx_pkt was received, which is
+        # taken on every cycle that a new one can be loaded
+        if self.timestamps:
+            m.d.sync += self.timestamp.eq(self.timestamp + 1)
+            with m.If(~rx_valid | rx_ready):
+                m.d.sync += rx_ts.eq(self.timestamp)
+
+        # Set ack to false by default for all tx peripherals
+        for ack in src_ack:
+            if ack is not None:
+                m.d.sync += ack.eq(0)
+
+        # The status is a list of bytes, sent in order. It starts with the tx_pend and rx_rdy bitmaps,
+        # most significant byte first, with bit i for peripheral i, so the STM32 can schedule all
+        # the reads and writes it can do. With credits, the credit counts follow.
+        status = ([tx_pend.word_select(k, 8) for k in reversed(range(bm_bits // 8))] +
+                  [rx_rdy.word_select(k, 8) for k in reversed(range(bm_bits // 8))])
+        if self.credits:
+            status += credit_count
+            # With a CRC, the STM32 can tell which of the last 8 packets it sent were dropped, and send them again
+            if self.crc:
+                status += [rx_seq, rx_errs]
+        else:
+            # Without credits, the status follows the reply to the read that asks if it is OK to send
+            status = [tx_pkt.word_select(self.tx_size - 1 - k, 8) for k in range(hb)] + status
+        # With timestamps, the STM32 can read the cycle counter, to line up its clock with it
+        if self.timestamps:
+            status += [self.timestamp.word_select(k, 8) for k in reversed(range(4))]
+
+        # The status is sent by its own QspiTx, and qd is switched to it by use_stat,
+        # which is set by the status command with credits, or when tx_pkt holds a reply without them.
+        # With sclk capture, one QspiTxSclk sends either, chosen by the command, and drives qd itself.
+        # With ddr, qd_o and qd_o_n go to DDR output cells.
+        if self.capture == "sclk":
+            m.submodules.tx = tx = QspiTxSclk(sizes = [self.tx_size, len(status)],
+                                              cmds = [read_cmd.value, status_cmd.value], qw = self.qw, ddr = self.ddr,
+                                              crc = self.crc)
+            m.d.comb += [
+                tx.csn.eq(self.csn),
+                tx.sclk.eq(self.sclk),
+                tx.qd_i.eq(self.qd_i),
+                tx.pkts[0].eq(tx_pkt),
+                tx.pkts[1].eq(Cat(*reversed(status))),
+                tx.nbs[0].eq(tx_len),
+                tx.nbs[1].eq(len(status)),
+                self.qd_o.eq(tx.qd),
+                self.qd_o_n.eq(tx.qd_n),
+                self.qd_oe.eq(tx.oe)
+            ]
+        else:
+            m.submodules.stx = stx = QspiTx(pkt_size = len(status), qw = self.qw, crc = self.crc)
+            m.d.comb += [
+                stx.csn.eq(csn | (~tx_go if self.credits else 0)),
+                stx.sclk.eq(sclk),
+                stx.pkt.eq(Cat(*reversed(status))),
+                stx.nb.eq(len(status))
+            ]
+            m.d.sync += qd_o.eq(Mux(use_stat, stx.qd, tx.qd))
 
         # State machine
-        with m.FSM():
+        with m.FSM() as fsm:
             with m.State("START"):
-                m.d.sync += tx_pkt[-8:].eq(ok_to_send)
-                m.next = "IDLE"
+                if self.pool is not None:
+                    reply(not_ready)
+                    m.next = "LEASE"
+                else:
+                    reply(ok_to_send)
+                    m.next = "IDLE"
             # In the IDLE state, we are waiting for events.
             # The qdir pin is set to 0 to allow the STM to send data,
             # but qd.oe is set to 1, as the first transaction is always
@@ -151,76 +639,254 @@ class Dispatcher(Elaboratable):
             # at the same time, and the case where the ice40 is not ready to receive.
             # If csn does not go low, we check whether any peripheral has data 
             # to send to the STM and if so, go to PERIPH_EVENT state.
+            # With credits, qd.oe is set to 0, and a transaction starts with a command,
+            # and we load the next packet to send, when there is not one already.
             with m.State("IDLE"):
                 # If a transaction has started send ok-to-send
                 with m.If(~csn):
-                    m.next = "OK_TO_SEND"
-                # Otherwise look at all the registered tx peripherals to 
-                # see if they have valid output, and set the peripheral event.
-                # We also set qdir=1 to interrupt the STM32 to tell if we have data to send.
-                with m.Else():
-                    first = True
-                    for i in range(self.num_periphs):
-                        p = self.tx_periph[i]
-                        if p is not None:
-                            if first:
-                                with m.If(p.o_valid):
-                                    m.d.sync += [
-                                        tx_pkt[-8:].eq(Cat(p.o_nb[:4], C(i, 4))), 
-                                        periph_ev.eq(i),
-                                        self.qdir.eq(1)
-                                    ]
-                                    m.next = "SEND_EVENT"
-                                first = False
-                            else:
-                                with m.Elif(p.o_valid):
-                                    m.d.sync += [
-                                        tx_pkt[-8:].eq(Cat(p.o_nb[:4], C(i, 4))),
-                                        periph_ev.eq(i),
-                                        self.qdir.eq(1)
-                                    ]
-                                    m.next = "SEND_EVENT"
+                    m.next = "COMMAND" if self.credits else "OK_TO_SEND"
+                # Otherwise see if the arbiter has chosen a tx peripheral with valid output,
+                # and set the peripheral event. A NACK is replied to first.
+                with m.Elif(arb.valid & ~tx_full & ~rx_nack):
+                    m.d.comb += arb.next.eq(1)
+                    with m.Switch(arb.grant):
+                        for i in range(self.num_periphs):
+                            if self.tx_periph[i] is not None:
+                                with m.Case(i):
+                                    tx_start(i)
+            # In COMMAND state, used with credits, we wait for the command byte that starts
+            # every transaction. 0xF8 reads the status, 0xF9 reads the packet to send,
+            # 0xF1 starts a burst, and anything else is the header of a packet being sent.
+            # With a CRC, 0xFA acks the packet that was read, which is kept until then.
+            with m.State("COMMAND"):
+                with m.If(rx.byte_valid):
+                    with m.Switch(rx.pkt[:8]):
+                        with m.Case(status_cmd.value):
+                            m.d.sync += use_stat.eq(1)
+                            m.next = "READ"
+                        with m.Case(read_cmd.value):
+                            m.d.sync += use_stat.eq(0)
+                            m.next = "READ"
+                        if self.burst:
+                            with m.Case(burst_cmd.value):
+                                m.next = "BURST_HEADER"
+                        if self.crc:
+                            with m.Case(ack_cmd.value):
+                                with m.If(tx_full):
+                                    tx_done()
+                                m.next = "WAIT_FOR_TXN"
+                        with m.Default():
+                            m.next = "RECEIVING"
+                with m.If(csn):
+                    m.next = "IDLE"
+            # In READ state, used with credits, the STM32 is reading the status or the packet to send.
+            # We start driving qd when the command byte has been sent, and start sending
+            # after the dummy byte that follows it, which gives the STM32 time to stop driving qd.
+            # If the STM32 ended the read before getting all of the packet, we send it all again,
+            # and with a CRC we do that until it is acked.
+            with m.State("READ"):
+                with m.If(Fell(sclk)):
+                    m.d.sync += qd_oe.eq(1)
+                    with m.If(rx.nb == 2):
+                        m.d.sync += tx_go.eq(1)
+                with m.If(csn):
+                    m.d.sync += [
+                        qd_oe.eq(0),
+                        tx_go.eq(0)
+                    ]
+                    m.next = "IDLE"
+                    if not self.crc:
+                        with m.If(~use_stat & tx_full & (rx.nb >= tx_len + 2)):
+                            tx_done()
             # In OK_TO_SEND state, the STM32 has started a transaction
             # to see if it is OK to send. Wait for csn to go high.
+            # If more than the reply was read, it was a status read, and no data follows.
             with m.State("OK_TO_SEND"):
                 with m.If(csn):
-                    m.next = "WAIT_STM_DATA"
+                    with m.If(rx_nack):
+                        reply(ok_to_send)
+                        m.d.sync += rx_nack.eq(0)
+                    with m.If(rx.nb > hb):
+                        m.next = "IDLE"
+                    with m.Else():
+                        m.next = "WAIT_STM_DATA"
             # In WAIT_STM_DATA state, we are waiting for the STM to send
             # the data packet
             with m.State("WAIT_STM_DATA"):
                 with m.If(~csn):
-                    m.d.sync += self.qd_oe.eq(0) # Allow read from qd
+                    m.d.sync += qd_oe.eq(0) # Allow read from qd
                     m.next = "RECEIVING"
             # In RECEIVING state we receive the data via QSPI
+            # If the first byte is the burst command, we go to the BURST_HEADER state instead.
+            # With a CRC, the packet is followed by its CRC, and dropped if that is wrong.
+            # Without credits, the next reply is then a NACK, and the STM32 sends it again.
+            # With credits, the status says which of the last packets were dropped.
+            # With timestamps, 0xFB followed by 4 bytes, instead of a packet, sets the cycle counter.
+            # A packet for a stream peripheral that is ready is cut through: the peripheral is started as soon as
+            # the header has arrived, and passed each byte as it arrives, so it has the packet when csn goes high.
             with m.State("RECEIVING"):
+                if self.pool is not None:
+                    m.d.comb += pp.w_req.eq(rx.byte_valid & (rx.nb > hb) & (rx.nb <= self.pkt_size))
+                if self.burst:
+                    with m.If(rx.byte_valid & (rx.nb == 1) & (rx.pkt[:8] == burst_cmd)):
+                        m.next = "BURST_HEADER"
+                if any(self.streamed):
+                    with m.If(rx.byte_valid & (rx.nb == hb) & ct_ok):
+                        m.d.sync += [
+                            ct_on.eq(1),
+                            periph_ev.eq(hdr_id),
+                            st_id.eq(hdr_id),
+                            st_flags.eq(rx.pkt[:4]),
+                            st_start.eq(1)
+                        ]
+                    with m.If(ct_on & rx.byte_valid & (rx.nb > hb) & (rx.nb <= self.pkt_size)):
+                        m.d.sync += [
+                            st_byte.eq(rx.pkt[:8]),
+                            st_valid.eq(1)
+                        ]
+                rx_ok = (rx.crc == 0) & (rx.nb >= hb + cb) if self.crc else C(1)
+                set_ts = C(0)
+                if self.timestamps:
+                    set_ts = rx_ok & (rx.nb == 5 + cb) & (rx.pkt.bit_select((rx.nb << 3) - 8, 8) == ts_cmd)
                 with m.If(csn):
+                    m.d.sync += qd_oe.eq(idle_oe)    # Allow write to qd, by default
+                    if self.crc and self.credits:
+                        m.d.sync += [
+                            rx_seq.eq(rx_seq + 1),
+                            rx_errs.eq(Cat(~rx_ok, rx_errs[:-1]))
+                        ]
+                    # A packet cut through has already been passed on, apart from its end
+                    with m.If(ct_on):
+                        m.d.comb += ct_end.eq(1)
+                        m.d.sync += [
+                            ct_on.eq(0),
+                            st_end.eq(1),
+                            st_nb.eq(Mux(rx.nb > self.pkt_size, self.pkt_size, rx.nb) - hb)
+                        ]
+                        reply(not_ready)
+                        m.next = "WAIT_FOR_TXN"
+                    with m.Elif(set_ts):
+                        m.d.sync += self.timestamp.eq(rx.pkt[8 * cb:8 * cb + 32])
+                        reply(not_ready)
+                        m.next = "WAIT_FOR_TXN"
+                    with m.Elif(rx_ok):
+                        m.d.sync += [
+                            rx_valid.eq(1),              # We have valid data for the selected peripheral
+                            rx_pkt.eq(rx.pkt[8 * cb:]),  # Copy the data to the packet buffer
+                            periph_ev.eq(rx.pkt.bit_select((rx.nb << 3) - id_bits, id_bits)), # Copy the peripheral id
+                            nb.eq(rx.nb - hb - cb),      # Get the number of bytes received
+                            flags.eq(rx.pkt.bit_select((rx.nb << 3) - 8 * hb, 4))
+                        ]
+                        reply(not_ready)                 # We return not ready to STM while waiting
+                        m.next = "RECEIVE_HANDSHAKE"
+                    with m.Else():
+                        if not self.credits:
+                            m.d.sync += rx_nack.eq(1)
+                        reply(nack)
+                        m.next = "IDLE"
+            # In BURST_HEADER state we wait for the header that all the packets
+            # of the burst are sent with, after the burst command.
+            with m.State("BURST_HEADER"):
+                with m.If(rx.byte_valid & (rx.nb == hb + 1)):
                     m.d.sync += [
-                        rx_valid.eq(1),              # We have valid data for the selected peripheral
-                        rx_pkt.eq(rx.pkt),           # Copy the data to the packet buffer
-                        self.qd_oe.eq(1),            # Allow write to qd, by default
-                        periph_ev.eq(rx.pkt.bit_select((rx.nb << 3) - 4, 4)), # Copy the peripheral id
-                        tx_pkt[-8:].eq(not_ready),   # We return not ready to STM while waiting
-                        nb.eq(rx.nb-1),              # Get the number of bytes received
-                        flags.eq(rx.pkt.bit_select((rx.nb << 3) - 8, 4))
+                        hdr.eq(rx.pkt[:8 * hb]),
+                        periph_ev.eq(rx.pkt[8 * hb - id_bits:8 * hb]),
+                        flags.eq(rx.pkt[:4]),
+                        burst_nb.eq(0)
                     ]
+                    m.next = "BURST_DATA"
+                with m.If(csn):
+                    m.d.sync += qd_oe.eq(idle_oe)
+                    m.next = "WAIT_FOR_TXN"
+            # In BURST_DATA state, every pkt_size - hdr_size bytes received are passed to the selected
+            # peripheral as a packet, while the rest of the burst is still being received.
+            # The peripheral must consume each packet before the next one is complete,
+            # otherwise the next one is dropped and burst_overrun set.
+            # When csn goes high, any remaining bytes are sent as a shorter packet.
+            with m.State("BURST_DATA"):
+                with m.If(rx_ready):
+                    m.d.sync += rx_valid.eq(0)
+                with m.If(rx.byte_valid):
+                    with m.If(burst_nb == self.pkt_size - hb - 1):
+                        m.d.sync += burst_nb.eq(0)
+                        with m.If(~rx_valid | rx_ready):
+                            m.d.sync += [
+                                rx_valid.eq(1),
+                                rx_pkt.eq(burst_pkt(self.pkt_size - hb)),
+                                nb.eq(self.pkt_size - hb)
+                            ]
+                        with m.Else():
+                            m.d.sync += self.burst_overrun.eq(1)
+                    with m.Else():
+                        m.d.sync += burst_nb.eq(burst_nb + 1)
+                with m.If(csn):
+                    m.d.sync += qd_oe.eq(idle_oe)
+                    reply(not_ready)
+                    with m.If(burst_nb != 0):
+                        with m.If(~rx_valid | rx_ready):
+                            m.d.sync += [
+                                rx_valid.eq(1),
+                                rx_pkt.eq(burst_pkt(burst_nb)),
+                                nb.eq(burst_nb)
+                            ]
+                        with m.Else():
+                            m.d.sync += self.burst_overrun.eq(1)
                     m.next = "RECEIVE_HANDSHAKE"
-            # IN RECEIVE_HANDSHAKE state, we wait for the selected peripheral to be ready
-            # to consume the data, and then set valid false.
+            # IN RECEIVE_HANDSHAKE state, we wait for the selected peripheral, or its fifo,
+            # to be ready to consume the data, and then set valid false.
             # We then go to the WAIT_FOR_TXN state.
+            # With the pool, if the buffer was passed to a pooled peripheral, we go to the LEASE state instead.
             with m.State("RECEIVE_HANDSHAKE"):
-                for i in range(self.num_periphs):
-                    p = self.rx_periph[i]
-                    if p is not None:
-                        with m.If((i == periph_ev) & p.o_ready):
-                            m.d.sync += rx_valid.eq(0)
-                            m.next = "WAIT_FOR_TXN"
+                with m.If(rx_ready):
+                    m.d.sync += rx_valid.eq(0)
+                    m.next = "WAIT_FOR_TXN"
+                    if self.pool is not None:
+                        with m.If(rx_pooled):
+                            m.next = "LEASE"
+            # In LEASE state, used with the pool, we lease a buffer for the next packet received.
+            # The STM32 is told it is not ready until we have one.
+            if self.pool is not None:
+                with m.State("LEASE"):
+                    m.d.comb += pp.lease_req.eq(1)
+                    with m.If(pp.lease_ack):
+                        m.d.sync += cur_buf.eq(pp.lease_buf)
+                        m.next = "WAIT_FOR_TXN"
             # In WAIT_FOR_TXN, we wait for the completion of any request to send
             # read transaction (that will have been replied to with not_ready),
             # before going back to the IDLE state
             with m.State("WAIT_FOR_TXN"):
                 with m.If(csn):
-                    m.d.sync += tx_pkt[-8:].eq(ok_to_send)
+                    reply(ok_to_send)
                     m.next = "IDLE"
+            # In COPY state, used with the pool, the packet to send is copied from its buffer to tx_pkt,
+            # a byte a cycle. The buffer is then released, and the packet sent as usual.
+            # If a transaction starts first, we go to OK_TO_SEND as in IDLE state, and copy it again later.
+            if self.pool is not None:
+                with m.State("COPY"):
+                    m.d.comb += [
+                        pp.r_req.eq(copy_rd != copy_nb),
+                        pp.r_buf.eq(copy_buf),
+                        pp.r_off.eq(copy_rd)
+                    ]
+                    with m.If(pp.r_gnt):
+                        m.d.sync += copy_rd.eq(copy_rd + 1)
+                    with m.If(pp.r_ack):
+                        m.d.sync += [
+                            tx_pkt.word_select(self.pkt_size + tb - 1 - copy_wr, 8).eq(pp.r_data),
+                            copy_wr.eq(copy_wr + 1)
+                        ]
+                    with m.If(~csn):
+                        m.next = "OK_TO_SEND"
+                    with m.Elif(copy_wr == copy_nb):
+                        m.d.comb += [
+                            pp.release.eq(1),
+                            pp.release_buf.eq(copy_buf)
+                        ]
+                        with m.Switch(periph_ev):
+                            for i in range(self.num_periphs):
+                                if self.tx_periph[i] is not None and self.pooled[i]:
+                                    with m.Case(i):
+                                        tx_event(i)
             # In SEND_EVENT state, we wait for the read transaction to start.
             with m.State("SEND_EVENT"):
                 with m.If(~csn):
@@ -239,21 +905,66 @@ class Dispatcher(Elaboratable):
                         if p is not None:
                             with m.Case(i):
                                 m.d.sync += [
-                                    tx_pkt.eq(p.o_pkt),
-                                    p.i_ack.eq(1)
+                                    tx_pkt.eq(Cat(C(0, 8 * tb), src_pkt[i])),
+                                    src_ack[i].eq(1),
+                                    use_stat.eq(0)
                                 ]
+                                trailer(i)
                 m.next = "SEND_DATA"
             # In SEND_DATA state we are waiting for the read transaction to start.
             with m.State("SEND_DATA"):
                 with m.If(~csn):
                     m.next = "SENDING"
             # In SENDING state, we are using QSPI to send the packet to the STM32.
-            # When this is done, we set the direction back to STM32 -> ice40.
+            # In merged mode, if the STM32 ended the read before getting all the data,
+            # for example because it only read the event byte, we send it all again.
+            # With a CRC, the packet is kept, and sent again by every read, until the STM32 has read all of it
+            # and then acks it with a read of a single byte, which is shorter than any read of the data.
             with m.State("SENDING"):
                 with m.If(csn):
-                    m.d.sync += tx_pkt[-8:].eq(ok_to_send)
-                    m.d.sync += self.qdir.eq(0)
-                    m.next = "IDLE"
+                    if self.crc:
+                        with m.If(tx_sent & (rx.nb == 1)):
+                            tx_done()
+                        with m.Else():
+                            with m.If(rx.nb >= (tx_len + cb if self.merged_tx else 2)):
+                                m.d.sync += tx_sent.eq(1)
+                            m.next = "SEND_DATA"
+                    elif self.merged_tx:
+                        with m.If(rx.nb < tx_len + cb):
+                            m.next = "SEND_DATA"
+                        with m.Else():
+                            tx_done()
+                    else:
+                        tx_done()
+
+        # Feed the link events to the statistics peripherals.
+        # A transaction is a write if the STM32 sent a packet or a burst, or, with credits, anything but a read.
+        if self.stats:
+            csn_d = Signal(reset=1)
+            m.d.sync += csn_d.eq(csn)
+
+            def in_state(s):
+                return fsm.ongoing(s) if s in fsm.encoding else C(0)
+
+            write = in_state("RECEIVING") | in_state("BURST_HEADER") | in_state("BURST_DATA")
+            if self.credits:
+                write = ~in_state("READ")
+
+            tx_ack   = Cat(*[a if a is not None else C(0) for a in src_ack])
+            tx_valid = Cat(*[v if v is not None else C(0) for v in src_valid])
+            for p in self.stats:
+                link = p.link
+                m.d.comb += [
+                    link.txn_end.eq(csn & ~csn_d),
+                    link.txn_write.eq(write),
+                    link.txn_nb.eq(rx.nb),
+                    link.not_ready.eq(~csn & csn_d & use_stat & (tx_pkt[-8:] == not_ready) if not self.credits else 0),
+                    link.state.eq(Cat(*[in_state(s) for s in STATES])),
+                    link.rx_pkt.eq((rx_valid & rx_ready) | ct_end),
+                    link.rx_id.eq(periph_ev),
+                    link.tx_valid.eq(tx_valid),
+                    link.tx_ack.eq(tx_ack)
+                ]
 
         return m
 
@@ -1,11 +1,18 @@
 from nmigen import *
+from nmigen.utils import log2_int
 
 class BramPeriph(Elaboratable):
-    """ BRAM peripheral """
-    def __init__(self, pkt_size=16, depth=4096):
+    """
+    BRAM peripheral. The memory is width bits wide, and is read and written a word a cycle,
+    so with width=32, the bytes of a packet are written in 4 or 5 cycles, instead of 13
+    """
+    def __init__(self, pkt_size=16, depth=4096, width=8):
+        assert width in (8, 16, 32, 64, 128)
+
         # Parameters
         self.pkt_size = pkt_size
-        self.depth    = depth
+        self.depth    = depth       # In bytes
+        self.width    = width
 
         # Inputs
         self.i_pkt    = Signal(pkt_size * 8)
@@ -17,71 +24,147 @@ class BramPeriph(Elaboratable):
         # Outputs
         self.o_ready  = Signal()
         self.o_valid  = Signal()
-        self.o_nb     = Signal(4)
+        self.o_nb     = Signal(5)
         self.o_pkt    = Signal(pkt_size * 8)
 
     def elaborate(self, platform):
         m = Module()
 
-        # Create the memory and its ports, currently only width=8 is supported
-        mem = Memory(width=8, depth=self.depth)
-        m.submodules.w = w = mem.write_port()
+        # The number of bytes in a word
+        bw = self.width // 8
+        lb = log2_int(bw)
+
+        # Create the memory and its ports, with a write enable for each byte of a word
+        mem = Memory(width=self.width, depth=self.depth // bw)
+        m.submodules.w = w = mem.write_port(granularity=8)
         m.submodules.r = r = mem.read_port()
 
         # Signals
-        nb    = Signal(4)
-        addr  = Signal(16)
+        nb    = Signal(5)               # The number of bytes left to read or write
+        addr  = Signal(16)              # The byte address of the next of them
         i_pkt = Signal(self.pkt_size * 8)
         req   = Signal()
 
+        # The byte of the word that addr is in, and the number of bytes read or written this cycle,
+        # which are the rest of that word, or the rest of the bytes
+        lane  = Signal(range(bw))
+        k     = Signal(range(bw + 1))
+
+        # The word read in the last cycle: its first byte and number of bytes, the index of the first
+        # of them in the packet sent back, and whether they are the last
+        rd_valid = Signal()
+        rd_lane  = Signal(range(bw))
+        rd_k     = Signal(range(bw + 1))
+        rd_j     = Signal(5)
+        rd_last  = Signal()
+
+        # The address of the next byte streamed, and the number of bytes left to stream back
+        s_addr = Signal(16)
+        s_left = Signal(16)
+        chunk  = Signal(5)
+
         # A write request consists of a 1-bit request (1=write, 0=read), followed by
         # a 15-bit address, followed by a variable number of bytes (up to 13)
         # A read request starts with the same request bit and address, and that is 
         # followed by a byte specifying the number of bytes to read (up to 16)
+        #
+        # For streaming, flags bit 1 is set. With bit 0 unset, the packet sets the stream 
+        # address, and can be followed by a 2-byte length, and if it is, that many bytes
+        # are sent back from the stream address, in a sequence of full packets.
+        # With bit 0 set, every byte of the packet is data, which is written at the 
+        # stream address, and the stream address is incremented past it.
 
         req_bit = self.i_flags[0]
+        stream  = self.i_flags[1]
 
         # Copy in the packet when valid and ready
         with m.If(self.i_valid & self.o_ready):
+            with m.If(~stream):
+                m.d.sync += [
+                    i_pkt.eq(self.i_pkt),
+                    # Get the 15-bit address
+                    addr.eq(self.i_pkt.bit_select(Cat(C(0,3), self.i_nb) - 16, 16)),
+                    # Get the request bit
+                    req.eq(req_bit),
+                    # The number of bytes to write after the address, or to read
+                    nb.eq(Mux(req_bit == 1, self.i_nb - 2, self.i_pkt[:8])),
+                    # Output number of bytes is only relevant for read requests
+                    self.o_nb.eq(self.i_pkt[:8]) 
+                ]
+            with m.Elif(req_bit):
+                # Write the data at the stream address
+                m.d.sync += [
+                    i_pkt.eq(self.i_pkt),
+                    addr.eq(s_addr),
+                    req.eq(1),
+                    nb.eq(self.i_nb),
+                    s_addr.eq(s_addr + self.i_nb)
+                ]
+            with m.Else():
+                # Set the stream address, and the number of bytes to stream back
+                m.d.sync += [
+                    s_addr.eq(self.i_pkt.bit_select(Cat(C(0,3), self.i_nb) - 16, 16)),
+                    s_left.eq(Mux(self.i_nb >= 4, self.i_pkt[:16], 0))
+                ]
+        # Otherwise, when streaming back, start reading the next packet, which is full unless it is the last
+        with m.Elif(self.o_ready & (s_left > 0)):
+            m.d.comb += chunk.eq(Mux(s_left > self.pkt_size, self.pkt_size, s_left))
             m.d.sync += [
-                i_pkt.eq(self.i_pkt),
-                # Get the 15-bit address
-                addr.eq(self.i_pkt.bit_select(Cat(C(0,3), self.i_nb) - 16, 16)),
-                # Get the request bit
-                req.eq(req_bit),
-                # Add 1 to number of bytes for read requests to make detecting 
-                # all bytes read simpler
-                nb.eq(Mux(req_bit == 1, self.i_nb - 2, self.i_pkt[:8] + 1)),
-                # Output number of bytes is only relevant for read requests
-                self.o_nb.eq(self.i_pkt[:8]) 
+                addr.eq(s_addr),
+                req.eq(0),
+                nb.eq(chunk),
+                self.o_nb.eq(chunk),
+                s_addr.eq(s_addr + chunk),
+                s_left.eq(s_left - chunk)
             ]
         
         # We are ready when we have written all the bytes, and, for reads, the output has been acked
-        m.d.comb += self.o_ready.eq((nb == 0) & ~self.o_valid)
+        m.d.comb += self.o_ready.eq((nb == 0) & ~rd_valid & ~self.o_valid)
 
-        # Connect to memory
         m.d.comb += [
-            w.en.eq((nb > 0) & (req == 1)),
-            w.data.eq(i_pkt.word_select(nb - 1, 8)),
-            w.addr.eq(addr),
-            r.addr.eq(addr)
+            lane.eq(addr & (bw - 1)),
+            k.eq(Mux(nb > bw - lane, bw - lane, nb))
         ]
 
-        # Decrement number of byte each cycle
-        with m.If(nb > 0):
-            m.d.sync += nb.eq(nb - 1)
+        # Connect to memory. Byte l of the word written is byte nb - 1 - (l - lane) of i_pkt, 
+        # as the data is at the bottom of it, first byte first.
+        m.d.comb += [
+            w.addr.eq(addr >> lb),
+            r.addr.eq(addr >> lb)
+        ]
+        for l in range(bw):
+            m.d.comb += [
+                w.en[l].eq((nb > 0) & (req == 1) & (l >= lane) & (l < lane + k)),
+                w.data.word_select(l, 8).eq(i_pkt.word_select(nb + lane - (l + 1), 8))
+            ]
 
-        # Increment address for all but first byte
+        # Move on by the bytes read or written
         with m.If(nb > 0):
-            m.d.sync += addr.eq(addr+1)
+            m.d.sync += [
+                nb.eq(nb - k),
+                addr.eq(addr + k)
+            ]
+
+        # For read requests, note the bytes of the word being read
+        m.d.sync += rd_valid.eq((req == 0) & (nb > 0))
+        with m.If((req == 0) & (nb > 0)):
+            m.d.sync += [
+                rd_lane.eq(lane),
+                rd_k.eq(k),
+                rd_j.eq(self.o_nb - nb),
+                rd_last.eq(nb == k)
+            ]
 
-        # For read requests, copy bytes to o_pkt
-        with m.If(req == 0 & (nb > 0)):
-            m.d.sync += self.o_pkt.word_select(self.pkt_size - 1 - self.o_nb + nb, 8).eq(r.data)
+        # and copy them to o_pkt, where byte j of the data is sent from the top
+        with m.If(rd_valid):
+            for l in range(bw):
+                with m.If((l >= rd_lane) & (l < rd_lane + rd_k)):
+                    m.d.sync += self.o_pkt.word_select(rd_lane + (self.pkt_size - 1 - l) - rd_j, 8).eq(
+                        r.data.word_select(l, 8))
 
-        # Set o_valid when reading last byte
-        with m.If((req == 0) & (nb == 1)):
-            m.d.sync += self.o_valid.eq(1)
+            # Set o_valid with the last bytes
+            with m.If(rd_last):
+                m.d.sync += self.o_valid.eq(1)
 
         # Unset o_valid when acked
         with m.If(self.i_ack):
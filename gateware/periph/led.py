@@ -2,9 +2,10 @@ from nmigen import *
 
 class Led(Elaboratable):
     """ Test peripheral that writes to leds """
-    def __init__(self, pkt_size=16):
+    def __init__(self, pkt_size=16, stream=False):
         # Parameters
         self.pkt_size = pkt_size
+        self.stream   = stream      # Register with the dispatcher with stream=True
 
         # Inputs
         self.i_pkt    = Signal(self.pkt_size * 8)
@@ -13,6 +14,12 @@ class Led(Elaboratable):
         self.i_nb     = Signal()
         self.i_flags  = Signal(4)
 
+        # Stream inputs, when stream is set
+        self.i_start      = Signal()
+        self.i_byte       = Signal(8)
+        self.i_byte_valid = Signal()
+        self.i_end        = Signal()
+
         # Outputs
         self.o_ready  = Signal()
         self.o_valid  = Signal()
@@ -24,9 +31,13 @@ class Led(Elaboratable):
     def elaborate(self, platform):
         m = Module()
 
-        # Put valid input on the leds
-        with m.If(self.i_valid):
-            m.d.sync += self.led.eq(self.i_pkt[:8])
+        # Put valid input on the leds, which is the last byte of each packet, or when streamed, each byte
+        if self.stream:
+            with m.If(self.i_byte_valid):
+                m.d.sync += self.led.eq(self.i_byte)
+        else:
+            with m.If(self.i_valid):
+                m.d.sync += self.led.eq(self.i_pkt[:8])
         
         # Always ready and no output
         m.d.comb += [
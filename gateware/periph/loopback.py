@@ -0,0 +1,52 @@
+from nmigen import *
+
+class Loopback(Elaboratable):
+    """ Test peripheral that sends back the packets it receives """
+    def __init__(self, pkt_size=16, pooled=False):
+        # Parameters
+        self.pkt_size = pkt_size
+        self.pooled   = pooled      # Register with the dispatcher with pooled=True
+
+        # Inputs
+        self.i_pkt    = Signal(self.pkt_size * 8)
+        self.i_valid  = Signal()
+        self.i_ack    = Signal()
+        self.i_nb     = Signal(4)
+        self.i_flags  = Signal(4)
+        self.i_buf    = Signal(8)   # The pool buffer received, when pooled
+
+        # Outputs
+        self.o_ready  = Signal()
+        self.o_valid  = Signal()
+        self.o_pkt    = Signal(pkt_size * 8)
+        self.o_nb     = Signal(5)
+        self.o_buf    = Signal(8)   # The pool buffer to send, when pooled
+
+        self.led      = Signal(8)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        # Ready when the last packet has been sent back
+        m.d.comb += self.o_ready.eq(~self.o_valid)
+
+        with m.If(self.i_valid & self.o_ready):
+            m.d.sync += [
+                self.o_nb.eq(self.i_nb),
+                self.o_valid.eq(1)
+            ]
+            # When pooled, the buffer received is sent back, without copying it.
+            # Otherwise the data received is at the bottom of i_pkt, and is sent from the top of o_pkt.
+            if self.pooled:
+                m.d.sync += self.o_buf.eq(self.i_buf)
+            else:
+                m.d.sync += [
+                    self.o_pkt.eq(self.i_pkt << ((self.pkt_size - self.i_nb) << 3)),
+                    self.led.eq(self.i_pkt[:8])
+                ]
+
+        # Unset o_valid when acked
+        with m.If(self.i_ack):
+            m.d.sync += self.o_valid.eq(0)
+
+        return m
@@ -0,0 +1,42 @@
+from nmigen import *
+
+from stream import StreamPeriph
+from sar import Reassembler, Segmenter
+
+class MessageLoopback(StreamPeriph):
+    """
+    Test peripheral that sends back the messages it receives, reassembling them and segmenting them again.
+    Its leds count the packets that were out of order.
+    """
+    def elaborate(self, platform):
+        m = super().elaborate(platform)
+
+        m.submodules.reasm = reasm = Reassembler()
+        m.submodules.seg   = seg   = Segmenter(self.pkt_size)
+
+        # An empty message is dropped, as a message to send has at least one byte
+        empty = reasm.out.last & (reasm.out.nb == 0)
+
+        m.d.comb += [
+            reasm.inp.data.eq(self.rx.data),
+            reasm.inp.valid.eq(self.rx.valid),
+            reasm.inp.last.eq(self.rx.last),
+            reasm.inp.flags.eq(self.rx.flags),
+            reasm.inp.nb.eq(self.rx.nb),
+            self.rx.ready.eq(reasm.inp.ready),
+
+            seg.inp.data.eq(reasm.out.data),
+            seg.inp.valid.eq(reasm.out.valid & ~empty),
+            seg.inp.last.eq(reasm.out.last),
+            reasm.out.ready.eq(seg.inp.ready | empty),
+
+            self.tx.data.eq(seg.out.data),
+            self.tx.valid.eq(seg.out.valid),
+            self.tx.last.eq(seg.out.last),
+            seg.out.ready.eq(self.tx.ready)
+        ]
+
+        with m.If(reasm.o_error):
+            m.d.sync += self.led.eq(self.led + 1)
+
+        return m
@@ -0,0 +1,178 @@
+from nmigen import *
+
+# The dispatcher states that cycles are counted for, in the order of their counters.
+# States that the dispatcher does not have, for the options it was created with, stay at 0.
+STATES = ["START", "IDLE", "COMMAND", "READ", "OK_TO_SEND", "WAIT_STM_DATA", "RECEIVING",
+          "BURST_HEADER", "BURST_DATA", "RECEIVE_HANDSHAKE", "LEASE", "WAIT_FOR_TXN", "COPY",
+          "SEND_EVENT", "SENDING_EVENT", "PERIPH_EVENT", "SEND_DATA", "SENDING"]
+
+# The counters before the state counters
+GENERAL = ["RX_TXNS", "TX_TXNS", "RX_BYTES", "TX_BYTES", "NOT_READY", "LAT_MIN", "LAT_MAX", "LAT_COUNT"]
+
+class LinkEvents:
+    """ The events the dispatcher feeds to the statistics peripheral, all in the sync domain """
+    def __init__(self, num_periphs):
+        self.txn_end   = Signal()                 # Strobe set when a transaction ends
+        self.txn_write = Signal()                 # Set with txn_end when the STM32 was writing
+        self.txn_nb    = Signal(8)                # The number of bytes in the transaction, with txn_end
+        self.not_ready = Signal()                 # Strobe set when a NOT_READY reply is read
+        self.state     = Signal(len(STATES))      # Bit k is set while the dispatcher is in STATES[k]
+        self.rx_pkt    = Signal()                 # Strobe set when a packet is passed to an rx peripheral
+        self.rx_id     = Signal(8)                # The peripheral it is passed to
+        self.tx_valid  = Signal(num_periphs)      # Bit i is set while tx peripheral i has a packet to send
+        self.tx_ack    = Signal(num_periphs)      # Bit i is set when the packet of tx peripheral i is taken
+
+class Stats(Elaboratable):
+    """ Statistics peripheral, with performance counters for the QSPI link """
+    def __init__(self, pkt_size=16, num_periphs=15, width=32, buckets=16):
+        # Parameters
+        self.pkt_size    = pkt_size
+        self.num_periphs = num_periphs
+        self.width       = width                  # The width of each counter, a whole number of bytes
+        self.buckets     = buckets                # The number of latency histogram buckets
+
+        # Inputs
+        self.i_pkt    = Signal(pkt_size * 8)
+        self.i_valid  = Signal()
+        self.i_nb     = Signal(4)
+        self.i_ack    = Signal()
+        self.i_flags  = Signal(4)
+
+        # Outputs
+        self.o_ready  = Signal()
+        self.o_valid  = Signal()
+        self.o_nb     = Signal(4)
+        self.o_pkt    = Signal(pkt_size * 8)
+
+        # The events counted, driven by the dispatcher when registered with stats=True
+        self.link = LinkEvents(num_periphs)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        link  = self.link
+        width = self.width
+        n     = self.num_periphs
+
+        # The counters, in the order they are read: the general ones, the cycles in each state,
+        # the packets received by each rx peripheral, the packets sent by each tx peripheral,
+        # and the latency histogram. The minimum latency starts at its highest value.
+        def counters(names):
+            return [Signal(width, name=name.lower(), reset=2 ** width - 1 if name == "LAT_MIN" else 0)
+                    for name in names]
+
+        general = counters(GENERAL)
+        state   = counters(["state_" + s for s in STATES])
+        rx_pkts = counters(["rx_pkts_" + str(i) for i in range(n)])
+        tx_pkts = counters(["tx_pkts_" + str(i) for i in range(n)])
+        hist    = counters(["hist_" + str(k) for k in range(self.buckets)])
+        cnt     = general + state + rx_pkts + tx_pkts + hist
+
+        rx_txns, tx_txns, rx_bytes, tx_bytes, not_ready, lat_min, lat_max, lat_count = general
+
+        # A read request is a packet with flags 0, and two bytes, the index of the first counter,
+        # and the number to read, which fit in a packet, most significant byte first.
+        # Flags 1 resets all the counters, and flags 2 selects the tx peripheral whose latency,
+        # from having a packet to send to it being taken, is measured, from the first byte.
+        cw    = width // 8
+        slots = self.pkt_size // cw
+        first = self.i_pkt.word_select(self.i_nb - 1, 8)
+        count = self.i_pkt.word_select(self.i_nb - 2, 8)
+
+        idx   = Signal(8)                         # The index of the next counter to copy
+        left  = Signal(range(slots + 1))          # The number of counters left to copy
+        slot  = Signal(range(slots))              # The slot of o_pkt to copy it to
+        clear = Signal()                          # Set to reset the counters
+        sel   = Signal(range(n))                  # The tx peripheral whose latency is measured
+
+        # We are ready when we are not copying counters, and there is no reply waiting
+        m.d.comb += self.o_ready.eq((left == 0) & ~self.o_valid)
+        m.d.sync += clear.eq(0)
+
+        with m.If(self.i_valid & self.o_ready):
+            with m.Switch(self.i_flags):
+                with m.Case(0):
+                    m.d.sync += [
+                        idx.eq(first),
+                        left.eq(Mux(count > slots, slots, count)),
+                        slot.eq(0),
+                        self.o_nb.eq(Mux(count > slots, slots, count) * cw)
+                    ]
+                with m.Case(1):
+                    m.d.sync += clear.eq(1)
+                with m.Case(2):
+                    m.d.sync += [
+                        sel.eq(first),
+                        clear.eq(1)
+                    ]
+
+        # Copy a counter a cycle to the reply, and set o_valid when they have all been copied
+        with m.If(left > 0):
+            m.d.sync += [
+                self.o_pkt.word_select(slots - 1 - slot, width).eq(Array(cnt)[idx]),
+                idx.eq(idx + 1),
+                slot.eq(slot + 1),
+                left.eq(left - 1)
+            ]
+            with m.If(left == 1):
+                m.d.sync += self.o_valid.eq(1)
+
+        with m.If(self.i_ack):
+            m.d.sync += self.o_valid.eq(0)
+
+        # Count the transactions and their bytes
+        with m.If(link.txn_end):
+            with m.If(link.txn_write):
+                m.d.sync += [
+                    rx_txns.eq(rx_txns + 1),
+                    rx_bytes.eq(rx_bytes + link.txn_nb)
+                ]
+            with m.Else():
+                m.d.sync += [
+                    tx_txns.eq(tx_txns + 1),
+                    tx_bytes.eq(tx_bytes + link.txn_nb)
+                ]
+
+        with m.If(link.not_ready):
+            m.d.sync += not_ready.eq(not_ready + 1)
+
+        # Count the cycles in each state
+        for k in range(len(STATES)):
+            with m.If(link.state[k]):
+                m.d.sync += state[k].eq(state[k] + 1)
+
+        # Count the packets of each peripheral
+        for i in range(n):
+            with m.If(link.rx_pkt & (link.rx_id == i)):
+                m.d.sync += rx_pkts[i].eq(rx_pkts[i] + 1)
+            with m.If(link.tx_ack[i]):
+                m.d.sync += tx_pkts[i].eq(tx_pkts[i] + 1)
+
+        # The latency of the selected peripheral is counted while it has a packet to send,
+        # and added to the histogram when it is taken. Bucket k counts latencies below 2**(k + 1).
+        lat    = Signal(width)
+        bucket = Signal(range(self.buckets))
+        m.d.comb += bucket.eq(self.buckets - 1)
+        for k in reversed(range(self.buckets - 1)):
+            with m.If(lat < 2 ** (k + 1)):
+                m.d.comb += bucket.eq(k)
+
+        with m.If(link.tx_ack.bit_select(sel, 1)):
+            m.d.sync += [
+                lat.eq(0),
+                lat_count.eq(lat_count + 1),
+                Array(hist)[bucket].eq(Array(hist)[bucket] + 1)
+            ]
+            with m.If(lat < lat_min):
+                m.d.sync += lat_min.eq(lat)
+            with m.If(lat > lat_max):
+                m.d.sync += lat_max.eq(lat)
+        with m.Elif(link.tx_valid.bit_select(sel, 1)):
+            m.d.sync += lat.eq(lat + 1)
+
+        # Reset the counters
+        with m.If(clear):
+            m.d.sync += [c.eq(c.reset) for c in cnt]
+            m.d.sync += lat.eq(0)
+
+        return m
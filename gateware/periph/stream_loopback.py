@@ -0,0 +1,23 @@
+from nmigen import *
+
+from stream import StreamPeriph
+
+class StreamLoopback(StreamPeriph):
+    """ Test peripheral that sends back the packets it receives, a byte at a time, through byte streams """
+    def elaborate(self, platform):
+        m = super().elaborate(platform)
+
+        # A packet with no data is dropped, as a packet to send has at least one byte
+        empty = self.rx.last & (self.rx.nb == 0)
+
+        m.d.comb += [
+            self.tx.data.eq(self.rx.data),
+            self.tx.valid.eq(self.rx.valid & ~empty),
+            self.tx.last.eq(self.rx.last),
+            self.rx.ready.eq(self.tx.ready | empty)
+        ]
+
+        with m.If(self.rx.valid & self.rx.ready):
+            m.d.sync += self.led.eq(self.rx.data)
+
+        return m
@@ -1,11 +1,14 @@
 from nmigen import *
+from nmigen.lib.fifo import SyncFIFOBuffered
 from nmigen_stdio.serial import *
 
 class Uart(Elaboratable):
     """ Uart peripheral using ngigen-stdio """
-    def __init__(self, pkt_size=16):
+    def __init__(self, pkt_size=16, pooled=False, stream=False):
         # Parameters
         self.pkt_size = pkt_size
+        self.pooled   = pooled      # Register with the dispatcher with pooled=True
+        self.stream   = stream      # Register with the dispatcher with stream=True
 
         # Inputs
         self.i_pkt    = Signal(pkt_size * 8)
@@ -13,12 +16,20 @@ class Uart(Elaboratable):
         self.i_ack    = Signal()
         self.i_nb     = Signal(4)
         self.i_flags  = Signal(4)
+        self.i_buf    = Signal(8)   # The pool buffer received, when pooled
+
+        # Stream inputs, when stream is set
+        self.i_start      = Signal()
+        self.i_byte       = Signal(8)
+        self.i_byte_valid = Signal()
+        self.i_end        = Signal()
 
         # Outputs
         self.o_ready  = Signal()
         self.o_valid  = Signal()
         self.o_pkt    = Signal(pkt_size * 8)
         self.o_nb     = Signal(4)
+        self.o_buf    = Signal(8)   # The pool buffer to send, when pooled
 
     def elaborate(self, platform):
         m = Module()
@@ -29,45 +40,172 @@ class Uart(Elaboratable):
 
         m.submodules.ser = ser = AsyncSerial(divisor=divisor, pins=uart)
 
-        i_pkt = Signal(self.pkt_size * 8)
-        i_nb =  Signal(4, reset=0)
+        if self.pooled:
+            self.elaborate_pooled(m, ser)
+            return m
+
+        if self.stream:
+            # When streamed, the bytes to transmit go into a fifo as they arrive, and we are ready
+            # while there is room in it for a whole packet
+            m.submodules.fifo = fifo = SyncFIFOBuffered(width=8, depth=2 * self.pkt_size)
+
+            m.d.comb += [
+                self.o_ready.eq(fifo.level <= self.pkt_size),
+                fifo.w_en.eq(self.i_byte_valid),
+                fifo.w_data.eq(self.i_byte),
+                ser.tx.data.eq(fifo.r_data),
+                ser.tx.ack.eq(fifo.r_rdy),
+                fifo.r_en.eq(ser.tx.rdy)
+            ]
+        else:
+            i_pkt = Signal(self.pkt_size * 8)
+            i_nb =  Signal(4, reset=0)
+
+            # We are ready when there are no bytes to transmit
+            m.d.comb += self.o_ready.eq(i_nb == 0)
+
+            # Consume packet when valid and ready
+            with m.If(self.i_valid & self.o_ready):
+                m.d.sync += [
+                    i_nb.eq(self.i_nb),
+                    i_pkt.eq(self.i_pkt)
+                ]
+
+            # Connect uart
+            m.d.comb += [
+                ser.tx.data.eq(i_pkt.word_select(i_nb -1, 8)),
+                ser.tx.ack.eq(i_nb > 0)
+            ]
+
+            # Move on when byte written
+            with m.If(ser.tx.ack & ser.tx.rdy):
+                m.d.sync += i_nb.eq(i_nb - 1)
+
+        # Allow input when we have no output
+        m.d.comb += ser.rx.ack.eq(~self.o_valid)
+
+        # Output packets are 1 byte
+        m.d.comb += self.o_nb.eq(1)
+
+        # Consume input when ack and rdy
+        with m.If(ser.rx.ack & ser.rx.rdy):
+            m.d.sync += [
+                self.o_valid.eq(1),
+                self.o_pkt[-8:].eq(ser.rx.data)
+            ]
+
+        # Unset o_valid when data acked
+        with m.If(self.i_ack):
+            m.d.sync += self.o_valid.eq(0)
+
+        return m
 
-        # We are ready when there are no bytes to transmit
-        m.d.comb += self.o_ready.eq(i_nb == 0)
+    # When pooled, the bytes to transmit are read from the pool buffer a byte at a time, 
+    # and the buffer released when the last one has been read.
+    # Bytes received are written to a buffer leased in advance, which is then sent.
+    def elaborate_pooled(self, m, ser):
+        pool = self.pool
+
+        i_buf = Signal(8)
+        i_nb  = Signal(5)        # The number of bytes left to read from the pool
+        off   = Signal(4)        # The offset of the next byte to read
+        wait  = Signal()         # Set while a read is waiting for its data
+        byte  = Signal(8)        # The next byte to transmit
+        have  = Signal()         # Set when byte is valid
+
+        # We are ready when all the bytes of the last packet have been read
+        m.d.comb += self.o_ready.eq((i_nb == 0) & ~wait)
 
-        # Consume packet when valid and ready
         with m.If(self.i_valid & self.o_ready):
             m.d.sync += [
+                i_buf.eq(self.i_buf),
                 i_nb.eq(self.i_nb),
-                i_pkt.eq(self.i_pkt)
+                off.eq(0)
+            ]
+            # An empty packet's buffer is released straight away
+            with m.If(self.i_nb == 0):
+                m.d.comb += [
+                    pool.release.eq(1),
+                    pool.release_buf.eq(self.i_buf)
+                ]
+
+        # Read the next byte when the last one has been passed to the uart
+        m.d.comb += [
+            pool.r_req.eq((i_nb > 0) & ~wait & ~have),
+            pool.r_buf.eq(i_buf),
+            pool.r_off.eq(off)
+        ]
+
+        with m.If(pool.r_gnt):
+            m.d.sync += [
+                wait.eq(1),
+                off.eq(off + 1),
+                i_nb.eq(i_nb - 1)
+            ]
+
+        with m.If(pool.r_ack):
+            m.d.sync += [
+                wait.eq(0),
+                have.eq(1),
+                byte.eq(pool.r_data)
             ]
+            with m.If(i_nb == 0):
+                m.d.comb += [
+                    pool.release.eq(1),
+                    pool.release_buf.eq(i_buf)
+                ]
 
         # Connect uart
         m.d.comb += [
-            ser.tx.data.eq(i_pkt.word_select(i_nb -1, 8)),
-            ser.tx.ack.eq(i_nb > 0)
+            ser.tx.data.eq(byte),
+            ser.tx.ack.eq(have)
         ]
 
-        # Move on when byte written
         with m.If(ser.tx.ack & ser.tx.rdy):
-            m.d.sync += i_nb.eq(i_nb - 1)
+            m.d.sync += have.eq(0)
 
-        # Allow input when we have no output
-        m.d.comb += ser.rx.ack.eq(~self.o_valid)
+        # Lease a buffer for the next byte received, when we do not have one
+        o_buf  = Signal(8)
+        leased = Signal()        # Set when o_buf has been leased
+        w_byte = Signal()        # Set while the byte received is being written
+
+        m.d.comb += pool.lease_req.eq(~leased)
+
+        with m.If(pool.lease_ack):
+            m.d.sync += [
+                o_buf.eq(pool.lease_buf),
+                leased.eq(1)
+            ]
+
+        # Allow input when we have a buffer, and no output
+        m.d.comb += ser.rx.ack.eq(leased & ~w_byte & ~self.o_valid)
 
         # Output packets are 1 byte
         m.d.comb += self.o_nb.eq(1)
 
-        # Consume input when ack and rdy
+        rx_data = Signal(8)
         with m.If(ser.rx.ack & ser.rx.rdy):
             m.d.sync += [
-                self.o_valid.eq(1),
-                self.o_pkt[-8:].eq(ser.rx.data)
+                rx_data.eq(ser.rx.data),
+                w_byte.eq(1)
+            ]
+
+        m.d.comb += [
+            pool.w_req.eq(w_byte),
+            pool.w_buf.eq(o_buf),
+            pool.w_off.eq(0),
+            pool.w_data.eq(rx_data)
+        ]
+
+        # When the byte has been written, send the buffer, which the dispatcher releases when it has been sent
+        with m.If(pool.w_ack):
+            m.d.sync += [
+                w_byte.eq(0),
+                leased.eq(0),
+                self.o_buf.eq(o_buf),
+                self.o_valid.eq(1)
             ]
 
         # Unset o_valid when data acked
         with m.If(self.i_ack):
             m.d.sync += self.o_valid.eq(0)
-
-        return m
-
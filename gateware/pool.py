@@ -0,0 +1,129 @@
+from nmigen import *
+
+from arbiter import Arbiter
+
+class PoolPort:
+    """ A client's port on the packet pool """
+    def __init__(self, n_bufs, pkt_size):
+        # Lease a free buffer. lease_ack is set in the cycle that lease_buf is leased.
+        self.lease_req   = Signal()
+        self.lease_ack   = Signal()
+        self.lease_buf   = Signal(range(n_bufs))
+
+        # Release a leased buffer
+        self.release     = Signal()
+        self.release_buf = Signal(range(n_bufs))
+
+        # Write a byte of a buffer. w_ack is set in the cycle that it is written.
+        self.w_req       = Signal()
+        self.w_ack       = Signal()
+        self.w_buf       = Signal(range(n_bufs))
+        self.w_off       = Signal(range(pkt_size))
+        self.w_data      = Signal(8)
+
+        # Read a byte of a buffer. r_gnt is set in the cycle that the read is granted,
+        # and r_ack in the cycle after, with the byte in r_data.
+        self.r_req       = Signal()
+        self.r_gnt       = Signal()
+        self.r_ack       = Signal()
+        self.r_buf       = Signal(range(n_bufs))
+        self.r_off       = Signal(range(pkt_size))
+        self.r_data      = Signal(8)
+
+class PacketPool(Elaboratable):
+    """ Pool of packet buffers in BRAM, handed between the dispatcher and peripherals by index """
+    def __init__(self, n_bufs=16, pkt_size=16):
+        # A buffer address is its index followed by the byte offset,
+        # and peripherals have 8-bit buffer indexes
+        assert pkt_size & (pkt_size - 1) == 0 and n_bufs <= 256
+
+        # Parameters
+        self.n_bufs   = n_bufs
+        self.pkt_size = pkt_size
+
+        # Outputs
+        self.free     = Signal(n_bufs, reset=(1 << n_bufs) - 1) # Bitmap of the free buffers
+
+        # The ports of the clients, the first of which has priority
+        self.ports    = []
+
+    # Add a port for a client
+    def port(self):
+        p = PoolPort(self.n_bufs, self.pkt_size)
+        self.ports.append(p)
+        return p
+
+    def elaborate(self, platform):
+        m = Module()
+
+        n = len(self.ports)
+
+        # Create the memory and its ports
+        mem = Memory(width=8, depth=self.n_bufs * self.pkt_size)
+        m.submodules.w = w = mem.write_port()
+        m.submodules.r = r = mem.read_port(transparent=False)
+
+        # Leases go to the first client that asks for one, and get the lowest numbered free buffer.
+        # Any number of buffers can be released in the same cycle.
+        free_buf = Signal(range(self.n_bufs))
+        for k in reversed(range(self.n_bufs)):
+            with m.If(self.free[k]):
+                m.d.comb += free_buf.eq(k)
+
+        m.submodules.lease_arb = la = Arbiter(n)
+        m.d.comb += la.req.eq(Cat(*[p.lease_req for p in self.ports]))
+
+        leased = Signal(self.n_bufs)
+        with m.If(la.valid & self.free.any()):
+            m.d.comb += leased.eq(1 << free_buf)
+
+        released = Signal(self.n_bufs)
+        for p in self.ports:
+            with m.If(p.release):
+                m.d.comb += released.bit_select(p.release_buf, 1).eq(1)
+
+        m.d.sync += self.free.eq((self.free & ~leased) | released)
+
+        for i, p in enumerate(self.ports):
+            m.d.comb += [
+                p.lease_buf.eq(free_buf),
+                p.lease_ack.eq(la.valid & self.free.any() & (la.grant == i))
+            ]
+
+        # Writes go to the first client that asks, which for the dispatcher is always granted,
+        # as bytes have to be written as they are received
+        m.submodules.w_arb = wa = Arbiter(n)
+        m.d.comb += [
+            wa.req.eq(Cat(*[p.w_req for p in self.ports])),
+            w.en.eq(wa.valid)
+        ]
+
+        with m.Switch(wa.grant):
+            for i, p in enumerate(self.ports):
+                with m.Case(i):
+                    m.d.comb += [
+                        w.addr.eq(Cat(p.w_off, p.w_buf)),
+                        w.data.eq(p.w_data),
+                        p.w_ack.eq(wa.valid)
+                    ]
+
+        # Reads are shared in turn by the clients that ask
+        m.submodules.r_arb = ra = Arbiter(n, "round_robin")
+        m.d.comb += [
+            ra.req.eq(Cat(*[p.r_req for p in self.ports])),
+            ra.next.eq(ra.valid)
+        ]
+
+        with m.Switch(ra.grant):
+            for i, p in enumerate(self.ports):
+                with m.Case(i):
+                    m.d.comb += [
+                        r.addr.eq(Cat(p.r_off, p.r_buf)),
+                        p.r_gnt.eq(ra.valid)
+                    ]
+
+        for p in self.ports:
+            m.d.sync += p.r_ack.eq(p.r_gnt)
+            m.d.comb += p.r_data.eq(r.data)
+
+        return m
@@ -0,0 +1,14 @@
+from nmigen import *
+
+# CRC-8 (polynomial 0x07) and CRC-16/CCITT (polynomial 0x1021, starting from 0xFFFF), most significant bit first,
+# with no final xor, so that the CRC of a message followed by its own CRC is 0
+CRC_POLY = {8: 0x07, 16: 0x1021}
+CRC_INIT = {8: 0x00, 16: 0xFFFF}
+
+def crc_next(crc, data, poly):
+    """ The CRC after shifting in the bits of data, most significant bit first """
+    width = len(crc)
+    for k in reversed(range(len(data))):
+        fb  = crc[-1] ^ data[k]
+        crc = Cat(C(0, 1), crc[:-1]) ^ Mux(fb, C(poly, width), C(0, width))
+    return crc
@@ -0,0 +1,59 @@
+from nmigen import *
+
+class QspiDdrIo(Elaboratable):
+    """ The qd pins, launching data on both edges of sclk, with iCE40 SB_IO DDR cells, or a model of them """
+    def __init__(self, qw=4, pins=None):
+        # Parameters
+        self.qw   = qw
+        self.pins = pins            # The qd pins, requested with dir="-", or None for the model
+
+        # Inputs
+        self.sclk = Signal()
+        self.o    = Signal(qw)      # Launched on the next rising edge of sclk
+        self.o_n  = Signal(qw)      # Launched on the next falling edge of sclk
+        self.oe   = Signal()        # Output enable, which is not registered
+
+        # Outputs
+        self.i    = Signal(qw)      # The value on the pins, which is not registered
+
+        # The pins, for the model
+        self.pin_i = Signal(qw)     # The value driven by the STM32
+        self.pin_o = Signal(qw)     # The value driven by the ice40, when oe is set
+
+    def elaborate(self, platform):
+        m = Module()
+
+        if self.pins is not None:
+            # PIN_OUTPUT_DDR_ENABLE and PIN_INPUT
+            for k, pin in enumerate(self.pins):
+                m.submodules["qd_" + str(k)] = Instance("SB_IO",
+                    p_PIN_TYPE      = C(0b100001, 6),
+                    p_IO_STANDARD   = "SB_LBCMOS",
+                    io_PACKAGE_PIN  = pin.io,
+                    i_OUTPUT_CLK    = self.sclk,
+                    i_OUTPUT_ENABLE = self.oe,
+                    i_D_OUT_0       = self.o[k],
+                    i_D_OUT_1       = self.o_n[k],
+                    o_D_IN_0        = self.i[k])
+            return m
+
+        # The model registers o on the rising edge and o_n on the falling edge,
+        # and drives the pins from whichever was registered last
+        m.domains.ddr_p = ClockDomain("ddr_p", reset_less=True, local=True)
+        m.domains.ddr_n = ClockDomain("ddr_n", clk_edge="neg", reset_less=True, local=True)
+        m.d.comb += [
+            ClockSignal("ddr_p").eq(self.sclk),
+            ClockSignal("ddr_n").eq(self.sclk)
+        ]
+
+        o_p = Signal(self.qw)
+        o_n = Signal(self.qw)
+        m.d.ddr_p += o_p.eq(self.o)
+        m.d.ddr_n += o_n.eq(self.o_n)
+
+        m.d.comb += [
+            self.pin_o.eq(Mux(self.sclk, o_p, o_n)),
+            self.i.eq(Mux(self.oe, self.pin_o, self.pin_i))
+        ]
+
+        return m
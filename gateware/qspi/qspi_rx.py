@@ -3,14 +3,20 @@ from nmigen.utils import bits_for
 
 from nmigen.hdl.ast import Rose, Fell
 
+from qspi.crc import CRC_POLY, CRC_INIT, crc_next
+
 import math
 
 class QspiRx(Elaboratable):
     """ QSPI Slave Receive data """
-    def __init__(self, pkt_size=16, qw=4):
+    def __init__(self, pkt_size=16, qw=4, crc=0):
+        # A chunk of qw bits is shifted in per sclk cycle, so a byte takes 8, 4, 2 or 1 cycles
+        assert qw in (1, 2, 4, 8) and crc in (0, 8, 16)
+
         # Parameters
         self.pkt_size = pkt_size
-        self.qw       = 4
+        self.qw       = qw
+        self.crc_bits = crc         # The width of the CRC, or 0 for none
 
         # QSPI pins
         self.csn  = Signal()
@@ -18,27 +24,39 @@ class QspiRx(Elaboratable):
         self.qd   = Signal(qw)
 
         # Outputs
-        self.pkt   = Signal(self.pkt_size * 8)
-        self.nb    = Signal(5)
+        chunk_bits = int(math.log2(8 // qw))
+        self.pkt        = Signal(self.pkt_size * 8)
+        self.nb         = Signal(bits_for(self.pkt_size * (8 // qw)) - chunk_bits)
+        self.byte_valid = Signal()  # Strobe set when a complete byte has been shifted into pkt
+        # The CRC of the chunks received, which is 0 when they end with their own CRC
+        self.crc        = Signal(max(crc, 1), reset=CRC_INIT.get(crc, 0))
 
     def elaborate(self, platform):
         m = Module()
 
         chunks = Signal(bits_for(self.pkt_size * (8 // self.qw)))
+        chunk_bits = int(math.log2(8 // self.qw))
+
+        m.d.sync += self.byte_valid.eq(0)
         
         with m.If(self.csn):
             m.d.sync += [
                 chunks.eq(0),
-                self.pkt.eq(0)
+                self.pkt.eq(0),
+                self.crc.eq(self.crc.reset)
             ]
         with m.Else():
             with m.If(Rose(self.sclk)):
                 m.d.sync += [
                     self.pkt.eq(Cat(self.qd, self.pkt[:-self.qw])),
-                    chunks.eq(chunks+1)
+                    chunks.eq(chunks+1),
+                    # The last chunk of a byte completes it, and with qw=8 every chunk does
+                    self.byte_valid.eq(chunks[:chunk_bits].all())
                 ]
+                # The CRC is updated a chunk at a time, at line rate
+                if self.crc_bits:
+                    m.d.sync += self.crc.eq(crc_next(self.crc, self.qd, CRC_POLY[self.crc_bits]))
 
-        m.d.comb += self.nb.eq(chunks[int(math.log2(8 // self.qw)):])
+        m.d.comb += self.nb.eq(chunks[chunk_bits:])
 
         return m
-
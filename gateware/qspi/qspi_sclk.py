@@ -0,0 +1,297 @@
+from nmigen import *
+from nmigen.utils import bits_for
+
+from nmigen.lib.cdc import FFSynchronizer
+from nmigen.lib.fifo import AsyncFIFO
+
+from qspi.crc import CRC_POLY, CRC_INIT, crc_next
+
+import math
+
+# Source-synchronous versions of QspiRx and QspiTx. The qd pins are sampled and driven by registers
+# clocked by sclk itself, rather than by the sync domain looking for its edges, so sclk is not limited
+# to a fraction of the sync clock. Both modules are held in reset by csn, asynchronously.
+# The registers with an async reset are set with Mux rather than If, as yosys only sees
+# the reset when it is the only condition in their process.
+# With ddr, the data moves a chunk on each edge of sclk, except for the command byte,
+# which the STM32 QUADSPI always sends at single data rate.
+
+class QspiRxSclk(Elaboratable):
+    """ QSPI Slave Receive data, captured on the rising edge of sclk """
+    def __init__(self, pkt_size=16, qw=4, fifo_depth=8, ddr=False, crc=0):
+        # A byte takes at least a whole cycle with ddr
+        assert qw in (1, 2, 4, 8) and (not ddr or qw <= 4) and crc in (0, 8, 16)
+
+        # Parameters
+        self.pkt_size   = pkt_size
+        self.qw         = qw
+        self.fifo_depth = fifo_depth
+        self.ddr        = ddr
+        self.crc_bits   = crc
+
+        # QSPI pins
+        self.csn  = Signal()
+        self.sclk = Signal()
+        self.qd   = Signal(qw)
+
+        # Outputs, in the sync domain, the same as for QspiRx
+        chunk_bits = int(math.log2(8 // qw))
+        self.pkt        = Signal(self.pkt_size * 8)
+        self.nb         = Signal(bits_for(self.pkt_size * (8 // qw)) - chunk_bits)
+        self.byte_valid = Signal()  # Strobe set when a complete byte has been shifted into pkt
+        self.sync_csn   = Signal(reset=1) # csn as seen by the sync domain, which goes high once all
+                                          # the bytes of the transaction have been shifted into pkt
+        # The CRC of the bytes received, which is 0 when they end with their own CRC
+        self.crc        = Signal(max(crc, 1), reset=CRC_INIT.get(crc, 0))
+
+    def elaborate(self, platform):
+        m = Module()
+
+        qw     = self.qw
+        chunks = 8 // qw
+
+        # The capture registers are reset by csn, but the write side of the fifo must not be,
+        # or the last bytes of a transaction would be lost when csn goes high.
+        # With ddr, bytes are written on the falling edge.
+        edge = "neg" if self.ddr else "pos"
+        m.domains.qspi_rx   = ClockDomain("qspi_rx", async_reset=True, local=True)
+        m.domains.qspi_rx_n = ClockDomain("qspi_rx_n", clk_edge="neg", async_reset=True, local=True)
+        m.domains.qspi_w    = ClockDomain("qspi_w", clk_edge=edge, reset_less=True, local=True)
+        m.d.comb += [
+            ClockSignal("qspi_rx").eq(self.sclk),
+            ResetSignal("qspi_rx").eq(self.csn),
+            ClockSignal("qspi_rx_n").eq(self.sclk),
+            ResetSignal("qspi_rx_n").eq(self.csn),
+            ClockSignal("qspi_w").eq(self.sclk)
+        ]
+
+        m.submodules.fifo = fifo = AsyncFIFO(width=8, depth=self.fifo_depth, r_domain="sync", w_domain="qspi_w")
+
+        shift = Signal(8 - qw)      # The chunks of the current byte received so far
+        chunk = Signal(range(chunks))
+
+        if not self.ddr:
+            m.d.qspi_rx += [
+                shift.eq(Cat(self.qd, shift)[:8 - qw]),
+                chunk.eq(Mux(chunk == chunks - 1, 0, chunk + 1))
+            ]
+
+            # The last chunk of a byte completes it, and with qw=8 every chunk does
+            m.d.comb += [
+                fifo.w_en.eq(chunk == chunks - 1),
+                fifo.w_data.eq(Cat(self.qd, shift))
+            ]
+        else:
+            # The command byte is shifted in on rising edges, and written on the falling edge after its last chunk
+            cmd   = Signal(8)
+            n_cmd = Signal(range(chunks + 1))
+            rise  = Signal(qw)      # The chunk sampled on the last rising edge
+            m.d.qspi_rx += [
+                cmd.eq(Mux(n_cmd != chunks, Cat(self.qd, cmd[:-qw]), cmd)),
+                n_cmd.eq(Mux(n_cmd != chunks, n_cmd + 1, n_cmd)),
+                rise.eq(self.qd)
+            ]
+
+            # After that, each falling edge completes a pair of chunks, and the last pair completes a byte
+            pairs  = chunks // 2
+            done   = Signal()       # Set when the command byte has been written
+            pair   = Cat(self.qd, rise)
+            shift  = Signal(8 - 2 * qw)
+            n_pair = Signal(range(pairs))
+            m.d.qspi_rx_n += [
+                done.eq(done | (n_cmd == chunks)),
+                shift.eq(Mux(done, Cat(pair, shift)[:8 - 2 * qw], shift)),
+                n_pair.eq(Mux(done, Mux(n_pair == pairs - 1, 0, n_pair + 1), n_pair))
+            ]
+
+            first = ~done & (n_cmd == chunks)
+            m.d.comb += [
+                fifo.w_en.eq(first | (done & (n_pair == pairs - 1))),
+                fifo.w_data.eq(Mux(first, cmd, Cat(pair, shift)))
+            ]
+
+        # A transaction starts when csn is seen low, or when a byte arrives, and the bytes are read from
+        # the fifo from the cycle after. It is over when csn has been seen high, and all its bytes have been read.
+        # As csn goes through one more stage than the fifo pointers, they have been written by then.
+        # The first byte of the next transaction can arrive before csn is seen low, and then csn is not
+        # looked at again until it has been.
+        csn    = Signal(reset=1)
+        m.submodules += FFSynchronizer(i=self.csn, o=csn, reset=1, stages=3)
+
+        active = Signal()           # Set during a transaction
+        fresh  = Signal()           # Set when a transaction started before csn was seen low
+
+        m.d.comb += fifo.r_en.eq(active)
+        m.d.sync += self.byte_valid.eq(0)
+
+        with m.If(~active):
+            m.d.sync += [
+                self.pkt.eq(0),
+                self.nb.eq(0),
+                self.crc.eq(self.crc.reset),
+                active.eq(~csn | fifo.r_rdy),
+                fresh.eq(csn)
+            ]
+        with m.Else():
+            with m.If(fifo.r_rdy):
+                m.d.sync += [
+                    self.pkt.eq(Cat(fifo.r_data, self.pkt[:-8])),
+                    self.nb.eq(self.nb + 1),
+                    self.byte_valid.eq(1)
+                ]
+                # The CRC is updated a byte at a time, as they are read from the fifo
+                if self.crc_bits:
+                    m.d.sync += self.crc.eq(crc_next(self.crc, fifo.r_data, CRC_POLY[self.crc_bits]))
+            with m.If(~csn):
+                m.d.sync += fresh.eq(0)
+            with m.Elif(~fresh & ~fifo.r_rdy):
+                m.d.sync += active.eq(0)
+
+        m.d.comb += self.sync_csn.eq(~active)
+
+        return m
+
+class QspiTxSclk(Elaboratable):
+    """ QSPI Slave Send data, launched on the falling edge of sclk """
+    def __init__(self, sizes, cmds, skip=2, qw=4, ddr=False, crc=0):
+        assert qw in (1, 2, 4, 8) and (not ddr or qw <= 4) and crc in (0, 8, 16)
+
+        # Parameters
+        self.sizes = sizes          # The size in bytes of each packet that can be sent
+        self.cmds  = cmds           # The command byte that selects each packet
+        self.skip  = skip           # The number of bytes before the data: the command and a dummy byte
+        self.qw    = qw
+        self.ddr   = ddr
+        self.crc_bits = crc         # The width of the CRC sent after the data, or 0 for none
+
+        # QSPI pins. With ddr, qd is launched by a DDR output cell on the next rising edge,
+        # and qd_n on the next falling edge, and otherwise qd is driven as it is.
+        self.csn  = Signal()
+        self.sclk = Signal()
+        self.qd_i = Signal(qw)      # Used to see the command
+        self.qd   = Signal(qw)
+        self.qd_n = Signal(qw)
+        self.oe   = Signal()
+
+        # Inputs, in the sync domain, and the number of bytes of each packet sent before the CRC
+        self.pkts = [Signal(n * 8, name="pkt_" + str(k)) for k, n in enumerate(sizes)]
+        self.nbs  = [Signal(range(n + 1), name="nb_" + str(k)) for k, n in enumerate(sizes)]
+
+    def elaborate(self, platform):
+        m = Module()
+
+        qw     = self.qw
+        chunks = 8 // qw
+        width  = max(self.sizes) * 8
+
+        m.domains.qspi_tx   = ClockDomain("qspi_tx", async_reset=True, local=True)
+        m.domains.qspi_tx_n = ClockDomain("qspi_tx_n", clk_edge="neg", async_reset=True, local=True)
+        m.d.comb += [
+            ClockSignal("qspi_tx").eq(self.sclk),
+            ResetSignal("qspi_tx").eq(self.csn),
+            ClockSignal("qspi_tx_n").eq(self.sclk),
+            ResetSignal("qspi_tx_n").eq(self.csn)
+        ]
+
+        # The packets are copied in the sync domain while csn is high, and held during a transaction.
+        # The sync domain sees csn go low long before the data starts, after the command and dummy byte.
+        csn = Signal(reset=1)
+        m.submodules += FFSynchronizer(i=self.csn, o=csn, reset=1)
+
+        held    = []
+        held_nb = []
+        for k, pkt in enumerate(self.pkts):
+            h  = Signal(width, name="held_" + str(k))
+            hn = Signal(range(max(self.sizes) + 1), name="held_nb_" + str(k))
+            with m.If(csn):
+                m.d.sync += [
+                    h.eq(pkt << (width - len(pkt))),
+                    hn.eq(self.nbs[k])
+                ]
+            held.append(h)
+            held_nb.append(hn)
+
+        # The command is shifted in on the rising edges of its first byte
+        cmd  = Signal(8)
+        n_in = Signal(range(chunks + 1))
+        m.d.qspi_tx += [
+            cmd.eq(Mux(n_in != chunks, Cat(self.qd_i, cmd[:-qw]), cmd)),
+            n_in.eq(Mux(n_in != chunks, n_in + 1, n_in))
+        ]
+
+        # The packet the command reads, if it is a read
+        is_read = Signal()
+        pkt     = Signal(width)
+        nb      = Signal(range(max(self.sizes) + 1))
+        for c, h, hn in zip(self.cmds, held, held_nb):
+            with m.If(cmd == c):
+                m.d.comb += [
+                    is_read.eq(1),
+                    pkt.eq(h),
+                    nb.eq(hn)
+                ]
+
+        # qd is driven from the falling edge after the command
+        n_oe = Signal(range(chunks))
+        m.d.qspi_tx_n += [
+            n_oe.eq(Mux(n_oe != chunks - 1, n_oe + 1, n_oe)),
+            self.oe.eq(self.oe | ((n_oe == chunks - 1) & is_read))
+        ]
+
+        shift = Signal(width)
+
+        # With a CRC, it is updated with the chunks as they are sent, and sent in place of the data
+        # after nb bytes. n_sent counts the steps of the shift, of one chunk, or two with ddr.
+        crc_bits = self.crc_bits
+        step     = 2 if self.ddr else 1
+        steps    = nb * (chunks // step)
+        crc      = Signal(max(crc_bits, 1), reset=CRC_INIT.get(crc_bits, 0))
+        n_sent   = Signal(range(max(self.sizes) * chunks + 1))
+        poly     = CRC_POLY.get(crc_bits, 0)
+
+        if not self.ddr:
+            # Counting falling edges, the first chunk of data is launched on the one after
+            # the dummy byte, to be sampled by the STM32 on the next rising edge
+            last  = self.skip * chunks
+            n_out = Signal(range(last + 1))
+            going = n_out == last
+            nxt   = Cat(C(0, qw), shift[:-qw])
+            if crc_bits:
+                crc_n = crc_next(crc, shift[-qw:], poly)
+                nxt   = Mux(n_sent == steps - 1, Cat(C(0, width - crc_bits), crc_n), nxt)
+                m.d.qspi_tx_n += [
+                    crc.eq(Mux(going, crc_n, crc)),
+                    n_sent.eq(Mux(going & (n_sent != steps), n_sent + 1, n_sent))
+                ]
+
+            m.d.qspi_tx_n += [
+                n_out.eq(Mux(n_out != last, n_out + 1, n_out)),
+                shift.eq(Mux(n_out == last - 1, pkt, Mux(going, nxt, shift)))
+            ]
+
+            m.d.comb += self.qd.eq(shift[-qw:])
+        else:
+            # Counting rising edges, from the one before the first chunk of data is sampled, 
+            # the next two chunks are set up on each one, the first to be launched on the falling edge 
+            # after it, and the second on the next rising edge. The dummy bytes are at double data rate.
+            first = chunks + (self.skip - 1) * chunks // 2 - 1
+            n_out = Signal(range(first + 2))
+            cur   = shift
+            if crc_bits:
+                cur = Mux(n_sent == steps, Cat(C(0, width - crc_bits), crc), cur)
+            cur   = Mux(n_out == first, pkt, cur)
+            go    = n_out >= first
+            if crc_bits:
+                m.d.qspi_tx += [
+                    crc.eq(Mux(go, crc_next(crc, cur[-2 * qw:], poly), crc)),
+                    n_sent.eq(Mux(go & (n_sent != steps), n_sent + 1, n_sent))
+                ]
+
+            m.d.qspi_tx += [
+                n_out.eq(Mux(n_out != first + 1, n_out + 1, n_out)),
+                self.qd_n.eq(Mux(go, cur[-qw:], 0)),
+                self.qd.eq(Mux(go, cur[-2 * qw:-qw], 0)),
+                shift.eq(Mux(go, Cat(C(0, 2 * qw), cur[:-2 * qw]), shift))
+            ]
+
+        return m
@@ -3,11 +3,16 @@ from nmigen.utils import bits_for
 
 from nmigen.hdl.ast import Rose, Fell
 
+from qspi.crc import CRC_POLY, CRC_INIT, crc_next
+
 class QspiTx(Elaboratable):
-    def __init__(self, pkt_size=16, qw=4):
+    def __init__(self, pkt_size=16, qw=4, crc=0):
+        assert crc in (0, 8, 16)
+
         # Parameters
         self.pkt_size = pkt_size
         self.qw       = qw
+        self.crc_bits = crc         # The width of the CRC sent after the data, or 0 for none
 
         # QSPI pins
         self.csn  = Signal()
@@ -16,19 +21,39 @@ class QspiTx(Elaboratable):
 
         # Inputs
         self.pkt   = Signal(self.pkt_size * 8)
+        self.nb    = Signal(range(self.pkt_size + 1)) # The number of bytes of pkt sent before the CRC
 
     def elaborate(self, platform):
         m = Module()
 
         shift_reg = Signal(self.pkt_size * 8)
 
-        with m.If(self.csn):
-            m.d.sync += shift_reg.eq(self.pkt)
+        # The CRC of the chunks sent so far, and the number of chunks sent
+        chunks = 8 // self.qw
+        crc    = Signal(max(self.crc_bits, 1), reset=CRC_INIT.get(self.crc_bits, 0))
+        n_sent = Signal(range(self.pkt_size * chunks + 1))
+
+        # Load the packet while csn is high, and on the cycle it goes low, in case the
+        # packet changed on the same cycle that the transaction started
+        with m.If(self.csn | Fell(self.csn)):
+            m.d.sync += [
+                shift_reg.eq(self.pkt),
+                crc.eq(crc.reset),
+                n_sent.eq(0)
+            ]
         with m.Else():
             with m.If(Fell(self.sclk)):
                 m.d.sync += shift_reg.eq(Cat(C(0,self.qw), shift_reg[:-self.qw]))
+                # With a CRC, it is updated with each chunk as it is sent, and takes the place
+                # of the data after nb bytes
+                if self.crc_bits:
+                    crc_n = crc_next(crc, shift_reg[-self.qw:], CRC_POLY[self.crc_bits])
+                    m.d.sync += crc.eq(crc_n)
+                    with m.If(n_sent != self.nb * chunks):
+                        m.d.sync += n_sent.eq(n_sent + 1)
+                    with m.If(n_sent == self.nb * chunks - 1):
+                        m.d.sync += shift_reg[-self.crc_bits:].eq(crc_n)
 
         m.d.comb += self.qd.eq(shift_reg[-self.qw:]),
 
         return m
-
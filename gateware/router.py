@@ -0,0 +1,113 @@
+from nmigen import *
+
+from arbiter import Arbiter
+
+class Router(Elaboratable):
+    """ Peripheral that routes packets to and from its own sub-peripherals """
+    def __init__(self, pkt_size=16, num_periphs=16, arbiter="priority"):
+        assert num_periphs <= 256
+
+        # Parameters
+        self.pkt_size    = pkt_size
+        self.num_periphs = num_periphs
+        self.arbiter     = arbiter                 # priority, round_robin or weighted
+
+        # Inputs
+        self.i_pkt    = Signal(self.pkt_size * 8)
+        self.i_valid  = Signal()
+        self.i_ack    = Signal()
+        self.i_nb     = Signal(4)
+        self.i_flags  = Signal(4)
+
+        # Outputs
+        self.o_ready  = Signal()
+        self.o_valid  = Signal()
+        self.o_pkt    = Signal(pkt_size * 8)
+        self.o_nb     = Signal(5)
+
+        self.led      = Signal(8)
+
+        # Peripherals
+        self.periph    = [None] * num_periphs # Contains all sub-peripherals
+        self.rx_periph = [None] * num_periphs # Contains only sub-peripheral that receive data from STM32
+        self.tx_periph = [None] * num_periphs # Contains only sub-peripherals that send data  to STM32
+        self.weight    = [1] * num_periphs    # The weight of each tx sub-peripheral for the weighted arbiter
+
+    # Register a sub-peripheral with a specified id, and say whether it receives or sends data, or both,
+    # in the same way as for the dispatcher
+    def register(self, i, mod, rx, tx, weight=1):
+        self.periph[i] = mod
+        if (rx):
+            self.rx_periph[i] = mod
+        if (tx):
+            self.tx_periph[i] = mod
+            self.weight[i] = weight
+
+    # Elaboration
+    def elaborate(self, platform):
+
+        m = Module()
+
+        # Add the registered sub-peripherals
+        for p in self.periph:
+            if p is not None:
+                m.submodules += p
+
+        if self.periph[0] is not None:
+            m.d.comb += self.led.eq(self.periph[0].led)
+
+        # The first byte of the data of a received packet is the sub-peripheral id.
+        # The packet is passed on with one byte less, so the id takes the place of the header,
+        # and packets for sub-peripherals that are not registered are dropped.
+        sub = Signal(8)
+        m.d.comb += [
+            sub.eq(self.i_pkt.bit_select((self.i_nb << 3) - 8, 8)),
+            self.o_ready.eq(1)
+        ]
+
+        for i in range(self.num_periphs):
+            p = self.rx_periph[i]
+            if p is not None:
+                m.d.comb += [
+                    p.i_valid.eq(self.i_valid & (self.i_nb != 0) & (sub == i)),
+                    p.i_pkt.eq(self.i_pkt),
+                    p.i_nb.eq(self.i_nb - 1),
+                    p.i_flags.eq(self.i_flags)
+                ]
+                with m.If((self.i_nb != 0) & (sub == i)):
+                    m.d.comb += self.o_ready.eq(p.o_ready)
+
+        # The arbiter chooses which tx sub-peripheral goes next. It is held in cur
+        # until its packet has been acked, so the packet does not change while it is offered.
+        # The packet is sent with the sub-peripheral id as the first byte of its data,
+        # so tx sub-peripherals can send up to pkt_size - 1 bytes.
+        m.submodules.arb = arb = Arbiter(self.num_periphs, self.arbiter, self.weight)
+        m.d.comb += arb.req.eq(Cat(*[p.o_valid if p is not None else 0 for p in self.tx_periph]))
+
+        cur  = Signal(range(self.num_periphs))
+        busy = Signal()
+
+        with m.If(~busy & arb.valid):
+            m.d.comb += arb.next.eq(1)
+            m.d.sync += [
+                cur.eq(arb.grant),
+                busy.eq(1)
+            ]
+
+        with m.If(self.i_ack):
+            m.d.sync += busy.eq(0)
+
+        m.d.comb += self.o_valid.eq(busy)
+
+        with m.Switch(cur):
+            for i in range(self.num_periphs):
+                p = self.tx_periph[i]
+                if p is not None:
+                    with m.Case(i):
+                        m.d.comb += [
+                            self.o_pkt.eq(Cat(p.o_pkt[8:], C(i, 8))),
+                            self.o_nb.eq(p.o_nb + 1),
+                            p.i_ack.eq(self.i_ack)
+                        ]
+
+        return m
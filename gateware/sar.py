@@ -0,0 +1,105 @@
+from nmigen import *
+
+from stream import ByteStream
+
+# Segmentation and reassembly (SAR) of messages of any length, over consecutive packets to or from a peripheral.
+# Packets written by the STM32 are marked with these bits of the flags nibble, and the other two bits are the
+# message's own. The packets a peripheral sends have no flags, so each one ends with a trailer byte which has them.
+# A message of one packet is marked as both first and last.
+SAR_FIRST = 1
+SAR_LAST  = 2
+
+class Reassembler(Elaboratable):
+    """
+    Reassembles the messages in a stream of received packets, such as StreamPeriph.rx, by their SAR flags, into
+    a stream of messages, with last set on the last byte of each. An empty message is a single byte with last set
+    and nb 0. Nothing is buffered. o_error is a strobe when a packet starts a message in the middle of one, or
+    continues one when there is none.
+    """
+    def __init__(self):
+        # Inputs
+        self.inp     = ByteStream()
+
+        # Outputs
+        self.out     = ByteStream()
+        self.o_error = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        first  = self.inp.flags[0]
+        final  = self.inp.flags[1]
+        in_msg = Signal()               # Set between the first and the last packet of a message
+        mid    = Signal()               # Set between the first and the last byte of a packet
+
+        # Packets with no data are dropped, except a message with none
+        drop   = self.inp.last & (self.inp.nb == 0) & ~(first & final)
+
+        m.d.comb += [
+            self.out.data.eq(self.inp.data),
+            self.out.valid.eq(self.inp.valid & ~drop),
+            self.out.last.eq(self.inp.last & final),
+            self.out.flags.eq(self.inp.flags),
+            self.out.nb.eq(self.inp.nb),
+            self.inp.ready.eq(self.out.ready | drop)
+        ]
+
+        with m.If(self.inp.valid & self.inp.ready):
+            m.d.sync += mid.eq(~self.inp.last)
+            with m.If(~mid):
+                m.d.comb += self.o_error.eq(first == in_msg)
+            with m.If(self.inp.last):
+                m.d.sync += in_msg.eq(~final)
+
+        return m
+
+class Segmenter(Elaboratable):
+    """
+    Splits a stream of messages, with last set on the last byte of each, into a stream of packets of up to
+    pkt_size bytes to send, such as StreamPeriph.tx. Each packet is a segment of up to pkt_size - 1 bytes of the
+    message, followed by a trailer byte with its SAR flags, which is only known once the segment has ended, so
+    nothing is buffered. A message must have at least one byte.
+    """
+    def __init__(self, pkt_size=16):
+        # Parameters
+        self.pkt_size = pkt_size
+
+        # Inputs
+        self.inp      = ByteStream()
+
+        # Outputs
+        self.out      = ByteStream()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        count   = Signal(range(self.pkt_size))
+        first   = Signal(reset=1)       # Set until the first segment of a message has been sent
+        trailer = Signal()              # Set when the trailer is to be sent
+        flags   = Signal(4)
+
+        with m.If(trailer):
+            m.d.comb += [
+                self.out.data.eq(flags),
+                self.out.valid.eq(1),
+                self.out.last.eq(1)
+            ]
+            with m.If(self.out.ready):
+                m.d.sync += trailer.eq(0)
+        with m.Else():
+            m.d.comb += [
+                self.out.data.eq(self.inp.data),
+                self.out.valid.eq(self.inp.valid),
+                self.inp.ready.eq(self.out.ready)
+            ]
+            with m.If(self.inp.valid & self.inp.ready):
+                m.d.sync += count.eq(count + 1)
+                with m.If(self.inp.last | (count == self.pkt_size - 2)):
+                    m.d.sync += [
+                        trailer.eq(1),
+                        count.eq(0),
+                        flags.eq(Cat(first, self.inp.last)),
+                        first.eq(self.inp.last)
+                    ]
+
+        return m
@@ -0,0 +1,80 @@
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from nmigen import *
+from nmigen.back import rtlil
+
+from dispatcher import Dispatcher
+from router import Router
+from periph.loopback import Loopback
+
+# Report how the dispatcher scales with the number of endpoints, with a flat dispatcher,
+# using extended addressing above 15 endpoints, and with routers of 16 endpoints each.
+# Every endpoint is a loopback peripheral.
+# Run from the gateware directory with: python scaling.py [endpoints ...]
+# Synthesis for ice40 uses yosys, or yowasp-yosys, and is skipped if neither is installed.
+
+def flat(n):
+    if n > 240:
+        return None
+    d = Dispatcher(num_periphs=max(n, 15), ext_addr=n > 15)
+    for i in range(n):
+        d.register(i, Loopback(), True, True)
+    return d
+
+def hierarchical(n):
+    routers = (n + 15) // 16
+    d = Dispatcher(num_periphs=max(routers, 15), ext_addr=routers > 15)
+    for r in range(routers):
+        router = Router(num_periphs=min(16, n - r * 16))
+        for i in range(router.num_periphs):
+            router.register(i, Loopback(pkt_size=16), True, True)
+        d.register(r, router, True, True)
+    return d
+
+def elaborate(d):
+    start = time.time()
+    il = rtlil.convert(d, ports=[d.csn, d.sclk, d.qd_i, d.qd_o, d.qd_oe, d.qdir])
+    return il, time.time() - start
+
+def synthesize(il):
+    yosys = shutil.which("yosys") or shutil.which("yowasp-yosys")
+    if yosys is None:
+        return None
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(os.path.join(tmp, "top.il"), "w") as f:
+            f.write(il)
+        start = time.time()
+        out = subprocess.run([yosys, "-q", "-p", "read_rtlil top.il; synth_ice40 -top top; tee -o stat.txt stat"],
+                             cwd=tmp, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        if out.returncode != 0:
+            return None
+        with open(os.path.join(tmp, "stat.txt")) as f:
+            stat = f.read()
+    def count(cell):
+        return sum(int(c) for c in re.findall(r"^\s+(\d+)\s+" + cell + r"\w*\s*$", stat, re.M) +
+                                   re.findall(r"^\s+" + cell + r"\w*\s+(\d+)\s*$", stat, re.M))
+    return count("SB_LUT4"), count("SB_DFF"), time.time() - start
+
+if __name__ == "__main__":
+    sizes = [int(a) for a in sys.argv[1:]] or [15, 64, 240, 256]
+
+    print("{:>9} {:>12} {:>10} {:>8} {:>8} {:>10}".format(
+          "endpoints", "scheme", "elab (s)", "LUT4s", "DFFs", "synth (s)"))
+    for n in sizes:
+        for name, build in (("flat", flat), ("hierarchical", hierarchical)):
+            d = build(n)
+            if d is None:
+                print("{:>9} {:>12} {:>10}".format(n, name, "-"))
+                continue
+            il, elab = elaborate(d)
+            syn = synthesize(il)
+            if syn is None:
+                print("{:>9} {:>12} {:>10.2f}".format(n, name, elab))
+            else:
+                print("{:>9} {:>12} {:>10.2f} {:>8} {:>8} {:>10.1f}".format(n, name, elab, *syn))
@@ -0,0 +1,211 @@
+import argparse
+import json
+import math
+import sys
+from collections import deque
+
+from nmigen.sim import *
+
+from dispatcher import Dispatcher
+from periph.led import Led
+from periph.hello_tx import HelloTx
+from periph.bram_periph import BramPeriph
+from periph.loopback import Loopback
+from sim.qspi_host import QspiHost, simulator
+
+# Benchmark the protocol in simulation, with a mix of peripherals and the host sending them as much traffic as it can.
+# For each packet size, report the payload bytes per SCLK cycle and the transactions per payload byte, in all
+# and for packets written by the host (rx) and read by it (tx), and the p50 and p99 latency, in system clock
+# cycles, in each direction.
+# Latency is from the host starting a write to the peripheral taking the packet, and from a peripheral
+# setting o_valid to the host having read the packet.
+# Run from the gateware directory with, for example:
+#   python -m sim.bench --periphs led,loopback,bram,hello --sizes 1,8,13 --pkts 20 --out bench.json
+#   python -m sim.bench --dispatcher '{"credits": true, "rx_fifo_depth": 2}'
+
+# The peripherals, and whether they are rx and tx. The BRAM is kept small, as the simulator
+# compiles reads of a large memory into code that is too deeply nested for Python.
+PERIPHS = {
+    "led"      : (Led,                                     True,  False),
+    "loopback" : (Loopback,                                True,  True),
+    "bram"     : (lambda: BramPeriph(depth=256),           True,  True),
+    "bram32"   : (lambda: BramPeriph(depth=256, width=32), True,  True),
+    "hello"    : (HelloTx,                                 False, True)
+}
+
+class BenchHost(QspiHost):
+    """
+    A QspiHost that counts the transactions and SCLK cycles of each direction: those of writes, including the
+    OK-TO-SEND queries and status reads they need, for rx, and those of reading packets, for tx
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dir_txns   = {"rx": 0, "tx": 0}
+        self.dir_cycles = {"rx": 0, "tx": 0}
+
+    def counted(self, direction, gen):
+        txns, cycles, tx_txns, tx_cycles = self.txns, self.cycles, self.dir_txns["tx"], self.dir_cycles["tx"]
+        r = yield from gen
+        # Packets read while writing are counted by read_packet, for tx
+        self.dir_txns[direction]   += self.txns - txns - (self.dir_txns["tx"] - tx_txns)
+        self.dir_cycles[direction] += self.cycles - cycles - (self.dir_cycles["tx"] - tx_cycles)
+        return r
+
+    def write(self, *args, **kwargs):
+        return (yield from self.counted("rx", super().write(*args, **kwargs)))
+
+    def read_packet(self, ev=None):
+        return (yield from self.counted("tx", super().read_packet(ev)))
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+def run(names, size, pkts, half, options):
+    """ Simulate pkts rounds of traffic with packets of size bytes, and return the counts and latencies """
+    dut = Dispatcher(**options)
+    periphs = []
+    for i, name in enumerate(names):
+        cls, rx, tx = PERIPHS[name]
+        p = cls()
+        dut.register(i, p, rx, tx)
+        periphs.append((i, name, p))
+    assert hasattr(dut.periph[0], "led"), "the first peripheral needs leds"
+
+    sim, host = simulator(dut, half, host=BenchHost)
+    room = dut.pkt_size - dut.hdr_size
+
+    now     = [0]
+    started = {i: deque() for i in range(len(names))}    # When the host started each write, by peripheral
+    offered = {i: deque() for i in range(len(names))}    # When each peripheral set o_valid, by peripheral
+    lat     = {"rx": {}, "tx": {}}                       # The latencies, by direction and packet size
+    counts  = {"rx_bytes": 0, "tx_bytes": 0, "tx_pkts": 0}
+
+    def record(direction, nb, cycles):
+        lat[direction].setdefault(nb, []).append(cycles)
+
+    # The packets the host writes, for each peripheral, and the number of packets each one sends back
+    def traffic(name, k):
+        data = [(k + j) & 0xFF for j in range(size)]
+        if name.startswith("bram"):
+            # A write of up to 13 bytes, and then a read of the same number, at an address for each round
+            n = min(size, room - 2)
+            addr = [0, (k * 16) & 0xFF]
+            return [(1, addr + data[:n], n), (0, addr + [n], 0)], 1
+        if name == "hello":
+            return [], 0
+        return [(0, data[:room], len(data[:room]))], 1 if name == "loopback" else 0
+
+    def got(pkt):
+        counts["tx_bytes"] += len(pkt.data)
+        counts["tx_pkts"]  += 1
+        record("tx", len(pkt.data), now[0] - offered[pkt.periph].popleft())
+
+    def host_process():
+        yield from host.wait(10)
+        expected = sum(1 for _, name, _ in periphs if name == "hello")
+        for k in range(pkts):
+            for i, name, _ in periphs:
+                writes, replies = traffic(name, k)
+                expected += replies
+                for flags, data, nb in writes:
+                    started[i].append((now[0], nb))
+                    counts["rx_bytes"] += nb
+                    yield from host.write(i, flags, data)
+            while host.received:
+                got(host.received.pop(0))
+            while (yield dut.qdir):
+                got((yield from host.await_event()))
+        while counts["tx_pkts"] < expected:
+            pkt = yield from host.await_event(timeout=20000)
+            if pkt is None:
+                break
+            got(pkt)
+
+    # Note when peripherals take packets, and when they offer them
+    def monitor():
+        yield Passive()
+        stamped = {}
+        while True:
+            now[0] += 1
+            for i, name, p in periphs:
+                _, rx, tx = PERIPHS[name]
+                if rx and (yield p.i_valid) and (yield p.o_ready):
+                    # BRAM read requests are not counted as rx traffic
+                    t, nb = started[i].popleft()
+                    if nb:
+                        record("rx", nb, now[0] - t)
+                if tx:
+                    if (yield p.i_ack):
+                        stamped[i] = False
+                    elif (yield p.o_valid) and not stamped.get(i):
+                        stamped[i] = True
+                        offered[i].append(now[0])
+            yield
+
+    sim.add_sync_process(host_process)
+    sim.add_sync_process(monitor)
+    sim.run()
+
+    def throughput(nbytes, txns, cycles):
+        sclk = cycles / (2 * half)
+        return {
+            "bytes"          : nbytes,
+            "transactions"   : txns,
+            "sclk_cycles"    : sclk,
+            "bytes_per_sclk" : nbytes / sclk if sclk else None,
+            "txns_per_byte"  : txns / nbytes if nbytes else None
+        }
+
+    result = {"size": size}
+    result.update(throughput(counts["rx_bytes"] + counts["tx_bytes"], host.txns, host.cycles))
+    for direction in ("rx", "tx"):
+        result[direction] = throughput(counts[direction + "_bytes"], host.dir_txns[direction], host.dir_cycles[direction])
+    return result, lat
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="QSPIE throughput and latency benchmark")
+    parser.add_argument("--periphs", default="led,loopback,bram,hello",
+                        help="comma separated peripherals, from " + ", ".join(PERIPHS))
+    parser.add_argument("--sizes", default="1,4,8,13", help="comma separated packet sizes in bytes")
+    parser.add_argument("--pkts", type=int, default=10, help="rounds of packets for each size")
+    parser.add_argument("--half", type=int, default=5, help="system clock cycles per half SCLK period")
+    parser.add_argument("--dispatcher", default="{}", help="dispatcher options, as JSON")
+    parser.add_argument("--out", help="file to write the results to, instead of stdout")
+    args = parser.parse_args()
+
+    names   = args.periphs.split(",")
+    options = json.loads(args.dispatcher)
+
+    runs = []
+    lat  = {"rx": {}, "tx": {}}
+    for size in [int(s) for s in args.sizes.split(",")]:
+        result, l = run(names, size, args.pkts, args.half, options)
+        runs.append(result)
+        for direction in l:
+            for nb, values in l[direction].items():
+                lat[direction].setdefault(nb, []).extend(values)
+
+    results = {
+        "config" : {
+            "periphs"    : names,
+            "pkts"       : args.pkts,
+            "half"       : args.half,
+            "dispatcher" : options
+        },
+        "runs"    : runs,
+        "latency" : {direction: {str(nb): {"n"   : len(values),
+                                            "p50" : percentile(values, 50),
+                                            "p99" : percentile(values, 99)}
+                                  for nb, values in sorted(lat[direction].items())}
+                     for direction in lat}
+    }
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
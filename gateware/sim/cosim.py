@@ -0,0 +1,146 @@
+import argparse
+import json
+import os
+import socket
+import time
+
+from dispatcher import Dispatcher
+from sim.bench import PERIPHS
+from sim.qspi_host import simulator
+
+# Co-simulation server: the Dispatcher RTL, with a mix of peripherals, runs in the simulator, and host software
+# drives its QSPI link over a Unix socket, with qspie.transport.SocketTransport. The simulation only runs while
+# a request is being served, and each request runs a whole transaction, or many cycles, rather than one cycle.
+# Run from the gateware directory with, for example:
+#   python -m sim.cosim --socket /tmp/qspie.sock --dispatcher '{"credits": true, "rx_fifo_depth": 2}'
+#
+# Requests and replies are JSON objects, one to a line. Every reply has qdir, which cannot change until the next
+# request, as the simulation is stopped in between:
+#   {"op": "config"}                      : the dispatcher's options, and the rx fifo depths, for the client
+#   {"op": "txn", "data": hex, "n": n}    : a transaction that writes data, and then reads n bytes, in "data"
+#   {"op": "wait", "cycles": n}           : run until QDIR is high, for at most n cycles, the cycles run in "cycles"
+#   {"op": "idle", "cycles": n}           : run for n cycles
+#   {"op": "stats"}                       : the simulated link throughput, and the wall clock throughput
+#   {"op": "close"}                       : end the simulation, with no reply
+
+# The system clock frequency of the simulation
+CLOCK = 100e6
+
+def config(dut):
+    """ The options the client needs, which must be the dispatcher's """
+    return {
+        "options"  : {
+            "pkt_size"    : dut.pkt_size,
+            "num_periphs" : dut.num_periphs,
+            "merged_tx"   : dut.merged_tx,
+            "credits"     : dut.credits,
+            "burst"       : dut.burst,
+            "ext_addr"    : dut.ext_addr,
+            "crc"         : dut.crc,
+            "timestamps"  : dut.timestamps
+        },
+        "rx_depth" : {str(i): d for i, d in enumerate(dut.rx_depth) if dut.rx_periph[i] is not None and d > 0},
+        "clock"    : CLOCK
+    }
+
+def stats(host, start):
+    """ The counts, and the throughput of the link in simulated time, and on the wall clock """
+    wall = time.time() - start
+    sim  = host.cycles / CLOCK
+    return {
+        "cycles"            : host.cycles,
+        "transactions"      : host.txns,
+        "bytes"             : host.bytes,
+        "sim_seconds"       : sim,
+        "wall_seconds"      : wall,
+        "sim_bytes_per_s"   : host.bytes / sim if sim else None,
+        "sim_bytes_per_sclk": host.bytes / (host.cycles / (2 * host.half)) if host.cycles else None,
+        "wall_bytes_per_s"  : host.bytes / wall if wall else None,
+        "wall_txns_per_s"   : host.txns / wall if wall else None,
+        "cycles_per_s"      : host.cycles / wall if wall else None
+    }
+
+def serve(f, names, half, options):
+    """ Simulate the dispatcher, serving the requests read from f until it is closed, and return the stats """
+    dut = Dispatcher(**options)
+    for i, name in enumerate(names):
+        cls, rx, tx = PERIPHS[name]
+        dut.register(i, cls(), rx, tx)
+
+    sim, host = simulator(dut, half, period=1 / CLOCK)
+    start = time.time()
+    final = {}
+
+    def process():
+        yield from host.wait(10)
+        for line in f:
+            req = json.loads(line)
+            op  = req["op"]
+            if op == "config":
+                reply = config(dut)
+            elif op == "txn":
+                r = yield from host.txn(list(bytes.fromhex(req["data"])), req["n"])
+                reply = {"data": bytes(r).hex()}
+            elif op == "wait":
+                n = 0
+                while n < req["cycles"] and not (yield dut.qdir):
+                    yield from host.wait(1)
+                    n += 1
+                reply = {"cycles": n}
+            elif op == "idle":
+                yield from host.wait(req["cycles"])
+                reply = {}
+            elif op == "stats":
+                reply = stats(host, start)
+            elif op == "close":
+                break
+            else:
+                reply = {"error": "unknown op " + str(op)}
+            reply["qdir"] = (yield dut.qdir)
+            try:
+                f.write((json.dumps(reply) + "\n").encode())
+                f.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                break
+        final.update(stats(host, start))
+
+    sim.add_sync_process(process)
+    sim.run()
+
+    return final
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="QSPIE co-simulation server")
+    parser.add_argument("--socket", default="/tmp/qspie.sock", help="the Unix socket to listen on")
+    parser.add_argument("--periphs", default="led,loopback,bram",
+                        help="comma separated peripherals, with ids from 0, from " + ", ".join(PERIPHS))
+    parser.add_argument("--half", type=int, default=5, help="system clock cycles per half SCLK period")
+    parser.add_argument("--dispatcher", default="{}", help="dispatcher options, as JSON")
+    parser.add_argument("--once", action="store_true", help="exit after the first connection")
+    args = parser.parse_args()
+
+    names   = args.periphs.split(",")
+    options = json.loads(args.dispatcher)
+
+    if os.path.exists(args.socket):
+        os.unlink(args.socket)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(args.socket)
+    server.listen(1)
+    print("Listening on", args.socket)
+
+    try:
+        while True:
+            # Each connection gets a new simulation, from reset
+            conn, _ = server.accept()
+            with conn, conn.makefile("rwb") as f:
+                s = serve(f, names, args.half, options)
+            print("{} transactions, {} bytes in {} cycles: {:.0f} bytes/s simulated, {:.0f} bytes/s and "
+                  "{:.0f} transactions/s on the wall clock, {:.0f} cycles/s".format(
+                  s["transactions"], s["bytes"], s["cycles"], s["sim_bytes_per_s"] or 0,
+                  s["wall_bytes_per_s"] or 0, s["wall_txns_per_s"] or 0, s["cycles_per_s"] or 0))
+            if args.once:
+                break
+    finally:
+        server.close()
+        os.unlink(args.socket)
@@ -0,0 +1,399 @@
+import os
+import sys
+
+from nmigen import *
+from nmigen.sim import *
+
+from qspi.qspi_ddr_io import QspiDdrIo
+
+# The protocol constants, and the framing and parsing of packets and the status, are shared with the host's client
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "host"))
+from qspie.protocol import (OK_TO_SEND, NACK, BURST_CMD, STATUS_CMD, READ_CMD, ACK_CMD, TS_CMD,
+                            crc, crc_bytes, crc_ok, header, parse_event, parse_merged, packet, status_size, parse_status,
+                            returned, dropped)
+
+# The sync cycles that csn is held high for between transactions, at least. The dispatcher needs 4, and with
+# SCLK capture, QDIR follows the end of a read 6 cycles after csn goes high, so it is checked after that.
+CSN_HIGH = 6
+
+class QspiHost:
+    """
+    Bus functional model of the STM32 side of the QSPIE protocol, for simulating a Dispatcher.
+
+    The calls are generators, used with `yield from` in a sync process of the simulator,
+    and they follow the protocol for the options the dispatcher was created with:
+    credits, merged reads, bursts, extended addressing, CRCs and timestamps, with any number of lanes.
+    With ddr, every byte of a transaction but the first moves a chunk on each edge of SCLK, through io,
+    the model of the DDR cells in qspi/qspi_ddr_io.py, which the dispatcher's qd signals are connected to.
+
+    SCLK runs at 1 / (2 * half) of the sync clock. csn should be a Signal with reset=1 that drives
+    the dispatcher's csn, so that no transaction is seen at reset.
+
+    Packets read while writing, because the ice40 had one to send first, are kept in `received`,
+    and returned by await_event before any others.
+
+    For testing the CRCs, a write can be corrupted on the link, and so can the next corrupt_reads reads of
+    a packet. Packets sent again, after a NACK or when the status shows they were dropped, are counted in resent,
+    and packets read again, after a bad CRC, in reread.
+    """
+    def __init__(self, dut, csn=None, half=5, io=None):
+        # With ddr, the qd pins are those of the model of the DDR cells, io, which is connected to the dut
+        assert not dut.ddr or io is not None
+        self.dut  = dut
+        self.csn  = dut.csn if csn is None else csn
+        self.half = half
+        self.qd_i = dut.qd_i if io is None else io.pin_i
+        self.qd_o = dut.qd_o if io is None else io.pin_o
+
+        # Set until the first byte of a transaction, which is at single data rate with ddr, has been sent
+        self.first = False
+
+        self.hb = dut.hdr_size
+        self.cb = dut.crc // 8
+        self.tb = dut.ts_size
+
+        # The credits left for each RX peripheral, and the last count of packets taken read from the status
+        self.credits = [d if p is not None else 0 for d, p in zip(dut.rx_depth, dut.rx_periph)]
+        self.taken   = [0] * dut.num_periphs
+
+        # With credits and a CRC, the packets sent since the status was last read, to send again if they were dropped
+        self.unchecked = []
+        self.seq       = 0
+
+        # The last packet sent, to send again after a NACK
+        self.last = None
+
+        self.received = []
+
+        self.corrupt_reads = 0
+        self.resent        = 0
+        self.reread        = 0
+
+        # Counts for throughput measurements
+        self.cycles = 0
+        self.txns   = 0
+        self.bytes  = 0
+
+    # Low level
+
+    def wait(self, n):
+        for _ in range(n):
+            self.cycles += 1
+            yield
+
+    def crc(self, data):
+        """ The CRC of data, as the dispatcher computes it """
+        return crc(data, self.dut.crc)
+
+    def corrupt(self, data):
+        """ data, with a bit of its last byte flipped, as if by noise on the link """
+        return list(data[:-1]) + [data[-1] ^ 0x10]
+
+    def with_crc(self, data):
+        return list(data) + list(crc_bytes(data, self.dut.crc))
+
+    def start(self):
+        yield self.dut.sclk.eq(0)
+        yield self.csn.eq(0)
+        yield from self.wait(self.half)
+        self.first = True
+
+    def stop(self):
+        yield from self.wait(self.half)
+        yield self.csn.eq(1)
+        yield from self.wait(max(self.half * 2, CSN_HIGH))
+        self.txns += 1
+
+    def clock(self, v=None):
+        """ One SCLK cycle, driving qd with v if it is not None, and returning qd sampled on the rising edge """
+        if v is not None:
+            yield self.qd_i.eq(v)
+        yield from self.wait(self.half)
+        yield self.dut.sclk.eq(1)
+        q = yield self.qd_o
+        yield from self.wait(self.half)
+        yield self.dut.sclk.eq(0)
+        return q
+
+    def clock_ddr(self, v=(None, None)):
+        """
+        One SCLK cycle at double data rate, driving qd with the two chunks of v that are not None, the first for
+        the rising edge and the second for the falling edge, and returning the two chunks sampled on those edges
+        """
+        q = []
+        for k in range(2):
+            if v[k] is not None:
+                yield self.qd_i.eq(v[k])
+            yield from self.wait(self.half)
+            q.append((yield self.qd_o))
+            yield self.dut.sclk.eq(1 - k)
+        return q
+
+    def chunks(self):
+        """ The number of chunks in a byte, and whether they go in pairs, at double data rate """
+        ddr = self.dut.ddr and not self.first
+        self.first = False
+        return 8 // self.dut.qw, ddr
+
+    def send_byte(self, b):
+        qw = self.dut.qw
+        n, ddr = self.chunks()
+        chunks = [(b >> (qw * j)) & ((1 << qw) - 1) for j in reversed(range(n))]
+        if ddr:
+            for j in range(0, n, 2):
+                yield from self.clock_ddr(chunks[j:j + 2])
+        else:
+            for c in chunks:
+                yield from self.clock(c)
+        self.bytes += 1
+
+    def recv_byte(self):
+        qw = self.dut.qw
+        n, ddr = self.chunks()
+        chunks = []
+        if ddr:
+            for j in range(0, n, 2):
+                chunks += yield from self.clock_ddr()
+        else:
+            for j in range(n):
+                chunks.append((yield from self.clock()))
+        b = 0
+        for c in chunks:
+            b = (b << qw) | c
+        self.bytes += 1
+        return b
+
+    def txn(self, data=(), n=0, cmd=None):
+        """ A transaction that sends data, or reads n bytes, after a command and a dummy byte if cmd is set """
+        yield from self.start()
+        out = []
+        if cmd is not None:
+            yield from self.send_byte(cmd)
+            yield from self.send_byte(0)
+        for b in data:
+            yield from self.send_byte(b)
+        for _ in range(n):
+            out.append((yield from self.recv_byte()))
+        yield from self.stop()
+        return out
+
+    # Status
+
+    def status(self):
+        """
+        Read the status, and return it as a dict. Credits are returned, and with a CRC,
+        packets that were dropped are sent again. Without credits, the reply before it is in `reply`.
+        """
+        dut = self.dut
+        n = status_size(dut.num_periphs, dut.credits, dut.crc, self.tb)
+        if dut.credits:
+            r = yield from self.txn(cmd=STATUS_CMD, n=n + self.cb)
+        else:
+            yield from self.drain()
+            r = yield from self.txn(n=self.hb + n + self.cb)
+            if r[0] < OK_TO_SEND:
+                # The ice40 had a packet to send first, so this was not the status
+                yield from self.event_reply(r)
+                return None
+        st = parse_status(r, dut.num_periphs, dut.credits, dut.ext_addr, dut.crc, self.tb)
+        if st is None:
+            return None
+        if dut.credits:
+            for i, c in enumerate(returned(self.taken, st["taken"])):
+                self.credits[i] += c
+        if "errs" in st:
+            yield from self.resend(st["seq"], st["errs"])
+        return st
+
+    def resend(self, seq, errs):
+        # The packets that were dropped did not use up a credit
+        drops = dropped(self.unchecked, seq, errs)
+        self.unchecked = []
+        for periph, pkt in drops:
+            self.credits[periph] += 1
+        for periph, pkt in drops:
+            yield from self.send(periph, pkt)
+            self.resent += 1
+
+    # Writes
+
+    def header(self, periph, flags):
+        return list(header(periph, flags, self.dut.ext_addr))
+
+    def drain(self):
+        """ Read the packets the ice40 has to send, while QDIR is high, and keep them, so that their peripherals can go on """
+        while (yield self.dut.qdir):
+            self.keep((yield from self.read_packet()))
+
+    def keep(self, pkt):
+        if pkt is not None:
+            self.received.append(pkt)
+
+    def event_reply(self, r):
+        """
+        Without credits, the reply r to a read that asked if it was OK to send was an event, as the ice40
+        had a packet to send first. Without merged reads, the data is read next. With them, the read got
+        the packet if it was long enough, and otherwise it is sent again.
+        """
+        if not self.dut.merged_tx:
+            self.keep((yield from self.read_packet(r[:self.hb])))
+        else:
+            self.keep(parse_merged(r, self.dut.pkt_size, self.dut.ext_addr, self.tb, self.dut.crc))
+
+    def ok_to_send(self):
+        """ Without credits, ask if it is OK to send until it is. Packets the ice40 sends first are kept. """
+        while True:
+            yield from self.drain()
+            r = yield from self.txn(n=self.hb)
+            if r[0] == OK_TO_SEND:
+                return
+            elif r[0] == NACK:
+                # The last packet had a bad CRC, and the ice40 is waiting for it again
+                yield from self.txn(self.last)
+                self.resent += 1
+            elif r[0] < OK_TO_SEND:
+                yield from self.event_reply(r)
+
+    def send(self, periph, pkt, corrupt=False):
+        """ Send a whole packet, with its header and any CRC, corrupted on the link if corrupt is set """
+        dut = self.dut
+        if dut.credits:
+            # rx_errs only covers the last 8 packets, so the status is read before more are unchecked
+            while self.credits[periph] == 0 or (self.cb and len(self.unchecked) >= 8):
+                yield from self.drain()
+                yield from self.status()
+            self.credits[periph] -= 1
+            if self.cb:
+                self.unchecked.append((self.seq, periph, pkt))
+                self.seq = (self.seq + 1) & 0xFF
+            yield from self.txn(self.corrupt(pkt) if corrupt else pkt)
+        else:
+            yield from self.ok_to_send()
+            self.last = pkt
+            yield from self.txn(self.corrupt(pkt) if corrupt else pkt)
+
+    def write(self, periph, flags, data, corrupt=False):
+        """ Write a packet of data to an RX peripheral, corrupted on the link the first time if corrupt is set """
+        assert len(data) <= self.dut.pkt_size - self.hb
+        assert self.cb or not corrupt
+        yield from self.send(periph, self.with_crc(self.header(periph, flags) + list(data)), corrupt)
+
+    def burst(self, periph, flags, data):
+        """ Write any number of bytes to an RX peripheral in a single transaction """
+        dut = self.dut
+        assert dut.burst
+        if dut.credits:
+            n = -(-len(data) // (dut.pkt_size - self.hb))
+            while self.credits[periph] < n:
+                yield from self.drain()
+                yield from self.status()
+            self.credits[periph] -= n
+            yield from self.txn([BURST_CMD] + self.header(periph, flags) + list(data))
+        else:
+            yield from self.ok_to_send()
+            yield from self.txn([BURST_CMD] + self.header(periph, flags) + list(data))
+
+    def set_timestamp(self, value):
+        """ Set the dispatcher's cycle counter """
+        assert self.tb
+        pkt = self.with_crc([TS_CMD] + [(value >> (8 * k)) & 0xFF for k in reversed(range(4))])
+        if self.dut.credits:
+            self.seq = (self.seq + 1) & 0xFF
+            yield from self.txn(pkt)
+        else:
+            yield from self.ok_to_send()
+            self.last = pkt
+            yield from self.txn(pkt)
+
+    # Reads
+
+    def event(self, ev):
+        """ The peripheral id and the number of bytes of data in an event """
+        return parse_event(ev, self.dut.pkt_size, self.dut.ext_addr)
+
+    def read_packet(self, ev=None):
+        """
+        Read the packet the ice40 has to send, when QDIR is high. ev is the event, when the
+        reply to an OK-TO-SEND read was one, which has already read it.
+        With a CRC, the packet is read again until its CRC is right.
+        """
+        dut = self.dut
+        while True:
+            if dut.merged_tx:
+                # The event and the data in one read, which is ended after the data
+                yield from self.start()
+                if dut.credits:
+                    yield from self.send_byte(READ_CMD)
+                    yield from self.send_byte(0)
+                r = []
+                for _ in range(self.hb):
+                    r.append((yield from self.recv_byte()))
+                periph, nb = self.event(r)
+                for _ in range(nb + self.tb + self.cb):
+                    r.append((yield from self.recv_byte()))
+                yield from self.stop()
+                pkt = parse_merged(self.corrupt_read(r), dut.pkt_size, dut.ext_addr, self.tb, dut.crc)
+            else:
+                # The event, and then the data in a second read
+                if ev is None:
+                    ev = yield from self.txn(n=self.hb)
+                periph, nb = self.event(ev)
+                data = self.corrupt_read((yield from self.txn(n=nb + self.tb + self.cb)))
+                pkt = packet(periph, nb, data, self.tb) if crc_ok(data, dut.crc) else None
+            if pkt is not None:
+                break
+            self.reread += 1
+        # The packet is kept until it is acked, with the ack command with credits, and otherwise with
+        # a read of a single byte
+        if self.cb:
+            yield from self.txn([ACK_CMD] if dut.credits else [], 0 if dut.credits else 1)
+        return pkt
+
+    def corrupt_read(self, data):
+        """ The data read, corrupted if corrupt_reads is set """
+        if self.corrupt_reads == 0:
+            return data
+        self.corrupt_reads -= 1
+        return self.corrupt(data)
+
+    def await_event(self, timeout=None):
+        """ Wait for QDIR to go high, for at most timeout cycles, and read the packet, or return None """
+        if self.received:
+            return self.received.pop(0)
+        n = 0
+        while not (yield self.dut.qdir):
+            if timeout is not None and n == timeout:
+                return None
+            yield from self.wait(1)
+            n += 1
+        return (yield from self.read_packet())
+
+def simulator(dut, half=5, host=QspiHost, period=1e-8):
+    """
+    Put a dispatcher, with its peripherals registered, in a module with csn high at reset, and return a simulator
+    of it, with a clock of period seconds, and a host of class host driving it with SCLK at 1 / (2 * half) of the
+    clock. With ddr, the qd pins go through the model of the DDR cells. Add the processes, which use the host,
+    to the simulator, and run it.
+    """
+    m = Module()
+
+    # csn is high at reset
+    csn = Signal(reset=1)
+
+    m.submodules.dut = dut
+    m.d.comb += dut.csn.eq(csn)
+
+    io = None
+    if dut.ddr:
+        m.submodules.io = io = QspiDdrIo(qw=dut.qw)
+        m.d.comb += [
+            io.sclk.eq(dut.sclk),
+            io.o.eq(dut.qd_o),
+            io.o_n.eq(dut.qd_o_n),
+            io.oe.eq(dut.qd_oe),
+            dut.qd_i.eq(io.i)
+        ]
+
+    sim = Simulator(m)
+    sim.add_clock(period)
+    return sim, host(dut, csn, half=half, io=io)
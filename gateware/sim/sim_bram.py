@@ -0,0 +1,79 @@
+from nmigen import *
+from nmigen.sim import *
+
+from periph.bram_periph import BramPeriph
+
+# Drive a BramPeriph directly, as the dispatcher would, with writes and reads at addresses that are not aligned
+# to its words, and a streamed write and read, for several memory widths. The data read back is checked, and
+# the cycles the peripheral is busy with each packet are counted.
+# Run from the gateware directory with: python -m sim.sim_bram
+
+def run(width):
+    dut = BramPeriph(depth=256, width=width)
+    pkt_size = dut.pkt_size
+
+    busy = {"write": [], "read": []}
+    errors = []
+
+    def put(flags, data):
+        """ Pass a packet to the peripheral, and return the cycles until it is ready again """
+        while not (yield dut.o_ready):
+            yield
+        # The data is at the bottom of the packet, first byte first
+        yield dut.i_pkt.eq(sum(b << (8 * (len(data) - 1 - j)) for j, b in enumerate(data)))
+        yield dut.i_nb.eq(len(data))
+        yield dut.i_flags.eq(flags)
+        yield dut.i_valid.eq(1)
+        yield
+        yield dut.i_valid.eq(0)
+        n = 0
+        yield
+        while not ((yield dut.o_ready) or (yield dut.o_valid)):
+            n += 1
+            yield
+        return n
+
+    def get():
+        """ Take the packet the peripheral has to send """
+        while not (yield dut.o_valid):
+            yield
+        nb = (yield dut.o_nb) or pkt_size
+        pkt = yield dut.o_pkt
+        yield dut.i_ack.eq(1)
+        yield
+        yield dut.i_ack.eq(0)
+        yield
+        # The data is sent from the top of the packet
+        return [(pkt >> (8 * (pkt_size - 1 - j))) & 0xFF for j in range(nb)]
+
+    def process():
+        for k, addr in enumerate([0, 1, 6, 35, 100]):
+            data = [(addr + j * 3) & 0xFF for j in range(13)]
+            busy["write"].append((yield from put(1, [0, addr] + data)))
+            busy["read"].append((yield from put(0, [0, addr, len(data)])))
+            got = yield from get()
+            if got != data:
+                errors.append((addr, got))
+        # Stream 40 bytes in, from address 130, and back
+        data = [(7 * j) & 0xFF for j in range(40)]
+        yield from put(2, [0, 130])
+        for j in range(0, len(data), 15):
+            yield from put(3, data[j:j + 15])
+        yield from put(2, [0, 130, 0, len(data)])
+        got = []
+        while len(got) < len(data):
+            got += yield from get()
+        if got != data:
+            errors.append(("stream", got))
+
+    sim = Simulator(dut)
+    sim.add_clock(1e-8)
+    sim.add_sync_process(process)
+    sim.run()
+
+    print("Width {}: {}, cycles busy for 13 byte writes {}, and reads {}".format(
+          width, "ok" if not errors else errors, busy["write"], busy["read"]))
+
+if __name__ == "__main__":
+    for width in (8, 16, 32, 128):
+        run(width)
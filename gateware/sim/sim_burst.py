@@ -0,0 +1,50 @@
+from nmigen.sim import Passive
+
+from dispatcher import Dispatcher
+from periph.led import Led
+from sim.qspi_host import simulator
+
+# Compare the payload bytes per QSPI transaction for single packet writes and for a burst.
+# Run from the gateware directory with: python -m sim.sim_burst
+
+N_PKTS  = 16   # Packets per burst
+PKT_LEN = 15   # Payload bytes per packet
+
+def run(name, burst, **kwargs):
+    dut = Dispatcher(burst=True, **kwargs)
+    led = Led()
+    dut.register(0, led, True, False, rx_fifo_depth=N_PKTS if dut.credits else None)
+
+    sim, host = simulator(dut)
+    payload = [i & 0xFF for i in range(N_PKTS * PKT_LEN)]
+    pkts    = []
+
+    # Count the packets consumed by the peripheral
+    def monitor():
+        yield Passive()
+        while True:
+            if (yield led.i_valid):
+                pkts.append(1)
+            yield
+
+    def process():
+        yield from host.wait(10)
+        if burst:
+            yield from host.burst(0, 0, payload)
+        else:
+            for i in range(0, len(payload), PKT_LEN):
+                yield from host.write(0, 0, payload[i:i + PKT_LEN])
+        yield from host.wait(100)
+
+    sim.add_sync_process(process)
+    sim.add_sync_process(monitor)
+    sim.run()
+
+    print("{}: {} packets delivered, {} transactions, {:.1f} payload bytes/transaction".format(
+          name, len(pkts), host.txns, len(payload) / host.txns))
+
+if __name__ == "__main__":
+    run("Single packets", False)
+    run("Burst", True)
+    run("Single packets, credits", False, credits=True)
+    run("Burst, credits", True, credits=True)
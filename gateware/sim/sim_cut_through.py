@@ -0,0 +1,77 @@
+from nmigen.sim import *
+
+from dispatcher import Dispatcher
+from periph.led import Led
+from sim.qspi_host import QspiHost, simulator
+
+# Compare the write latency of a Led taking whole packets with one registered as a stream peripheral, which
+# packets are cut through to as they arrive. The latency is from csn going high at the end of a packet to the
+# led showing its last byte. With a CRC, and in bursts, packets are replayed to a stream peripheral from the
+# packet buffer instead, and for stream peripherals the bytes they were passed are checked.
+# Run from the gateware directory with: python -m sim.sim_cut_through
+
+class TimedHost(QspiHost):
+    """ A QspiHost that notes the cycle that csn last went high """
+    def stop(self):
+        yield from super().stop()
+        self.end = self.cycles - 2 * self.half
+
+def run(name, stream, burst=False, **kwargs):
+    dut = Dispatcher(burst=burst, **kwargs)
+    led = Led(stream=stream)
+    dut.register(0, led, True, False, stream=stream)
+
+    sim, host = simulator(dut, host=TimedHost)
+    room = dut.pkt_size - dut.hdr_size
+    # The last byte of each packet is different from every byte before it, and from the led at reset
+    sent = [[k * 16 + j + 1 for j in range(1 + (2 * k) % room)] for k in range(8)]
+
+    now      = [0]
+    changed  = []                              # The cycles the led changed
+    streamed = []                              # The bytes passed to a stream peripheral
+    lat      = []
+
+    def process():
+        yield from host.wait(10)
+        if burst:
+            yield from host.burst(0, 0, [b for data in sent for b in data])
+            yield from host.wait(200)
+            return
+        for data in sent:
+            yield from host.write(0, 0, data)
+            n = 0
+            while (yield led.led) != data[-1] and n < 500:
+                yield from host.wait(1)
+                n += 1
+            lat.append(changed[-1] - host.end)
+
+    def monitor():
+        yield Passive()
+        last = 0
+        while True:
+            now[0] += 1
+            v = yield led.led
+            if v != last:
+                changed.append(now[0])
+                last = v
+            if stream and (yield led.i_byte_valid):
+                streamed.append((yield led.i_byte))
+            yield
+
+    sim.add_sync_process(process)
+    sim.add_sync_process(monitor)
+    sim.run()
+
+    expected = [b for data in sent for b in data]
+    check = "" if not stream else ", bytes " + ("ok" if streamed == expected else str(streamed))
+    latency = "" if burst else ", latency after csn {} to {} cycles".format(min(lat), max(lat))
+    print("{}: {} transactions, {} cycles{}{}".format(name, host.txns, host.cycles, latency, check))
+
+if __name__ == "__main__":
+    run("Whole packets", False)
+    run("Cut through", True)
+    run("Cut through, two lanes", True, qw=2)
+    run("Cut through, extended addressing", True, ext_addr=True)
+    run("Replayed, with CRC-8", True, crc=8)
+    run("Whole packets in a burst", False, burst=True)
+    run("Replayed in a burst", True, burst=True)
@@ -1,85 +1,90 @@
-from nmigen import *
-from nmigen.sim import *
-
 from dispatcher import Dispatcher
-from test_rx import TestRx
-from test_tx import TestTx
-from test_both import TestBoth
-
-if __name__ == "__main__":
+from periph.loopback import Loopback
+from periph.hello_tx import HelloTx
+from sim.qspi_host import simulator
+
+# Write packets to a loopback peripheral and read them back, along with the packet from HelloTx,
+# for a few of the dispatcher's options. With corrupt set, some of the packets written and read have bad CRCs on
+# the link, and are sent or read again.
+# Run from the gateware directory with: python -m sim.sim_dispatcher
+
+def run(name, corrupt=False, packets=4, depth=2, half=5, **kwargs):
+    dut = Dispatcher(**kwargs)
+    rx_fifo_depth = depth if dut.credits else None
+    # With a pool, the loopback is passed buffers instead of packets
+    pooled = dut.pool is not None
+    dut.register(0, Loopback(pooled=pooled), True, True, rx_fifo_depth=rx_fifo_depth, pooled=pooled)
+    dut.register(1, HelloTx(), False, True)
+
+    sim, host = simulator(dut, half)
+    sent = [[i + k for i in range(1 + k)] for k in range(packets)]
+    got  = []
+    st   = []
 
     def process():
-        # csn high and event zero by default
-        yield dut.csn.eq(1)
-
-        # Start a write transaction by setting the event
-        # and then setting it back to F
-        print("Starting write txn - sending 0x0123456789abcdef0123456789abcdef")
-        yield dut.ev_i.eq(0)
-        yield
-        yield dut.ev_i.eq(0xf)
-        yield
-
-        # Set spi clock low by default
-        yield dut.sclk.eq(0)
-
-        # Start the transaction
-        yield dut.csn.eq(0)
-        nibble = 0
-
-        # Send 0-F nibbles twice
-        for i in range(32):
-            yield dut.qd_i.eq(i & 0xF)
-
-            yield 
-            yield dut.sclk.eq(1)
-            yield
-            yield dut.sclk.eq(0)
-        
-        # End the transaction 
-        yield dut.csn.eq(1)
-        
-        print("Waiting for read request")
-
-        # Look for a read request
-        for i in range(10):
-            ev_o = yield dut.ev_o
-            if (ev_o == 1):
+        yield from host.wait(10)
+        for k, data in enumerate(sent):
+            # The second and third packets have bad CRCs the first time they are sent
+            yield from host.write(0, k, data, corrupt=corrupt and k in (1, 2))
+        if corrupt and dut.credits:
+            # The ice40 drops them, and its status says which were dropped, so they are sent again.
+            # Without credits, they are NACKed and sent again by the next write.
+            yield from host.status()
+        if corrupt:
+            # The packets read are kept until they are acked, so they can be read again
+            host.corrupt_reads = 2
+        while len(got) < len(sent) + 1:
+            pkt = yield from host.await_event(timeout=2000)
+            if pkt is None:
+                break
+            got.append(pkt)
+        # A status read is not the status if the ice40 had a packet to send first
+        for _ in range(4):
+            r = yield from host.status()
+            if r is not None:
+                st.append(r)
                 break
-            yield
-
-        # Set spi clock low and start the transaction
-        yield dut.sclk.eq(0)
-        yield dut.csn.eq(0)
-        
-        print("Read ", end='')
-
-        # Read nibbles
-        for i in range(32):
-            yield 
-            yield dut.sclk.eq(1)
-            yield
-            qd_o = yield dut.qd_o;
-            print("{:x}".format(qd_o),end='')
-            yield dut.sclk.eq(0)
-
-        print()
-        
-        # End the transaction
-        yield dut.csn.eq(1)
-        yield
-
-    m = Module()
-
-    dut = Dispatcher()
-    dut.register(0, TestBoth(), True, True)
-    dut.register(1, TestTx(), False, True)
-    m.submodules.dut = dut
 
-    sim = Simulator(m)
-    sim.add_clock(1e-6)
     sim.add_sync_process(process)
+    sim.run()
 
-    with sim.write_vcd("dispatch.vcd", "dispatch.gtkw"):
-        sim.run()
+    echoed = [list(p.data) for p in got if p.periph == 0]
+    if corrupt and dut.credits:
+        # Packets dropped with credits are sent again after the ones sent since, so they are echoed out of order
+        echoed.sort(key=len)
+    hello  = [bytes(p.data) for p in got if p.periph == 1]
+    print("{}: {} echoed, status {}, {} transactions, {} cycles, {}{}".format(
+          name, "all" if echoed == sent else echoed, "ok" if st else "not read", host.txns, host.cycles, hello,
+          ", {} resent, {} read again".format(host.resent, host.reread) if corrupt else ""))
 
+if __name__ == "__main__":
+    run("Default")
+    run("Merged reads", merged_tx=True)
+    run("Extended addressing", ext_addr=True, merged_tx=True)
+    run("Credits", credits=True)
+    run("Credits with CRC-16", credits=True, crc=16)
+    run("CRC-8", crc=8)
+    run("CRC-16", crc=16)
+    run("CRC-8, merged reads", crc=8, merged_tx=True)
+    run("CRC-8, timestamps", crc=8, merged_tx=True, timestamps=True)
+    run("Two lanes", qw=2)
+    run("SCLK capture", credits=True, capture="sclk")
+    run("SCLK capture at SCLK / 2", half=1, credits=True, capture="sclk")
+    run("SCLK capture at SCLK / 4, one lane", half=2, credits=True, capture="sclk", qw=1)
+    run("SCLK capture, eight lanes", credits=True, capture="sclk", qw=8)
+    run("One lane, merged reads", qw=1, merged_tx=True)
+    run("One lane, credits", qw=1, credits=True)
+    run("Eight lanes, merged reads", qw=8, merged_tx=True)
+    run("Eight lanes, credits", qw=8, credits=True)
+    run("Timestamps", merged_tx=True, timestamps=True)
+    run("DDR", credits=True, capture="sclk", ddr=True)
+    run("DDR at SCLK / 2", half=1, credits=True, capture="sclk", ddr=True)
+    run("DDR with CRC-16, corrupted", corrupt=True, credits=True, capture="sclk", ddr=True, crc=16)
+    run("CRC-8, corrupted", corrupt=True, crc=8)
+    run("CRC-16, corrupted, merged reads", corrupt=True, crc=16, merged_tx=True)
+    run("Credits with CRC-8, corrupted", corrupt=True, credits=True, crc=8)
+    run("Credits with CRC-16, corrupted, merged reads", corrupt=True, credits=True, crc=16, merged_tx=True)
+    run("SCLK capture with CRC-8, corrupted", corrupt=True, credits=True, crc=8, capture="sclk")
+    run("Credits with CRC-8, corrupted, deep FIFO", corrupt=True, packets=12, depth=16, credits=True, crc=8)
+    run("Pool", pool_bufs=8, merged_tx=True)
+    run("Pool, round robin, extended addressing", pool_bufs=8, merged_tx=True, arbiter="round_robin", ext_addr=True)
@@ -0,0 +1,147 @@
+import os
+import sys
+import time
+
+from dispatcher import Dispatcher
+from periph.led import Led
+from periph.loopback import Loopback
+from periph.bram_periph import BramPeriph
+from sim.qspi_host import QspiHost, simulator
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "host"))
+from qspie import model
+from qspie.protocol import OK_TO_SEND
+
+# Check the transaction-level model in host/qspie/model.py against the RTL. The transactions of a simulation
+# of the dispatcher, with a led, a loopback and a BRAM peripheral, are recorded, with the time each one started,
+# and replayed on the model, which has to read the same bytes, and have QDIR high at the same transactions.
+# The model's own speed is measured on the traffic of packets echoed by a loopback.
+# Run from the gateware directory with: python -m sim.sim_model
+
+class RecordingHost(QspiHost):
+    """ A QspiHost that records its transactions, as [start cycle, bytes sent, bytes read, qdir] """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.log = []
+
+    def start(self):
+        self.log.append([self.cycles, [], [], (yield self.dut.qdir)])
+        yield from super().start()
+
+    def send_byte(self, b):
+        self.log[-1][1].append(b)
+        yield from super().send_byte(b)
+
+    def recv_byte(self):
+        b = yield from super().recv_byte()
+        self.log[-1][2].append(b)
+        return b
+
+def traffic(k):
+    """ The writes of round k, as (periph, flags, data) """
+    data = [(k * 7 + j) & 0xFF for j in range(1 + k % 13)]
+    addr = [0, (k * 16) & 0xFF]
+    return [(0, 0, data[:1]),
+            (1, k & 0xF, data[:14]),
+            (2, 1, addr + data[:13]),
+            (2, 0, addr + [len(data[:13])])]
+
+def record(rounds, **kwargs):
+    """ Simulate the RTL, and return the transactions, the led, and the cycles it ran for """
+    dut = Dispatcher(**kwargs)
+    rx_fifo_depth = 2 if dut.credits else None
+    dut.register(0, Led(), True, False, rx_fifo_depth=rx_fifo_depth)
+    dut.register(1, Loopback(), True, True, rx_fifo_depth=rx_fifo_depth)
+    dut.register(2, BramPeriph(depth=256), True, True, rx_fifo_depth=rx_fifo_depth)
+
+    sim, host = simulator(dut, host=RecordingHost)
+    led  = []
+
+    def process():
+        yield from host.wait(10)
+        for k in range(rounds):
+            for periph, flags, data in traffic(k):
+                yield from host.write(periph, flags, data)
+            if dut.burst:
+                yield from host.burst(0, 0, list(range(20 + k)))
+            while (yield dut.qdir):
+                yield from host.await_event()
+        while (yield from host.await_event(timeout=500)) is not None:
+            pass
+        led.append((yield dut.periph[0].led))
+
+    sim.add_sync_process(process)
+    sim.run()
+
+    return host.log, led[0], host.cycles
+
+def replay(log, cycles, **kwargs):
+    """ Replay the transactions on the model, for the cycles the RTL ran for, and return the number that differ, and the led """
+    d = model.Dispatcher(**kwargs)
+    rx_fifo_depth = 2 if d.credits else None
+    d.register(0, model.Led(), True, False, rx_fifo_depth=rx_fifo_depth)
+    d.register(1, model.Loopback(), True, True, rx_fifo_depth=rx_fifo_depth)
+    d.register(2, model.BramPeriph(depth=256), True, True, rx_fifo_depth=rx_fifo_depth)
+
+    bad = 0
+    for t, sent, read, qdir in log:
+        # The host reads QDIR from the simulator before the clock edge, so it sees it as it was the cycle before
+        d.idle(t - 1 - d.now)
+        q = d.qdir
+        d.idle(1)
+        got = list(d.transaction(sent, len(read)))
+        if got != read or q != qdir:
+            if bad < 5:
+                print("  at {}: sent {}, read {}, qdir {}, model read {}, qdir {}".format(
+                      t, sent, read, qdir, got, int(q)))
+            bad += 1
+    d.idle(cycles - d.now)
+    return bad, d.periph[0].led
+
+def run(name, rounds=6, **kwargs):
+    log, led, cycles = record(rounds, **kwargs)
+    bad, model_led = replay(log, cycles, **kwargs)
+    print("{}: {} transactions, {} differ, led {}".format(
+          name, len(log), bad, "matches" if led == model_led else "{} != {}".format(led, model_led)))
+
+def benchmark(rounds=20000):
+    """
+    Run the model, without the RTL, on rounds of write and echo traffic, and report its transactions per second
+    on the wall clock. Each round is an OK-TO-SEND query, the write of a packet to a loopback, and the reads
+    of its event and data.
+    """
+    d = model.Dispatcher()
+    d.register(1, model.Loopback(), True, True)
+
+    txns = 0
+    t = time.perf_counter()
+    for k in range(rounds):
+        data = bytes((k + j) & 0xFF for j in range(1 + k % 15))
+        while d.transaction(b"", 1)[0] != OK_TO_SEND:
+            d.idle(10)
+            txns += 1
+        d.idle(10)
+        d.transaction(bytes([0x10 | (k & 0xF)]) + data)
+        d.idle(10)
+        while not d.qdir:
+            d.idle(10)
+        ev = d.transaction(b"", 1)
+        d.idle(10)
+        got = d.transaction(b"", ev[0] & 0xF or 16)
+        d.idle(10)
+        txns += 4
+        assert got == data
+    t = time.perf_counter() - t
+    print("Model: {} transactions of write and echo traffic in {:.2f}s, {:.0f} transactions/s".format(txns, t, txns / t))
+
+if __name__ == "__main__":
+    run("Default")
+    run("Merged reads", merged_tx=True)
+    run("Extended addressing", ext_addr=True, merged_tx=True)
+    run("Bursts", burst=True)
+    run("Credits", credits=True)
+    run("Credits with CRC-16", credits=True, crc=16)
+    run("CRC-8", crc=8)
+    run("Two lanes", qw=2)
+    run("TX fifos, round robin", tx_fifo_depth=2, arbiter="round_robin")
+    benchmark()
@@ -0,0 +1,61 @@
+from dispatcher import Dispatcher
+from router import Router
+from periph.loopback import Loopback
+from periph.bram_periph import BramPeriph
+from sim.qspi_host import simulator
+
+# Write packets through a Router to two loopback sub-peripherals, and read them back with the sub-peripheral
+# id in front, up to the longest packet that fits. A BRAM sub-peripheral is read 15 bytes at a time, which is the
+# most a sub-peripheral can send, and a packet for a sub-peripheral that is not registered is dropped.
+# Run from the gateware directory with: python -m sim.sim_router
+
+ROUTER = 0
+BRAM   = 15
+
+def run(name, **kwargs):
+    dut = Dispatcher(**kwargs)
+    router = Router(pkt_size=dut.pkt_size)
+    router.register(0, Loopback(), True, True)
+    router.register(5, Loopback(), True, True)
+    router.register(BRAM, BramPeriph(depth=256), True, True)
+    dut.register(ROUTER, router, True, True, rx_fifo_depth=2 if dut.credits else None)
+
+    sim, host = simulator(dut)
+
+    # The data of a packet to a sub-peripheral follows its id
+    room = dut.pkt_size - dut.hdr_size - 1
+    sent = [[sub] + [(sub + j) & 0xFF for j in range(n)] for sub in (0, 5) for n in (1, 7, room)]
+    data = [(3 * j) & 0xFF for j in range(dut.pkt_size - 1)]
+    got  = []
+
+    def process():
+        yield from host.wait(10)
+        for pkt in sent:
+            yield from host.write(ROUTER, 0, pkt)
+        # Dropped by the router
+        yield from host.write(ROUTER, 0, [9, 1, 2, 3])
+        # Write 15 bytes to the BRAM, in two requests that fit, and read them back in one packet
+        half = room - 2
+        yield from host.write(ROUTER, 1, [BRAM, 0, 16] + data[:half])
+        yield from host.write(ROUTER, 1, [BRAM, 0, 16 + half] + data[half:])
+        yield from host.write(ROUTER, 0, [BRAM, 0, 16, len(data)])
+        while True:
+            pkt = yield from host.await_event(timeout=2000)
+            if pkt is None:
+                break
+            got.append(pkt)
+
+    sim.add_sync_process(process)
+    sim.run()
+
+    echoed = [list(p.data) for p in got if p.periph == ROUTER and p.data[0] != BRAM]
+    read   = [list(p.data) for p in got if p.periph == ROUTER and p.data[0] == BRAM]
+    print("{}: {} echoed, {}, {} transactions, {} cycles".format(
+          name, "all" if echoed == sent else echoed,
+          "15 byte read ok" if read == [[BRAM] + data] else read, host.txns, host.cycles))
+
+if __name__ == "__main__":
+    run("Router")
+    run("Router, merged reads", merged_tx=True)
+    run("Router, extended addressing", ext_addr=True, merged_tx=True)
+    run("Router, credits", credits=True)
@@ -0,0 +1,53 @@
+import os
+import sys
+
+from dispatcher import Dispatcher
+from periph.message_loopback import MessageLoopback
+from sar import SAR_LAST
+from sim.qspi_host import simulator
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "host"))
+from qspie.sar import segments
+
+# Write messages of several lengths to a MessageLoopback, as packets marked with the SAR flags, and reassemble
+# the messages it sends back from the trailers of its packets. The messages are split into packets as the host's
+# client does.
+# Run from the gateware directory with: python -m sim.sim_sar
+
+def run(name, stream, **kwargs):
+    dut = Dispatcher(**kwargs)
+    rx_fifo_depth = 2 if dut.credits else None
+    dut.register(0, MessageLoopback(stream=stream), True, True, rx_fifo_depth=rx_fifo_depth, stream=stream)
+
+    sim, host = simulator(dut)
+    room = dut.pkt_size - dut.hdr_size
+    sent = [[(k * 7 + j) & 0xFF for j in range(n)] for k, n in enumerate([1, room, room + 1, 15, 40, 3])]
+    got  = []
+    msg  = []
+
+    def process():
+        yield from host.wait(10)
+        for data in sent:
+            for flags, chunk in segments(data, room):
+                yield from host.write(0, flags, chunk)
+        while len(got) < len(sent):
+            pkt = yield from host.await_event(timeout=2000)
+            if pkt is None:
+                break
+            msg.extend(pkt.data[:-1])
+            if pkt.data[-1] & SAR_LAST:
+                got.append(list(msg))
+                msg.clear()
+
+    sim.add_sync_process(process)
+    sim.run()
+
+    print("{}: {} echoed, {} transactions, {} cycles".format(
+          name, "all" if got == sent else got, host.txns, host.cycles))
+
+if __name__ == "__main__":
+    run("Cut through", True)
+    run("Replayed, with CRC-8", True, crc=8)
+    run("Whole packets", False)
+    run("Whole packets, with credits", False, credits=True)
+    run("Extended addressing", True, ext_addr=True, merged_tx=True)
@@ -0,0 +1,119 @@
+from dispatcher import Dispatcher
+from periph.loopback import Loopback
+from periph.stats import Stats, GENERAL, STATES
+from sim.qspi_host import simulator
+
+# Write packets to a loopback peripheral, and read the Stats counters over the link: the transactions and bytes,
+# the packets of each peripheral, and the latency of the loopback's packets, and its histogram. The counters
+# are reset, and the latency is measured for another peripheral, which sends nothing, and then checked again.
+# Run from the gateware directory with: python -m sim.sim_stats
+
+STATS = 6
+
+# The index of the first counter of each kind, as in the README
+RX_PKTS = len(GENERAL) + len(STATES)
+
+def bucket(lat, buckets=16):
+    """ The histogram bucket of a latency: bucket k counts latencies below 2**(k + 1) """
+    return min(max(lat.bit_length() - 1, 0), buckets - 1)
+
+def run(name, **kwargs):
+    dut = Dispatcher(**kwargs)
+    rx_fifo_depth = 2 if dut.credits else None
+    stats = Stats(num_periphs=dut.num_periphs)
+    dut.register(0, Loopback(), True, True, rx_fifo_depth=rx_fifo_depth)
+    dut.register(STATS, stats, True, True, rx_fifo_depth=rx_fifo_depth, stats=True)
+
+    sim, host = simulator(dut)
+    tx_pkts = RX_PKTS + dut.num_periphs
+    hist    = tx_pkts + dut.num_periphs
+    sent    = [[k] * (3 + k) for k in range(4)]
+    errors  = []
+    seen    = {}
+
+    def read(first, count):
+        """ Read count counters from first, a packet of up to 4 at a time """
+        cnt = []
+        while len(cnt) < count:
+            n = min(count - len(cnt), 4)
+            yield from host.write(STATS, 0, [first + len(cnt), n])
+            while True:
+                pkt = yield from host.await_event(timeout=2000)
+                if pkt is None:
+                    errors.append(("no counters", first + len(cnt)))
+                    return cnt
+                if pkt.periph == STATS:
+                    break
+            cnt += [int.from_bytes(bytes(pkt.data[4 * k:4 * k + 4]), "big") for k in range(n)]
+        return cnt
+
+    def echo():
+        """ Write the packets to the loopback, and read them back """
+        for k, data in enumerate(sent):
+            yield from host.write(0, k, data)
+        echoed = []
+        while len(echoed) < len(sent):
+            pkt = yield from host.await_event(timeout=2000)
+            if pkt is None:
+                break
+            echoed.append(list(pkt.data))
+        if echoed != sent:
+            errors.append(("echoed", echoed))
+
+    def check(what, got, expected):
+        if got != expected:
+            errors.append((what, got, expected))
+
+    def process():
+        yield from host.wait(10)
+
+        # Measure the latency of the loopback, which also resets the counters
+        yield from host.write(STATS, 2, [0])
+        yield from echo()
+        general = yield from read(0, len(GENERAL))
+        rx_txns, tx_txns, rx_bytes, tx_bytes, not_ready, lat_min, lat_max, lat_count = general
+        # The writes counted are those of the packets, and of the read request
+        hb, cb = dut.hdr_size, dut.crc // 8
+        check("writes", (rx_txns, rx_bytes), (len(sent) + 1, sum(hb + len(d) + cb for d in sent) + hb + 2 + cb))
+        seen["txns"]  = (rx_txns, tx_txns, rx_bytes, tx_bytes)
+        seen["lat"]   = (lat_min, lat_max, lat_count)
+        pkts = yield from read(RX_PKTS, 1)
+        pkts += yield from read(tx_pkts, 1)
+        check("packets", pkts, [len(sent), len(sent)])
+        check("latencies", lat_count, len(sent))
+        if not lat_min <= lat_max:
+            errors.append(("latency range", lat_min, lat_max))
+        buckets = yield from read(hist, 16)
+        seen["hist"] = buckets
+        check("histogram", sum(buckets), lat_count)
+        for lat in (lat_min, lat_max):
+            if buckets[bucket(lat)] == 0:
+                errors.append(("bucket", lat, buckets))
+
+        # Reset the counters, and see that the packets counted before are gone
+        yield from host.write(STATS, 1, [])
+        pkts = yield from read(RX_PKTS, 1)
+        pkts += yield from read(tx_pkts, 1)
+        # Only the read requests since the reset have been passed on, to the stats peripheral
+        check("packets after reset", pkts, [0, 0])
+        general = yield from read(0, len(GENERAL))
+        check("latencies after reset", general[5:], [2 ** 32 - 1, 0, 0])
+
+        # Measure the latency of a peripheral that sends nothing, and see that the loopback's are not counted
+        yield from host.write(STATS, 2, [1])
+        yield from echo()
+        general = yield from read(0, len(GENERAL))
+        check("latencies of peripheral 1", general[7], 0)
+
+    sim.add_sync_process(process)
+    sim.run()
+
+    print("{}: {}, {} RX / {} TX transactions, {} / {} bytes, latency min {} max {} count {}, histogram {}".format(
+          name, "ok" if not errors else errors, *seen.get("txns", [None] * 4), *seen.get("lat", [None] * 3),
+          seen.get("hist")))
+
+if __name__ == "__main__":
+    run("Default")
+    run("Merged reads", merged_tx=True)
+    run("Credits", credits=True)
+    run("CRC-8", crc=8)
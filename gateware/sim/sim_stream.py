@@ -0,0 +1,46 @@
+from dispatcher import Dispatcher
+from periph.stream_loopback import StreamLoopback
+from sim.qspi_host import simulator
+
+# Write packets to a StreamLoopback, which passes them back a byte at a time through its byte streams, and read
+# them back. Registered with stream=True its bytes are cut through, or replayed with a CRC and in bursts, and
+# otherwise it is passed whole packets, which it turns into a stream, so it can be used with credits.
+# Run from the gateware directory with: python -m sim.sim_stream
+
+def run(name, stream, burst=False, **kwargs):
+    dut = Dispatcher(burst=burst, **kwargs)
+    rx_fifo_depth = 2 if dut.credits else None
+    dut.register(0, StreamLoopback(stream=stream), True, True, rx_fifo_depth=rx_fifo_depth, stream=stream)
+
+    sim, host = simulator(dut)
+    room = dut.pkt_size - dut.hdr_size
+    sent = [[k * 16 + j for j in range(1 + (3 * k) % room)] for k in range(6)]
+    got  = []
+
+    def process():
+        yield from host.wait(10)
+        if burst:
+            for data in sent:
+                yield from host.burst(0, 0, data)
+        else:
+            for data in sent:
+                yield from host.write(0, 0, data)
+        while len(got) < len(sent):
+            pkt = yield from host.await_event(timeout=2000)
+            if pkt is None:
+                break
+            got.append(list(pkt.data))
+
+    sim.add_sync_process(process)
+    sim.run()
+
+    print("{}: {} echoed, {} transactions, {} cycles".format(
+          name, "all" if got == sent else got, host.txns, host.cycles))
+
+if __name__ == "__main__":
+    run("Cut through", True)
+    run("Cut through, merged reads", True, merged_tx=True)
+    run("Replayed, with CRC-8", True, crc=8)
+    run("Replayed in bursts", True, burst=True)
+    run("Whole packets", False)
+    run("Whole packets, with credits", False, credits=True)
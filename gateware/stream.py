@@ -0,0 +1,257 @@
+from nmigen import *
+from nmigen.lib.fifo import SyncFIFOBuffered
+
+class ByteStream:
+    """
+    A stream of the bytes of packets. A byte is passed in a cycle that valid and ready are both set.
+    On a stream of received packets, flags come with every byte, and nb, the number of bytes in the packet,
+    with its last byte. A packet with no data is a single byte, with last set and nb 0.
+    On a stream of packets to send, flags and nb are not used.
+    """
+    def __init__(self):
+        self.data  = Signal(8)
+        self.valid = Signal()
+        self.ready = Signal()
+        self.last  = Signal()       # Set with the last byte of a packet
+        self.flags = Signal(4)
+        self.nb    = Signal(5)
+
+class PacketToStream(Elaboratable):
+    """ Adapter from the packets the dispatcher passes to an rx peripheral, to a byte stream """
+    def __init__(self, pkt_size=16):
+        # Parameters
+        self.pkt_size = pkt_size
+
+        # Inputs
+        self.i_pkt    = Signal(pkt_size * 8)
+        self.i_valid  = Signal()
+        self.i_nb     = Signal(4)
+        self.i_flags  = Signal(4)
+
+        # Outputs
+        self.o_ready  = Signal()
+        self.out      = ByteStream()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        pkt  = Signal(self.pkt_size * 8)
+        left = Signal(5)             # The number of bytes left to pass on
+        busy = Signal()
+
+        m.d.comb += self.o_ready.eq(~busy)
+
+        with m.If(self.i_valid & self.o_ready):
+            m.d.sync += [
+                pkt.eq(self.i_pkt),
+                left.eq(self.i_nb),
+                busy.eq(1),
+                self.out.flags.eq(self.i_flags),
+                self.out.nb.eq(self.i_nb)
+            ]
+
+        # The data is at the bottom of the packet, first byte first, and a packet with no data is passed as one byte
+        m.d.comb += [
+            self.out.data.eq(pkt.word_select(left - 1, 8)),
+            self.out.valid.eq(busy),
+            self.out.last.eq(left <= 1)
+        ]
+
+        with m.If(self.out.valid & self.out.ready):
+            m.d.sync += left.eq(left - 1)
+            with m.If(self.out.last):
+                m.d.sync += busy.eq(0)
+
+        return m
+
+class StreamRx(Elaboratable):
+    """
+    Adapter from the bytes the dispatcher passes to a stream peripheral, as they arrive, to a byte stream.
+    They go into a fifo, which the stream is read from, and the dispatcher is told it is ready while there is room
+    in it for a whole packet. The end of a packet is only known after its last byte, so each byte is held until
+    the next one, or the end, has arrived.
+    """
+    def __init__(self, pkt_size=16):
+        # Parameters
+        self.pkt_size = pkt_size
+
+        # Inputs
+        self.i_start      = Signal()
+        self.i_byte       = Signal(8)
+        self.i_byte_valid = Signal()
+        self.i_end        = Signal()
+        self.i_nb         = Signal(4)
+        self.i_flags      = Signal(4)
+
+        # Outputs
+        self.o_ready  = Signal()
+        self.out      = ByteStream()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        # Each entry is a byte, its last bit, the flags and nb
+        m.submodules.fifo = fifo = SyncFIFOBuffered(width=8 + 1 + 4 + 5, depth=2 * self.pkt_size)
+
+        flags = Signal(4)
+        held  = Signal()
+        byte  = Signal(8)
+
+        m.d.comb += self.o_ready.eq(fifo.level <= self.pkt_size)
+
+        with m.If(self.i_start):
+            m.d.sync += flags.eq(self.i_flags)
+
+        with m.If(self.i_byte_valid):
+            m.d.sync += [
+                byte.eq(self.i_byte),
+                held.eq(1)
+            ]
+            with m.If(held):
+                m.d.comb += [
+                    fifo.w_en.eq(1),
+                    fifo.w_data.eq(Cat(byte, C(0, 1), flags, C(0, 5)))
+                ]
+
+        with m.If(self.i_end):
+            m.d.sync += held.eq(0)
+            m.d.comb += [
+                fifo.w_en.eq(1),
+                fifo.w_data.eq(Cat(Mux(held, byte, 0), C(1, 1), flags, Mux(held, self.i_nb, 0)))
+            ]
+
+        m.d.comb += [
+            self.out.data.eq(fifo.r_data[:8]),
+            self.out.last.eq(fifo.r_data[8]),
+            self.out.flags.eq(fifo.r_data[9:13]),
+            self.out.nb.eq(fifo.r_data[13:]),
+            self.out.valid.eq(fifo.r_rdy),
+            fifo.r_en.eq(self.out.ready)
+        ]
+
+        return m
+
+class StreamToPacket(Elaboratable):
+    """
+    Adapter from a byte stream to the packets a tx peripheral offers the dispatcher. A packet ends at the last byte
+    of the stream's packet, or when it is full.
+    """
+    def __init__(self, pkt_size=16):
+        # Parameters
+        self.pkt_size = pkt_size
+
+        # Inputs
+        self.i_ack    = Signal()
+        self.inp      = ByteStream()
+
+        # Outputs
+        self.o_valid  = Signal()
+        self.o_pkt    = Signal(pkt_size * 8)
+        self.o_nb     = Signal(5)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        nb = Signal(range(self.pkt_size + 1))
+
+        # Bytes are not taken while the packet is being acked
+        m.d.comb += self.inp.ready.eq(~self.o_valid & ~self.i_ack)
+
+        # The data is sent from the top of the packet
+        with m.If(self.inp.valid & self.inp.ready):
+            m.d.sync += [
+                self.o_pkt.word_select(self.pkt_size - 1 - nb, 8).eq(self.inp.data),
+                nb.eq(nb + 1)
+            ]
+            with m.If(self.inp.last | (nb == self.pkt_size - 1)):
+                m.d.sync += [
+                    self.o_valid.eq(1),
+                    self.o_nb.eq(nb + 1),
+                    nb.eq(0)
+                ]
+
+        with m.If(self.i_ack):
+            m.d.sync += self.o_valid.eq(0)
+
+        return m
+
+class StreamPeriph(Elaboratable):
+    """
+    The base of peripherals with byte streams. Subclasses take the bytes received from rx, and put the bytes
+    to send on tx, in their elaborate, which starts with the module that super().elaborate returns.
+    With stream set, it is registered with the dispatcher with stream=True, and the bytes come through StreamRx,
+    and otherwise the packets are passed to it in the usual way, through PacketToStream.
+    Packets to send go to the dispatcher through StreamToPacket.
+    """
+    def __init__(self, pkt_size=16, stream=False):
+        # Parameters
+        self.pkt_size = pkt_size
+        self.stream   = stream      # Register with the dispatcher with stream=True
+
+        # Inputs
+        self.i_pkt    = Signal(self.pkt_size * 8)
+        self.i_valid  = Signal()
+        self.i_ack    = Signal()
+        self.i_nb     = Signal(4)
+        self.i_flags  = Signal(4)
+
+        # Stream inputs, when stream is set
+        self.i_start      = Signal()
+        self.i_byte       = Signal(8)
+        self.i_byte_valid = Signal()
+        self.i_end        = Signal()
+
+        # Outputs
+        self.o_ready  = Signal()
+        self.o_valid  = Signal()
+        self.o_pkt    = Signal(pkt_size * 8)
+        self.o_nb     = Signal(5)
+
+        # The streams of the bytes received and to send
+        self.rx       = ByteStream()
+        self.tx       = ByteStream()
+
+        self.led      = Signal(8)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        if self.stream:
+            m.submodules.rx = rx = StreamRx(self.pkt_size)
+            m.d.comb += [
+                rx.i_start.eq(self.i_start),
+                rx.i_byte.eq(self.i_byte),
+                rx.i_byte_valid.eq(self.i_byte_valid),
+                rx.i_end.eq(self.i_end)
+            ]
+        else:
+            m.submodules.rx = rx = PacketToStream(self.pkt_size)
+            m.d.comb += [
+                rx.i_pkt.eq(self.i_pkt),
+                rx.i_valid.eq(self.i_valid)
+            ]
+        m.d.comb += [
+            rx.i_nb.eq(self.i_nb),
+            rx.i_flags.eq(self.i_flags),
+            self.o_ready.eq(rx.o_ready),
+            self.rx.data.eq(rx.out.data),
+            self.rx.valid.eq(rx.out.valid),
+            self.rx.last.eq(rx.out.last),
+            self.rx.flags.eq(rx.out.flags),
+            self.rx.nb.eq(rx.out.nb),
+            rx.out.ready.eq(self.rx.ready)
+        ]
+
+        m.submodules.tx = tx = StreamToPacket(self.pkt_size)
+        m.d.comb += [
+            tx.inp.data.eq(self.tx.data),
+            tx.inp.valid.eq(self.tx.valid),
+            tx.inp.last.eq(self.tx.last),
+            self.tx.ready.eq(tx.inp.ready),
+            tx.i_ack.eq(self.i_ack),
+            self.o_valid.eq(tx.o_valid),
+            self.o_pkt.eq(tx.o_pkt),
+            self.o_nb.eq(tx.o_nb)
+        ]
+
+        return m
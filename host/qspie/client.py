@@ -0,0 +1,422 @@
+import asyncio
+from collections import deque
+
+from qspie.protocol import (OK_TO_SEND, NACK, NOT_READY, BURST_CMD, STATUS_CMD, READ_CMD, ACK_CMD,
+                            crc_bytes, crc_ok, header, parse_event, parse_merged, packet, status_size,
+                            parse_status, returned, dropped)
+from qspie.sar import Reassembler, segments
+
+# The number of times a status read is tried before it fails
+STATUS_TRIES = 8
+
+class Channel:
+    """
+    The client's channel to one peripheral. Packets the peripheral sends go to the requests waiting for them,
+    in order, and otherwise are queued for read. Writes to a stream channel are batched, so small writes made
+    while the link is busy go as full packets, or as bursts of as many packets as the peripheral can take.
+
+    A peripheral that sends back a packet, such as a BramPeriph, does not take another until that one has been
+    read, and the dispatcher waits for it, so at most window requests are outstanding, and writes wait while
+    there are that many. The window is 1, plus the depth of any rx fifo.
+    """
+    def __init__(self, client, periph, stream=False, window=1):
+        self.client  = client
+        self.periph  = periph
+        self.stream  = stream
+        self.queue   = asyncio.Queue()
+        self.waiting = deque()              # The futures of requests waiting for a packet
+        self.slots   = asyncio.Semaphore(window)
+        self.reasm   = Reassembler()
+
+    async def write(self, data, flags=0):
+        """ Write data to the peripheral, and return when it has been sent """
+        await self.slots.acquire()
+        self.slots.release()
+        await self.client.write(self.periph, data, flags, self.stream)
+
+    async def read(self):
+        """ The next packet from the peripheral """
+        return await self.queue.get()
+
+    async def request(self, data, flags=0):
+        """ Write data, and return the packet the peripheral sends back. Requests can be concurrent. """
+        async with self.slots:
+            fut = asyncio.get_event_loop().create_future()
+            self.waiting.append(fut)
+            await self.client.write(self.periph, data, flags, self.stream)
+            return await fut
+
+    async def send_message(self, data, flags=0):
+        """
+        Write a message of any length, as packets marked with the SAR flags (see qspie/sar.py), which are queued
+        together, and return when they have all been sent
+        """
+        await asyncio.gather(*[self.write(seg, f) for f, seg in segments(data, self.client.room, flags)])
+
+    async def read_message(self):
+        """ The next message from the peripheral, reassembled from its packets """
+        while True:
+            msg = self.reasm.push((await self.read()).data)
+            if msg is not None:
+                return msg
+
+    def deliver(self, pkt):
+        while self.waiting:
+            fut = self.waiting.popleft()
+            if not fut.done():
+                fut.set_result(pkt)
+                return
+        self.queue.put_nowait(pkt)
+
+class _Write:
+    """ Bytes queued for a peripheral, and the futures of the writes they came from """
+    __slots__ = ["periph", "flags", "data", "stream", "futures"]
+
+    def __init__(self, periph, flags, data, stream):
+        self.periph  = periph
+        self.flags   = flags
+        self.data    = bytearray(data)
+        self.stream  = stream
+        self.futures = []
+
+class Client:
+    """
+    Asyncio client for the QSPIE protocol. The options must be the ones the dispatcher was built with, and
+    rx_depth gives the depth of the rx fifo of each rx peripheral that has one, as a dict, for credits,
+    the windows of channels and the length of bursts.
+
+    A single link task makes all the transactions. It reads the packets the ice40 has while QDIR is high,
+    and passes them to their channels, and otherwise sends the writes that have been queued. With credits,
+    writes go back to back while there are credits for them, so there are many outstanding, and other
+    peripherals' writes go on while one is waiting for credits. When the ice40 is not ready, it backs off,
+    from backoff[0] seconds, doubling up to backoff[1].
+    """
+    def __init__(self, transport, pkt_size=16, num_periphs=15, merged_tx=False, credits=False, burst=False,
+                 ext_addr=False, crc=0, timestamps=False, rx_depth=None, backoff=(1e-6, 1e-3), poll=1e-3):
+        self.transport   = transport
+        self.pkt_size    = pkt_size
+        self.num_periphs = num_periphs
+        self.merged_tx   = merged_tx or credits
+        self.credits     = credits
+        self.burst       = burst
+        self.ext_addr    = ext_addr
+        self.crc         = crc
+        self.backoff     = backoff
+        self.rx_depth    = rx_depth or {}
+        self.poll        = poll                 # Seconds to wait for QDIR at a time, when idle
+
+        self.hb   = 2 if ext_addr else 1
+        self.cb   = crc // 8
+        self.tb   = 4 if timestamps else 0
+        self.room = pkt_size - self.hb
+
+        # The credits left for each RX peripheral, and the last count of packets taken read from the status
+        self.credit = [0] * num_periphs
+        self.taken  = [0] * num_periphs
+        for i, d in self.rx_depth.items():
+            self.credit[i] = d
+
+        # With credits and a CRC, the packets sent since the status was last read, to send again if they were dropped
+        self.unchecked = []
+        self.seq       = 0
+
+        # The last packet sent, to send again after a NACK
+        self.last = None
+
+        self.channels = {}
+        self.writes   = deque()
+        self.statuses = []                  # The futures of status reads
+        self.wake     = asyncio.Event()
+        self.task     = None
+        self.closing  = False
+
+        # Counts
+        self.sent       = 0
+        self.bursts     = 0
+        self.received   = 0
+        self.reread     = 0                 # Packets read again after a bad CRC
+        self.not_ready  = 0
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.link())
+
+    async def close(self):
+        """ Send the writes that are queued, and stop the link task """
+        self.closing = True
+        self.wake.set()
+        await self.task
+        await self.transport.close()
+
+    def channel(self, periph, stream=False, window=None):
+        if periph not in self.channels:
+            if window is None:
+                window = 1 + self.rx_depth.get(periph, 0)
+            self.channels[periph] = Channel(self, periph, stream, window)
+        return self.channels[periph]
+
+    async def read_status(self):
+        """ Read the status, between the link task's other transactions, and return it as a dict """
+        fut = asyncio.get_event_loop().create_future()
+        self.statuses.append(fut)
+        self.wake.set()
+        return await fut
+
+    async def write(self, periph, data, flags=0, stream=False):
+        """ Queue data for periph, and return when it has been sent """
+        assert stream or len(data) <= self.room
+        fut = asyncio.get_event_loop().create_future()
+        last = self.writes[-1] if self.writes else None
+        if stream and last is not None and last.stream and last.periph == periph and last.flags == flags:
+            last.data += data
+        else:
+            last = _Write(periph, flags, data, stream)
+            self.writes.append(last)
+        last.futures.append(fut)
+        self.wake.set()
+        await fut
+
+    # The link task
+
+    async def link(self):
+        try:
+            delay = self.backoff[0]
+            tries = 0
+            while True:
+                if await self.transport.qdir():
+                    self.deliver((await self.read_packet()))
+                    continue
+                # Status reads that were given up on are dropped
+                self.statuses = [f for f in self.statuses if not f.done()]
+                if self.statuses:
+                    # A status read can be preempted by a packet to send, or fail its CRC, so it is tried again,
+                    # a few times
+                    st = await self.status()
+                    tries = 0 if st is not None else tries + 1
+                    if st is not None or tries == STATUS_TRIES:
+                        for fut in self.statuses:
+                            if st is not None:
+                                fut.set_result(st)
+                            else:
+                                fut.set_exception(IOError("status read failed"))
+                        self.statuses = []
+                        tries = 0
+                    continue
+                w = self.next_write()
+                if w is not None:
+                    await self.send_write(w)
+                    delay = self.backoff[0]
+                    continue
+                if self.writes:
+                    # With credits, every write queued is waiting for credits, so read the status
+                    # to see which have been taken, and back off if none have
+                    await self.status()
+                    if self.next_write() is None:
+                        self.not_ready += 1
+                        await self.transport.sleep(delay)
+                        delay = min(delay * 2, self.backoff[1])
+                    continue
+                if self.closing:
+                    return
+                await self.idle()
+        except Exception as e:
+            for fut in [f for w in self.writes for f in w.futures] + self.statuses:
+                if not fut.done():
+                    fut.set_exception(e)
+            raise
+
+    async def idle(self):
+        """ Wait for QDIR, or a new write """
+        self.wake.clear()
+        wake = asyncio.ensure_future(self.wake.wait())
+        qdir = asyncio.ensure_future(self.transport.wait(self.poll))
+        await asyncio.wait([wake, qdir], return_when=asyncio.FIRST_COMPLETED)
+        wake.cancel()
+        qdir.cancel()
+
+    def deliver(self, pkt):
+        if pkt is not None:
+            self.received += 1
+            self.channel(pkt.periph).deliver(pkt)
+
+    def next_write(self):
+        """ The first write that can be sent, which is the first queued, unless credits are short """
+        if not self.credits:
+            return self.writes[0] if self.writes else None
+        blocked = set()
+        for w in self.writes:
+            if w.periph not in blocked and self.credit[w.periph] > 0:
+                return w
+            # Writes to a peripheral stay in order
+            blocked.add(w.periph)
+        return None
+
+    def burst_room(self, periph):
+        """
+        The most bytes a burst to periph can carry. The dispatcher drops the packets of a burst the peripheral
+        does not take in time, so there must be credits for them all, or without credits, room for them all
+        in the peripheral's rx fifo.
+        """
+        return self.room * (self.credit[periph] if self.credits else self.rx_depth.get(periph, 0))
+
+    async def send_write(self, w):
+        # A stream's bytes go as a burst, when there is more than a packet of them that can go in one, or as a packet
+        n = min(len(w.data), self.burst_room(w.periph))
+        if self.burst and w.stream and n > self.room:
+            await self.send_burst(w.periph, w.flags, bytes(w.data[:n]))
+        else:
+            n = min(len(w.data), self.room)
+            await self.send(w.periph, self.with_crc(header(w.periph, w.flags, self.ext_addr) + bytes(w.data[:n])))
+        del w.data[:n]
+        if not w.data:
+            self.writes.remove(w)
+            for fut in w.futures:
+                if not fut.done():
+                    fut.set_result(None)
+
+    # Transactions
+
+    async def txn(self, data=b"", n=0, cmd=None):
+        """ A transaction that sends data, or reads n bytes, after a command and a dummy byte if cmd is set """
+        if cmd is not None:
+            data = bytes([cmd, 0]) + bytes(data)
+        return await self.transport.transaction(bytes(data), n)
+
+    def with_crc(self, data):
+        return bytes(data) + crc_bytes(data, self.crc)
+
+    async def status(self):
+        """
+        Read the status, and return it as a dict. Credits are updated, and with a CRC, packets that
+        were dropped are sent again. Without credits, the reply before it is in `reply`.
+        """
+        n = status_size(self.num_periphs, self.credits, self.crc, self.tb)
+        if self.credits:
+            r = await self.txn(cmd=STATUS_CMD, n=n + self.cb)
+        else:
+            await self.drain()
+            r = await self.txn(n=self.hb + n + self.cb)
+            if r[0] < OK_TO_SEND:
+                # The ice40 had a packet to send first, so this was not the status
+                await self.event_reply(r)
+                return None
+        st = parse_status(r, self.num_periphs, self.credits, self.ext_addr, self.crc, self.tb)
+        if st is None:
+            return None
+        if self.credits:
+            for i, c in enumerate(returned(self.taken, st["taken"])):
+                self.credit[i] += c
+        if "errs" in st:
+            await self.resend(st["seq"], st["errs"])
+        return st
+
+    async def resend(self, seq, errs):
+        # The packets that were dropped did not use up a credit
+        drops = dropped(self.unchecked, seq, errs)
+        self.unchecked = []
+        for periph, pkt in drops:
+            self.credit[periph] += 1
+        for periph, pkt in drops:
+            await self.send(periph, pkt)
+
+    # Writes
+
+    async def drain(self):
+        """ Read the packets the ice40 has to send, while QDIR is high """
+        while await self.transport.qdir():
+            self.deliver((await self.read_packet()))
+
+    async def event_reply(self, r):
+        """
+        Without credits, the reply r to a read that asked if it was OK to send was an event, as the ice40
+        had a packet to send first. Without merged reads, the data is read next. With them, the read got
+        the packet if it was long enough, and otherwise it is sent again.
+        """
+        if not self.merged_tx:
+            self.deliver((await self.read_packet(r[:self.hb])))
+        else:
+            pkt = parse_merged(r, self.pkt_size, self.ext_addr, self.tb, self.crc)
+            if pkt is not None:
+                self.deliver(pkt)
+
+    async def ok_to_send(self):
+        """ Without credits, ask if it is OK to send until it is, backing off while the ice40 is not ready """
+        delay = self.backoff[0]
+        while True:
+            await self.drain()
+            r = await self.txn(n=self.hb)
+            if r[0] == OK_TO_SEND:
+                return
+            elif r[0] == NACK:
+                # The last packet had a bad CRC, and the ice40 is waiting for it again
+                await self.txn(self.last)
+            elif r[0] == NOT_READY:
+                self.not_ready += 1
+                await self.transport.sleep(delay)
+                delay = min(delay * 2, self.backoff[1])
+            elif r[0] < OK_TO_SEND:
+                await self.event_reply(r)
+
+    async def send(self, periph, pkt):
+        """ Send a whole packet, with its header and any CRC. With credits, there must be one for it. """
+        if self.credits:
+            if self.cb:
+                # rx_errs only covers the last 8 packets, so the status is read before more are unchecked,
+                # and any that were dropped are sent first
+                while len(self.unchecked) >= 8:
+                    await self.status()
+            self.credit[periph] -= 1
+            if self.cb:
+                self.unchecked.append((self.seq, periph, pkt))
+                self.seq = (self.seq + 1) & 0xFF
+        else:
+            await self.ok_to_send()
+            self.last = pkt
+        await self.txn(pkt)
+        self.sent += 1
+
+    async def send_burst(self, periph, flags, data):
+        """ Write any number of bytes to an RX peripheral in a single transaction """
+        if self.credits:
+            self.credit[periph] -= -(-len(data) // self.room)
+        else:
+            await self.ok_to_send()
+        await self.txn(bytes([BURST_CMD]) + header(periph, flags, self.ext_addr) + data)
+        self.sent   += 1
+        self.bursts += 1
+
+    # Reads
+
+    async def read_packet(self, ev=None):
+        """
+        Read the packet the ice40 has to send, when QDIR is high. ev is the event, when the
+        reply to an OK-TO-SEND read was one, which has already read it.
+        With a CRC, the packet is read again until its CRC is right.
+        """
+        while True:
+            if self.merged_tx:
+                # The event and the data in one read, as long as the longest packet
+                r = await self.txn(n=self.hb + self.pkt_size + self.tb + self.cb,
+                                   cmd=READ_CMD if self.credits else None)
+                pkt = parse_merged(r, self.pkt_size, self.ext_addr, self.tb, self.crc)
+            else:
+                # The event, and then the data in a second read
+                if ev is None:
+                    ev = await self.txn(n=self.hb)
+                periph, nb = parse_event(ev, self.pkt_size, self.ext_addr)
+                data = await self.txn(n=nb + self.tb + self.cb)
+                pkt = packet(periph, nb, data, self.tb) if crc_ok(data, self.crc) else None
+            if pkt is not None:
+                break
+            self.reread += 1
+        # The packet is kept until it is acked, with the ack command with credits, and otherwise with
+        # a read of a single byte
+        if self.cb:
+            await self.txn(bytes([ACK_CMD]) if self.credits else b"", 0 if self.credits else 1)
+        return pkt
@@ -0,0 +1,672 @@
+from collections import deque
+
+from qspie.protocol import (OK_TO_SEND, NACK, NOT_READY, BURST_CMD, STATUS_CMD, READ_CMD, ACK_CMD,
+                            SAR_FIRST, SAR_LAST, crc, crc_bytes, event)
+
+# Transaction-level model of the ice40 side of QSPIE: the dispatcher in gateware/dispatcher.py, and models of
+# the stock peripherals. A transaction is the bytes the STM32 clocks out while csn is low, and the model
+# returns the bytes it would have read. Time is counted in system clock cycles, and a transaction takes as long
+# as it would on the link, so that peripherals can be busy, and replies can be NOT_READY, as they are in the RTL.
+#
+# Between transactions, everything the dispatcher would have done by the time the next one starts has been done.
+# As in the RTL, the dispatcher sees csn change CSN_DELAY cycles after it does, through its synchronizer, so a
+# packet that a peripheral has to send just before a transaction starts can be sent first, though QDIR was low.
+# Pools, timestamps and double data rate are not modelled.
+
+# The cycles the dispatcher takes to see csn change, and that a packet takes to get through a fifo
+CSN_DELAY    = 2
+FIFO_LATENCY = 2
+
+class Periph:
+    """ The base of the peripheral models. Times are in system clock cycles. """
+    def __init__(self, pkt_size=16):
+        self.pkt_size = pkt_size
+
+    def ready_at(self):
+        """ The time from which a packet can be put, or None until the packet to send has been acked """
+        return 0
+
+    def put(self, t, flags, data):
+        """ Take a packet of data, at time t """
+
+    def valid_at(self):
+        """ The time from which there is a packet to send, or None """
+        return None
+
+    def packet(self):
+        """ The packet to send """
+        return None
+
+    def ack(self, t):
+        """ The packet to send has been taken, at time t """
+
+class Led(Periph):
+    """ Model of periph/led.py, which shows the last byte of each packet """
+    def __init__(self, pkt_size=16):
+        super().__init__(pkt_size)
+        self.led = 0
+
+    def put(self, t, flags, data):
+        if data:
+            self.led = data[-1]
+
+class LCD(Periph):
+    """ Model of periph/lcd.py, a text buffer that holds up to the last 15 bytes of each packet """
+    def __init__(self, pkt_size=16):
+        super().__init__(pkt_size)
+        self.text = b""
+
+    def put(self, t, flags, data):
+        self.text = bytes(data[-(self.pkt_size - 1):])
+
+class Loopback(Periph):
+    """ Model of periph/loopback.py, which sends back the packets it receives """
+    def __init__(self, pkt_size=16):
+        super().__init__(pkt_size)
+        self.out     = None
+        self.out_at  = 0
+        self.free_at = 0
+        self.led     = 0
+
+    def ready_at(self):
+        return None if self.out is not None else self.free_at
+
+    def put(self, t, flags, data):
+        self.out    = bytes(data)
+        self.out_at = t + 1
+        if data:
+            self.led = data[-1]
+
+    def valid_at(self):
+        return None if self.out is None else self.out_at
+
+    def packet(self):
+        return self.out
+
+    def ack(self, t):
+        self.out     = None
+        self.free_at = t + 1
+
+class BramPeriph(Periph):
+    """
+    Model of periph/bram_periph.py. A packet with flags 1 writes the bytes after a 2-byte address, and one with
+    flags 0 reads the number of bytes in the byte after the address, which are sent back. For streaming, one with
+    flags 2 sets the stream address, and with a 2-byte length after it, that many bytes are sent back from it, in
+    full packets, and every byte of one with flags 3 is written at the stream address, which is incremented.
+    The memory is width bits wide, and a word is read or written a cycle.
+    """
+    def __init__(self, pkt_size=16, depth=4096, width=8):
+        super().__init__(pkt_size)
+        self.depth   = depth
+        self.bw      = width // 8
+        self.mem     = bytearray(depth)
+        self.out     = None
+        self.out_at  = 0
+        self.free_at = 0
+        self.s_addr  = 0
+        self.s_left  = 0
+
+    def ready_at(self):
+        return None if self.out is not None else self.free_at
+
+    def _cycles(self, addr, n):
+        """ The cycles to read or write n bytes from addr, which is the number of words they are in """
+        return (addr % self.bw + n + self.bw - 1) // self.bw if n else 0
+
+    def _stream(self, t):
+        # The next packet streamed back, which is read at a byte a cycle
+        if self.out is None and self.s_left:
+            n = min(self.s_left, self.pkt_size)
+            self.out    = bytes(self.mem[(self.s_addr + k) % self.depth] for k in range(n))
+            self.out_at = t + 2 + self._cycles(self.s_addr, n)
+            self.s_addr = (self.s_addr + n) & 0xFFFF
+            self.s_left -= n
+
+    def put(self, t, flags, data):
+        if flags & 2:
+            if flags & 1:
+                for k, b in enumerate(data):
+                    self.mem[(self.s_addr + k) % self.depth] = b
+                self.free_at = t + 1 + self._cycles(self.s_addr, len(data))
+                self.s_addr  = (self.s_addr + len(data)) & 0xFFFF
+            else:
+                self.s_addr  = int.from_bytes(bytes(data[:2]), "big")
+                self.s_left  = int.from_bytes(bytes(data[2:4]), "big") if len(data) >= 4 else 0
+                self.free_at = t + 1
+                self._stream(t + 1)
+            return
+        addr = int.from_bytes(bytes(data[:2]), "big") % self.depth
+        if flags & 1:
+            for k, b in enumerate(data[2:]):
+                self.mem[(addr + k) % self.depth] = b
+            self.free_at = t + 1 + self._cycles(addr, max(len(data) - 2, 0))
+        else:
+            n = data[-1] if data else 0
+            if n:
+                self.out    = bytes(self.mem[(addr + k) % self.depth] for k in range(n))
+                self.out_at = t + 2 + self._cycles(addr, n)
+            else:
+                self.free_at = t + 1
+
+    def valid_at(self):
+        return None if self.out is None else self.out_at
+
+    def packet(self):
+        return self.out
+
+    def ack(self, t):
+        self.out     = None
+        self.free_at = t + 1
+        self._stream(t + 1)
+
+class UartLoopback(Periph):
+    """
+    Model of periph/uart.py with its TX pin wired to its RX pin. The bytes of each packet are sent at
+    byte_cycles per byte, and each one received is sent back as a packet of 1 byte. The uart holds one byte
+    received while the last one is waiting to be sent, and drops any more, counting them in overruns.
+    """
+    def __init__(self, pkt_size=16, byte_cycles=10 * 434):
+        super().__init__(pkt_size)
+        self.byte_cycles = byte_cycles
+        self.free_at  = 0
+        self.arrivals = deque()             # The bytes being sent, and when they are received
+        self.out      = None
+        self.out_at   = 0
+        self.hold     = None
+        self.overruns = 0
+
+    def ready_at(self):
+        return self.free_at
+
+    def put(self, t, flags, data):
+        start = max(t + 1, self.arrivals[-1][0] if self.arrivals else 0)
+        for k, b in enumerate(data):
+            self.arrivals.append((start + (k + 1) * self.byte_cycles, b))
+        # Ready when the last byte has been passed to the transmitter
+        self.free_at = start + max(len(data) - 1, 0) * self.byte_cycles
+
+    def _receive(self, t):
+        # Bytes received while the last one is waiting to be sent
+        while self.arrivals and self.arrivals[0][0] <= t:
+            _, b = self.arrivals.popleft()
+            if self.hold is None:
+                self.hold = b
+            else:
+                self.overruns += 1
+
+    def valid_at(self):
+        if self.out is not None:
+            return self.out_at
+        if self.arrivals:
+            return self.arrivals[0][0] + 1
+        return None
+
+    def packet(self):
+        if self.out is None and self.arrivals:
+            t, b = self.arrivals.popleft()
+            self.out, self.out_at = bytes([b]), t + 1
+        return self.out
+
+    def ack(self, t):
+        self._receive(t)
+        self.out = None
+        if self.hold is not None:
+            self.out, self.out_at, self.hold = bytes([self.hold]), t + 1, None
+
+class MessageLoopback(Periph):
+    """
+    Model of periph/message_loopback.py, which sends back the messages it receives, as segments of up to
+    pkt_size - 1 bytes, each followed by a trailer with the SAR flags, as soon as each is full, or the message
+    has ended. Packets that are out of order are counted in errors, and their bytes are still sent back.
+    """
+    def __init__(self, pkt_size=16):
+        super().__init__(pkt_size)
+        self.pending = bytearray()          # The bytes of the segment being sent back
+        self.in_msg  = False
+        self.first   = True
+        self.out     = deque()              # (time, packet)
+        self.free_at = 0
+        self.errors  = 0
+
+    def ready_at(self):
+        # A packet is taken while one is waiting to be sent, as its bytes have gone through, and the next ones are
+        # held in the adapters until it has been acked
+        return None if len(self.out) > 1 else self.free_at
+
+    def put(self, t, flags, data):
+        final = flags & SAR_LAST
+        if bool(flags & SAR_FIRST) == self.in_msg:
+            self.errors += 1
+        self.in_msg = not final
+        # Packets with no data are dropped, and so is a message with none
+        if not data:
+            self.free_at = t + 1
+            return
+        self.pending += data
+        seg = self.pkt_size - 1
+        while len(self.pending) >= seg or (final and self.pending):
+            last = final and len(self.pending) <= seg
+            trailer = (SAR_FIRST if self.first else 0) | (SAR_LAST if last else 0)
+            self.out.append((t + 2 + len(data), bytes(self.pending[:seg]) + bytes([trailer])))
+            del self.pending[:seg]
+            self.first = last
+        self.free_at = t + 1 + len(data)
+
+    def valid_at(self):
+        return self.out[0][0] if self.out else None
+
+    def packet(self):
+        return self.out[0][1] if self.out else None
+
+    def ack(self, t):
+        self.out.popleft()
+        self.free_at = max(self.free_at, t + 1)
+
+class Dispatcher:
+    """ Transaction-level model of gateware/dispatcher.py, with the same parameters """
+    def __init__(self, pkt_size=16, num_periphs=15, qw=4, half=5, burst=False, merged_tx=False,
+                 rx_fifo_depth=0, tx_fifo_depth=0, arbiter="priority", credits=False, ext_addr=False, crc=0):
+        assert num_periphs <= (240 if ext_addr else 15)
+        assert qw in (1, 2, 4, 8)
+        assert arbiter in ("priority", "round_robin", "weighted")
+        assert crc in (0, 8, 16) and not (crc and burst)
+
+        # Parameters
+        self.pkt_size      = pkt_size
+        self.num_periphs   = num_periphs
+        self.qw            = qw
+        self.half          = half                 # System clock cycles per half SCLK period
+        self.burst         = burst
+        self.merged_tx     = merged_tx or credits
+        self.rx_fifo_depth = rx_fifo_depth
+        self.tx_fifo_depth = tx_fifo_depth
+        self.arbiter       = arbiter
+        self.credits       = credits
+        self.ext_addr      = ext_addr
+        self.crc           = crc
+
+        self.hb      = 2 if ext_addr else 1
+        self.cb      = crc // 8
+        self.bm      = max(16, (num_periphs + 7) // 8 * 8) // 8
+        self.tx_size = pkt_size + (self.hb if self.merged_tx else 0)
+
+        # Peripherals
+        self.periph    = [None] * num_periphs
+        self.rx_periph = [None] * num_periphs
+        self.tx_periph = [None] * num_periphs
+        self.rx_depth  = [0] * num_periphs
+        self.tx_depth  = [0] * num_periphs
+        self.weight    = [1] * num_periphs
+        self.rx_fifo   = [deque() for _ in range(num_periphs)]   # (time, flags, data)
+        self.tx_fifo   = [deque() for _ in range(num_periphs)]   # (time, data)
+        self.rx_fifos  = []                                       # The ids with rx fifos, rx and tx peripherals, and tx fifos
+        self.rx_ids    = []
+        self.tx_ids    = []
+        self.tx_fifos  = []
+
+        # State
+        self.now           = 0
+        self.state         = "IDLE"
+        self.tx_pkt        = bytearray(self.tx_size)
+        self.tx_len        = 0
+        self.tx_full       = False
+        self.tx_sent       = False
+        self.use_stat      = False
+        self.qdir          = False
+        self.periph_ev     = 0
+        self.pending       = None                 # The packet received that is waiting for its peripheral
+        self.pending_at    = 0
+        self.rx_nack       = False
+        self.rx_seq        = 0
+        self.rx_errs       = 0
+        self.credit_count  = [0] * num_periphs
+        self.burst_overrun = False
+        self.ptr           = 0                    # The arbiter's pointer, and the grants left for it
+        self.left          = 1
+
+        self.reply(OK_TO_SEND)
+
+    def register(self, i, mod, rx, tx, rx_fifo_depth=None, tx_fifo_depth=None, weight=1):
+        self.periph[i] = mod
+        if rx:
+            self.rx_periph[i] = mod
+            self.rx_depth[i] = self.rx_fifo_depth if rx_fifo_depth is None else rx_fifo_depth
+            self.rx_ids.append(i)
+            if self.rx_depth[i] > 0:
+                self.rx_fifos.append(i)
+        if tx:
+            self.tx_periph[i] = mod
+            self.tx_depth[i] = self.tx_fifo_depth if tx_fifo_depth is None else tx_fifo_depth
+            self.weight[i] = weight
+            self.tx_ids.append(i)
+            if self.tx_depth[i] > 0:
+                self.tx_fifos.append(i)
+        if i == 0:
+            self.left = weight
+        if self.credits and rx:
+            assert self.rx_depth[i] > 0, "credits need rx fifos"
+
+    # Sources and sinks, and the arbiter
+
+    def src_valid_at(self, i):
+        if self.tx_depth[i] > 0:
+            return self.tx_fifo[i][0][0] if self.tx_fifo[i] else None
+        return self.tx_periph[i].valid_at()
+
+    def src_packet(self, i):
+        if self.tx_depth[i] > 0:
+            return self.tx_fifo[i][0][1]
+        return self.tx_periph[i].packet()
+
+    def src_ack(self, i, t):
+        if self.tx_depth[i] > 0:
+            self.tx_fifo[i].popleft()
+        else:
+            self.tx_periph[i].ack(t)
+
+    def rx_ready_at(self, i):
+        """ The time from which rx peripheral i, or its fifo, can take a packet, or None """
+        p = self.rx_periph[i] if 0 <= i < self.num_periphs else None
+        if p is None:
+            return None
+        if self.rx_depth[i] > 0:
+            return 0 if len(self.rx_fifo[i]) < self.rx_depth[i] else None
+        return p.ready_at()
+
+    def rx_put(self, i, t, flags, data):
+        if self.rx_depth[i] > 0:
+            self.rx_fifo[i].append((t, flags, data))
+        else:
+            self.rx_periph[i].put(t, flags, data)
+
+    def grant(self, t):
+        """ The tx peripheral with a packet to send at time t that the arbiter chooses, or None """
+        first = 0 if self.arbiter == "priority" else self.ptr
+        for k in range(self.num_periphs):
+            i = (first + k) % self.num_periphs
+            if self.tx_periph[i] is not None:
+                v = self.src_valid_at(i)
+                if v is not None and v <= t:
+                    break
+        else:
+            return None
+        if self.arbiter != "priority":
+            grants = self.left if i == self.ptr else self.weight[i]
+            if grants > 1:
+                self.ptr, self.left = i, grants - 1
+            else:
+                self.ptr = 0 if i == self.num_periphs - 1 else i + 1
+                self.left = self.weight[self.ptr]
+        return i
+
+    # Dispatcher actions, as in the RTL
+
+    def reply(self, r):
+        if not self.credits:
+            self.tx_pkt[:self.hb] = bytes([r]) + bytes(self.hb - 1)
+            self.use_stat = True
+
+    def tx_event(self, i, t):
+        self.periph_ev = i
+        self.qdir = True
+        data = self.src_packet(i)
+        nb = len(data) or self.pkt_size
+        if self.merged_tx:
+            self.tx_pkt = bytearray(event(i, nb, self.ext_addr) + bytes(data).ljust(self.pkt_size, b"\0"))
+            self.tx_len = self.hb + nb
+            self.use_stat = False
+            self.tx_full = True
+            self.src_ack(i, t)
+            if not self.credits:
+                self.state = "SEND_DATA"
+        else:
+            self.tx_pkt[:self.hb] = event(i, nb, self.ext_addr)
+            self.tx_len = nb
+            self.use_stat = True
+            self.state = "SEND_EVENT"
+
+    def tx_done(self, t):
+        self.reply(OK_TO_SEND)
+        self.qdir = False
+        self.tx_full = False
+        self.tx_sent = False
+        self.state = "IDLE"
+        i = self.periph_ev
+        if self.tx_periph[i] is not None and self.tx_depth[i] > 0:
+            v = self.src_valid_at(i)
+            if v is not None and v <= t:
+                self.tx_event(i, t)
+
+    def advance(self, t, in_txn=False):
+        """ Do everything that happens before time t. During a transaction, the dispatcher cannot send events. """
+        while True:
+            best = None
+            # Packets passed from rx fifos to their peripherals
+            for i in self.rx_fifos:
+                q = self.rx_fifo[i]
+                if q:
+                    r = self.rx_periph[i].ready_at()
+                    if r is not None:
+                        et = max(q[0][0] + FIFO_LATENCY, r)
+                        if best is None or et < best[0]:
+                            best = (et, "rx_fifo", i)
+            # Packets passed from tx peripherals to their fifos
+            for i in self.tx_fifos:
+                if len(self.tx_fifo[i]) < self.tx_depth[i]:
+                    v = self.tx_periph[i].valid_at()
+                    if v is not None and (best is None or v < best[0]):
+                        best = (v, "tx_fifo", i)
+            # The packet received being taken, in the RECEIVE_HANDSHAKE state, or during a burst
+            if self.state in ("RECEIVE_HANDSHAKE", "BURST_DATA") and (self.pending is not None or
+                                                                      self.state == "RECEIVE_HANDSHAKE"):
+                r = self.rx_ready_at(self.periph_ev)
+                if r is not None:
+                    et = max(self.pending_at, r)
+                    if best is None or et < best[0]:
+                        best = (et, "handshake", self.periph_ev)
+            # A packet to send, in the IDLE state
+            if not in_txn and self.state == "IDLE" and not self.tx_full and not self.rx_nack:
+                vs = [v for v in map(self.src_valid_at, self.tx_ids) if v is not None]
+                if vs:
+                    et = max(min(vs), self.now)
+                    if best is None or et < best[0]:
+                        best = (et, "arbiter", None)
+            if best is None or best[0] >= t:
+                break
+
+            et, kind, i = best
+            et = max(et, self.now)
+            if kind == "rx_fifo":
+                _, flags, data = self.rx_fifo[i].popleft()
+                self.rx_periph[i].put(et, flags, data)
+                self.credit_count[i] = (self.credit_count[i] + 1) & 0xFF
+            elif kind == "tx_fifo":
+                p = self.tx_periph[i]
+                self.tx_fifo[i].append((et + FIFO_LATENCY, p.packet()))
+                p.ack(et)
+            elif kind == "handshake":
+                if self.pending is not None:
+                    self.rx_put(i, et, *self.pending)
+                    self.pending = None
+                if self.state == "RECEIVE_HANDSHAKE":
+                    if in_txn:
+                        self.state = "WAIT_FOR_TXN"
+                    else:
+                        self.reply(OK_TO_SEND)
+                        self.state = "IDLE"
+            else:
+                g = self.grant(et)
+                if g is not None:
+                    self.tx_event(g, et)
+            self.now = et
+        self.now = max(self.now, t)
+
+    # Transactions
+
+    def status(self, t):
+        """ The status bytes, at time t """
+        pend = (1 << self.periph_ev) if self.qdir else 0
+        rdy = 0
+        for i in self.tx_ids:
+            v = self.src_valid_at(i)
+            if v is not None and v <= t:
+                pend |= 1 << i
+        for i in self.rx_ids:
+            r = self.rx_ready_at(i)
+            if r is not None and r <= t:
+                rdy |= 1 << i
+        st = pend.to_bytes(self.bm, "big") + rdy.to_bytes(self.bm, "big")
+        if self.credits:
+            st += bytes(self.credit_count)
+            if self.crc:
+                st += bytes([self.rx_seq, self.rx_errs])
+        else:
+            st = bytes(self.tx_pkt[:self.hb]) + st
+        return st
+
+    def stream(self, t, n):
+        """
+        The bytes sent when a read of n bytes starts at time t: the status, or the packet to send, and any CRC.
+        Without credits, a read of just the reply, which is most of them, does not need the status after it.
+        """
+        if self.use_stat and not self.credits and n <= self.hb:
+            return bytes(self.tx_pkt[:self.hb])
+        data = self.status(t) if self.use_stat else bytes(self.tx_pkt[:self.tx_len])
+        return data + crc_bytes(data, self.crc)
+
+    def byte_time(self):
+        return (8 // self.qw) * 2 * self.half
+
+    def receive(self, data, t):
+        """ A packet written by the STM32 has been received at time t, when csn went high """
+        cb, hb = self.cb, self.hb
+        ok = not self.crc or (len(data) >= hb + cb and crc(data, self.crc) == 0)
+        if self.credits and self.crc:
+            self.rx_seq = (self.rx_seq + 1) & 0xFF
+            self.rx_errs = ((self.rx_errs << 1) | (not ok)) & 0xFF
+        if ok:
+            i = data[0] if self.ext_addr else data[0] >> 4
+            flags = (data[1] if self.ext_addr else data[0]) & 0xF
+            self.periph_ev = i
+            self.pending = (flags, bytes(data[hb:len(data) - cb]))
+            self.pending_at = t + 1
+            self.reply(NOT_READY)
+            self.state = "RECEIVE_HANDSHAKE"
+        else:
+            if not self.credits:
+                self.rx_nack = True
+            self.reply(NACK)
+            self.state = "IDLE"
+
+    def receive_burst(self, data, t0):
+        """ A burst written by the STM32, in a transaction that started at t0, from the command byte at data[0] """
+        hb, room, bt = self.hb, self.pkt_size - self.hb, self.byte_time()
+        t_end = t0 + self.half * 2 + len(data) * bt
+        if len(data) < 1 + hb:
+            self.advance(t_end, True)
+            self.state = "IDLE"
+            return
+        hdr = data[1:1 + hb]
+        self.periph_ev = hdr[0] if self.ext_addr else hdr[0] >> 4
+        flags = hdr[-1] & 0xF
+        self.state = "BURST_DATA"
+        payload = data[1 + hb:]
+        chunks = [payload[k:k + room] for k in range(0, len(payload), room)]
+        for k, chunk in enumerate(chunks):
+            if len(chunk) < room:
+                break
+            t = t0 + self.half + (1 + hb + (k + 1) * room) * bt
+            self.advance(t, True)
+            if self.pending is None:
+                self.pending, self.pending_at = (flags, bytes(chunk)), t
+            else:
+                self.burst_overrun = True
+        self.advance(t_end, True)
+        if len(payload) % room:
+            if self.pending is None:
+                self.pending, self.pending_at = (flags, bytes(chunks[-1])), t_end + 1
+            else:
+                self.burst_overrun = True
+        self.reply(NOT_READY)
+        self.state = "RECEIVE_HANDSHAKE"
+
+    def transaction(self, data=b"", n=0):
+        """
+        A transaction that starts now, in which the STM32 clocks out the bytes of data, and then reads n bytes,
+        which are returned. With credits, reads clock out the command and a dummy byte first.
+        """
+        data = bytes(data)
+        t0 = self.now + CSN_DELAY
+        self.advance(t0)
+        total = len(data) + n
+        t_end = t0 + self.half * 2 + total * self.byte_time()
+
+        # What the dispatcher does when csn goes low, the bytes it sends, and the byte they start at
+        state, stream, skip = self.state, b"", 0
+        if self.credits and state == "IDLE":
+            cmd = data[0] if data else None
+            if cmd == STATUS_CMD or cmd == READ_CMD:
+                self.use_stat = cmd == STATUS_CMD
+                stream, skip = self.stream(t0, total), 2
+                state = "READ"
+            elif cmd == BURST_CMD and self.burst:
+                state = "BURST"
+            elif cmd == ACK_CMD and self.crc:
+                state = "ACK"
+            elif cmd is not None:
+                state = "RECEIVING"
+        elif state == "IDLE":
+            stream, state = self.stream(t0, total), "OK_TO_SEND"
+        elif state == "WAIT_STM_DATA":
+            state = "BURST" if self.burst and data[:1] == bytes([BURST_CMD]) else "RECEIVING"
+        elif state in ("RECEIVE_HANDSHAKE", "SEND_EVENT", "SEND_DATA"):
+            if not self.credits:
+                stream = self.stream(t0, total)
+
+        # The bytes read, from byte len(data) of the transaction, and zeros before and after the stream
+        lo = len(data) - skip
+        out = (bytes(max(-lo, 0)) + stream[max(lo, 0):max(lo + n, 0)])[:n].ljust(n, b"\0")
+
+        # What it does during the transaction, and when csn goes high
+        if state == "BURST":
+            self.receive_burst(data, t0)
+        else:
+            self.advance(t_end, True)
+        if state == "OK_TO_SEND":
+            if self.rx_nack:
+                self.reply(OK_TO_SEND)
+                self.rx_nack = False
+            self.state = "IDLE" if total > self.hb else "WAIT_STM_DATA"
+        elif state == "RECEIVING":
+            self.receive(data, t_end)
+        elif state == "READ":
+            if not self.crc and not self.use_stat and self.tx_full and total >= self.tx_len + 2:
+                self.tx_done(t_end)
+        elif state == "ACK":
+            if self.tx_full:
+                self.tx_done(t_end)
+        elif state == "SEND_EVENT":
+            # The event has been read, so the data is loaded and sent next
+            i = self.periph_ev
+            self.tx_pkt = bytearray(bytes(self.src_packet(i)).ljust(self.pkt_size, b"\0"))
+            self.src_ack(i, t_end)
+            self.use_stat = False
+            self.state = "SEND_DATA"
+        elif state == "SEND_DATA":
+            if self.crc:
+                # The packet is kept until it has been read in full, and then acked by a read of a single byte
+                if self.tx_sent and total == 1:
+                    self.tx_done(t_end)
+                elif total >= (self.tx_len + self.cb if self.merged_tx else 2):
+                    self.tx_sent = True
+            elif not self.merged_tx or total >= self.tx_len + self.cb:
+                self.tx_done(t_end)
+        if self.state == "WAIT_FOR_TXN":
+            self.reply(OK_TO_SEND)
+            self.state = "IDLE"
+        self.now = t_end
+        return out
+
+    def idle(self, cycles):
+        """ Let time pass between transactions """
+        self.advance(self.now + cycles)
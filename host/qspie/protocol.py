@@ -0,0 +1,146 @@
+# The QSPIE protocol constants, and the helpers shared by the model, the client, and the bus functional model
+# of the STM32 in gateware/sim/qspi_host.py. See the Protocol section of README.md.
+
+from collections import namedtuple
+
+# Replies
+OK_TO_SEND = 0xF0
+NACK       = 0xFE
+NOT_READY  = 0xFF
+
+# Commands
+BURST_CMD  = 0xF1
+STATUS_CMD = 0xF8
+READ_CMD   = 0xF9
+ACK_CMD    = 0xFA
+TS_CMD     = 0xFB
+
+# The flags of the packets of a message split into segments, as in gateware/sar.py. The packets a peripheral
+# sends end with a trailer byte which has them.
+SAR_FIRST  = 1
+SAR_LAST   = 2
+
+# CRC-8 (polynomial 0x07) and CRC-16/CCITT (polynomial 0x1021, starting from 0xFFFF), most significant bit first,
+# with no final xor, as computed by gateware/qspi/crc.py
+CRC_POLY = {8: 0x07, 16: 0x1021}
+CRC_INIT = {8: 0x00, 16: 0xFFFF}
+
+def _crc_table(width):
+    poly, top, mask = CRC_POLY[width], 1 << (width - 1), (1 << width) - 1
+    table = []
+    for b in range(256):
+        c = b << (width - 8)
+        for _ in range(8):
+            c = ((c << 1) ^ poly if c & top else c << 1) & mask
+        table.append(c)
+    return table
+
+_CRC_TABLES = {w: _crc_table(w) for w in CRC_POLY}
+
+def crc(data, width):
+    """ The CRC of the bytes of data """
+    table, c, shift, mask = _CRC_TABLES[width], CRC_INIT[width], width - 8, (1 << width) - 1
+    for b in data:
+        c = ((c << 8) & mask) ^ table[(c >> shift) ^ b]
+    return c
+
+def crc_bytes(data, width):
+    """ The bytes of the CRC of data, most significant first, or none if width is 0 """
+    if not width:
+        return b""
+    return crc(data, width).to_bytes(width // 8, "big")
+
+def header(periph, flags, ext_addr=False):
+    """ The header of a packet written to a peripheral """
+    return bytes([periph, flags]) if ext_addr else bytes([(periph << 4) | flags])
+
+def event(periph, nb, ext_addr=False):
+    """ The event for a packet of nb bytes sent by a peripheral, where a full packet has length 0 """
+    return bytes([periph, nb & 0xF]) if ext_addr else bytes([(periph << 4) | (nb & 0xF)])
+
+def parse_event(ev, pkt_size=16, ext_addr=False):
+    """ The peripheral, and the number of bytes of data, of an event """
+    periph = ev[0] if ext_addr else ev[0] >> 4
+    return periph, (ev[-1] & 0xF) or pkt_size
+
+# A packet read from a TX peripheral: its id, its data, and with timestamps, the time it had it, or None
+Packet = namedtuple("Packet", ["periph", "data", "ts"])
+
+def crc_ok(data, width):
+    """ Whether data, which ends with its CRC, is right, which it always is when width is 0 """
+    return not width or crc(data, width) == 0
+
+def packet(periph, nb, data, tb=0):
+    """ The packet of nb bytes from periph, from the data read, which is followed by tb bytes of any timestamp """
+    ts = int.from_bytes(bytes(data[nb:nb + tb]), "big") if tb else None
+    return Packet(periph, bytes(data[:nb]), ts)
+
+def parse_merged(r, pkt_size=16, ext_addr=False, tb=0, width=0):
+    """
+    The packet in r, a merged read of the event and the data, and any timestamp and CRC, or None if r is too
+    short, or its CRC is wrong. r can be longer than the packet.
+    """
+    hb = 2 if ext_addr else 1
+    periph, nb = parse_event(r[:hb], pkt_size, ext_addr)
+    n = hb + nb + tb + width // 8
+    if len(r) < n or not crc_ok(r[:n], width):
+        return None
+    return packet(periph, nb, r[hb:], tb)
+
+def _bitmap_size(num_periphs):
+    """ The bytes of a bitmap of the peripherals in the status """
+    return max(16, (num_periphs + 7) // 8 * 8) // 8
+
+def status_size(num_periphs, credits=False, width=0, tb=0):
+    """ The number of bytes of the status, without the reply before it or its CRC """
+    n = 2 * _bitmap_size(num_periphs) + tb
+    if credits:
+        n += num_periphs + (2 if width else 0)
+    return n
+
+def parse_status(r, num_periphs, credits=False, ext_addr=False, width=0, tb=0):
+    """
+    The status read in r, as a dict, or None if its CRC is wrong. Without credits, r starts with the reply,
+    which the CRC covers too, and which is in `reply`. With credits, `taken` has the count of packets taken
+    from each RX peripheral, and with a CRC, `seq` and `errs` are the sequence number of the next packet,
+    and which of the 8 before it were dropped.
+    """
+    if not crc_ok(r, width):
+        return None
+    reply = None
+    if not credits:
+        reply, r = r[0], r[2 if ext_addr else 1:]
+    bm = _bitmap_size(num_periphs)
+    st = {
+        "reply"   : reply,
+        "tx_pend" : int.from_bytes(bytes(r[:bm]), "big"),
+        "rx_rdy"  : int.from_bytes(bytes(r[bm:2 * bm]), "big")
+    }
+    k = 2 * bm
+    if credits:
+        st["taken"] = list(r[k:k + num_periphs])
+        k += num_periphs
+        if width:
+            st["seq"], st["errs"] = r[k], r[k + 1]
+            k += 2
+    if tb:
+        st["ts"] = int.from_bytes(bytes(r[k:k + 4]), "big")
+    return st
+
+def returned(taken, counts):
+    """ The credits returned for each RX peripheral, from the counts of packets taken in the status, which are kept """
+    ret = [(c - t) & 0xFF for c, t in zip(counts, taken)]
+    taken[:] = counts
+    return ret
+
+def dropped(unchecked, seq, errs):
+    """
+    The (periph, packet) of each packet in unchecked, a list of (seq, periph, packet), that errs shows was dropped.
+    Bit k of errs is for the packet k before seq, which is the sequence number of the next packet.
+    """
+    drops = []
+    for pkt_seq, periph, pkt in unchecked:
+        k = (seq - 1 - pkt_seq) & 0xFF
+        if k < 8 and (errs >> k) & 1:
+            drops.append((periph, pkt))
+    return drops
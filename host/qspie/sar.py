@@ -0,0 +1,37 @@
+from qspie.protocol import SAR_FIRST, SAR_LAST
+
+# Segmentation and reassembly of messages of any length, the host side of gateware/sar.py. The packets of a
+# message written to a peripheral are marked with the SAR flags, and the two other bits of the flags nibble are
+# the message's own. The packets of a message a peripheral sends end with a trailer byte with the SAR flags.
+
+def segments(data, room, flags=0):
+    """ The flags and data of the packets of a message, with room bytes of data in each """
+    chunks = [data[k:k + room] for k in range(0, len(data), room)] or [data[:0]]
+    for k, chunk in enumerate(chunks):
+        yield (flags & ~(SAR_FIRST | SAR_LAST) | (SAR_FIRST if k == 0 else 0) |
+               (SAR_LAST if k == len(chunks) - 1 else 0)), bytes(chunk)
+
+class Reassembler:
+    """
+    Reassembles the messages sent by a peripheral from its packets. A packet that starts a message in the middle
+    of one, or continues one when there is none, is counted in errors, and the message it interrupted is dropped.
+    """
+    def __init__(self):
+        self.data   = None              # The message so far, or None between messages
+        self.errors = 0
+
+    def push(self, data):
+        """ Add a packet, and return the message if it was the last one, or None """
+        flags, seg = data[-1], data[:-1]
+        if flags & SAR_FIRST:
+            if self.data is not None:
+                self.errors += 1
+            self.data = bytearray()
+        elif self.data is None:
+            self.errors += 1
+            return None
+        self.data += seg
+        if flags & SAR_LAST:
+            msg, self.data = bytes(self.data), None
+            return msg
+        return None
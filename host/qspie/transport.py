@@ -0,0 +1,138 @@
+import asyncio
+import json
+from abc import ABC, abstractmethod
+
+# Transports carry the client's transactions to the ice40. Only the client's link task uses a transport,
+# so there is never more than one transaction in progress. A transport for real hardware implements the
+# same calls, over the host's QSPI controller, with QDIR on a GPIO.
+
+class Transport(ABC):
+    """ The base of the transports, which cannot be created without the abstract calls """
+    @abstractmethod
+    async def transaction(self, data=b"", n=0):
+        """ A transaction that writes the bytes of data, and then reads n bytes, which are returned """
+
+    @abstractmethod
+    async def qdir(self):
+        """ Whether QDIR is high """
+
+    @abstractmethod
+    async def wait(self, timeout):
+        """ Wait until QDIR is high, for at most timeout seconds, and return it """
+
+    async def sleep(self, seconds):
+        """ Let time pass on the link, to back off when the ice40 is not ready """
+        await asyncio.sleep(seconds)
+
+    async def close(self):
+        pass
+
+class ModelTransport(Transport):
+    """
+    A transport to the transaction-level model in qspie.model. Time passes in the model, not on the wall clock,
+    and the host takes gap cycles between transactions.
+    """
+    def __init__(self, dispatcher, clock=100e6, gap=10, step=100):
+        self.d     = dispatcher
+        self.clock = clock                  # The system clock frequency, to convert seconds to cycles
+        self.gap   = gap
+        self.step  = step                   # The cycles between checks of QDIR while waiting
+
+        self.txns  = 0
+
+    async def transaction(self, data=b"", n=0):
+        r = self.d.transaction(data, n)
+        self.d.idle(self.gap)
+        self.txns += 1
+        return r
+
+    async def qdir(self):
+        return self.d.qdir
+
+    async def wait(self, timeout):
+        cycles = int(timeout * self.clock)
+        waited = 0
+        while not self.d.qdir and waited < cycles:
+            n = min(self.step, cycles - waited)
+            self.d.idle(n)
+            waited += n
+            # Let other tasks run, so that the client sees new writes
+            await asyncio.sleep(0)
+        return self.d.qdir
+
+    async def sleep(self, seconds):
+        self.d.idle(int(seconds * self.clock))
+        await asyncio.sleep(0)
+
+class SocketTransport(Transport):
+    """
+    A transport to the co-simulation server in gateware/sim/cosim.py, which runs the RTL, over a Unix socket.
+    Create it with connect. As with ModelTransport, time passes in the simulation. QDIR comes with every reply,
+    and does not change until the next request, so reading it needs no request. Waits run step cycles at a
+    time, so that the client can send new writes.
+    """
+    def __init__(self, reader, writer, clock=100e6, step=1000):
+        self.reader = reader
+        self.writer = writer
+        self.clock  = clock
+        self.step   = step
+
+        self.lock  = asyncio.Lock()
+        self.level = False
+        self.txns  = 0
+
+    @classmethod
+    async def connect(cls, path, step=1000):
+        reader, writer = await asyncio.open_unix_connection(path)
+        transport = cls(reader, writer, step=step)
+        transport.clock = (await transport.config())["clock"]
+        return transport
+
+    async def request(self, **req):
+        # A request is shielded, so that when a wait is cancelled its reply is still read
+        return await asyncio.shield(self._request(req))
+
+    async def _request(self, req):
+        async with self.lock:
+            self.writer.write((json.dumps(req) + "\n").encode())
+            await self.writer.drain()
+            reply = json.loads(await self.reader.readline())
+        if "error" in reply:
+            raise IOError(reply["error"])
+        self.level = bool(reply["qdir"])
+        return reply
+
+    async def config(self):
+        """ The dispatcher's options, for the client, its rx fifo depths and its clock frequency """
+        reply = await self.request(op="config")
+        reply["rx_depth"] = {int(i): d for i, d in reply["rx_depth"].items()}
+        return reply
+
+    async def stats(self):
+        """ The link throughput, in simulated time and on the wall clock """
+        return await self.request(op="stats")
+
+    async def transaction(self, data=b"", n=0):
+        reply = await self.request(op="txn", data=bytes(data).hex(), n=n)
+        self.txns += 1
+        return bytes.fromhex(reply["data"])
+
+    async def qdir(self):
+        return self.level
+
+    async def wait(self, timeout):
+        cycles = int(timeout * self.clock)
+        waited = 0
+        while not self.level and waited < cycles:
+            waited += (await self.request(op="wait", cycles=min(self.step, cycles - waited)))["cycles"]
+        return self.level
+
+    async def sleep(self, seconds):
+        await self.request(op="idle", cycles=int(seconds * self.clock))
+
+    async def close(self):
+        # After any request still waiting for its reply
+        async with self.lock:
+            self.writer.write((json.dumps({"op": "close"}) + "\n").encode())
+            self.writer.close()
+            await self.writer.wait_closed()
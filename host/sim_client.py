@@ -0,0 +1,185 @@
+import argparse
+import asyncio
+import time
+
+from qspie import model
+from qspie.client import Client
+from qspie.transport import ModelTransport, SocketTransport
+
+# Run the client against the transaction-level model, with concurrent requests to a BRAM, packets echoed
+# by a loopback, a stream of small writes to a uart, messages of many packets echoed by a message loopback, and
+# streams of writes echoed by a loopback with an rx fifo, which go as bursts, for a few of the dispatcher's options.
+# Run from the host directory with: python sim_client.py
+# With --socket, it runs against the RTL in the co-simulation server, gateware/sim/cosim.py, with its
+# default peripherals, which have no uart or message loopback, and with the server's options.
+
+# The depth of the stream loopback's rx fifo
+STREAM_DEPTH = 4
+
+async def session(c, rounds, with_uart=True, with_msgs=True, with_stream=True, dma=1024):
+    """ Run the users of the peripherals, then stream dma bytes to the BRAM and back, and return the errors """
+    errors = []
+    led, loop, bram = c.channel(0), c.channel(1), c.channel(2)
+
+    async def bram_user(k):
+        # Write a block, and read it back, with the requests of all the users outstanding at once
+        addr = (k * 16).to_bytes(2, "big")
+        data = bytes((k * 16 + j) & 0xFF for j in range(c.room - 2))
+        await bram.write(addr + data, flags=1)
+        pkt = await bram.request(addr + bytes([len(data)]))
+        if pkt.data != data:
+            errors.append(("bram", k, pkt.data))
+
+    async def loop_user():
+        for k in range(rounds):
+            data = bytes(range(k % 14 + 1))
+            pkt = await loop.request(data)
+            if pkt.data != data:
+                errors.append(("loopback", k, pkt.data))
+            await led.write(bytes([k]))
+
+    async def uart_user():
+        # The uart echoes each byte as it is sent, and drops the ones that come back while the dispatcher is
+        # waiting for it to take another packet, so a packet's worth of small writes goes at a time
+        uart = c.channel(3, stream=True)
+        text = b"Hello, World! " * (rounds // 4 + 1)
+        got = b""
+        for k in range(0, len(text), c.room):
+            line = text[k:k + c.room]
+            await asyncio.gather(*[uart.write(line[j:j + 3]) for j in range(0, len(line), 3)])
+            while len(got) < k + len(line):
+                got += (await uart.read()).data
+        if got != text:
+            errors.append(("uart", got))
+
+    async def msg_user():
+        # Messages from empty to many packets long, with the top bit of the flags their own
+        msgs = c.channel(4)
+        for k in range(rounds // 4 + 1):
+            data = bytes((k + j) & 0xFF for j in range(k * 11))
+            if not data:
+                # An empty message is not sent back
+                await msgs.send_message(data, flags=8)
+                continue
+            _, got = await asyncio.gather(msgs.send_message(data, flags=8), msgs.read_message())
+            if got != data:
+                errors.append(("message", k, got))
+        if msgs.reasm.errors:
+            errors.append(("message", "errors", msgs.reasm.errors))
+
+    async def stream_user():
+        # Many small writes made at once are batched, and go as bursts as long as the loopback's rx fifo
+        stream = c.channel(5, stream=True)
+        for k in range(rounds // 8 + 1):
+            data = bytes((k * 5 + j) & 0xFF for j in range(c.room * 4 + k))
+            await asyncio.gather(*[stream.write(data[j:j + 4]) for j in range(0, len(data), 4)])
+            got = b""
+            while len(got) < len(data):
+                got += (await stream.read()).data
+            if got != data:
+                errors.append(("stream", k, got))
+
+    users = [loop_user()] + [bram_user(k) for k in range(rounds)]
+    if with_uart:
+        users.append(uart_user())
+    if with_msgs:
+        users.append(msg_user())
+    if with_stream:
+        users.append(stream_user())
+    await asyncio.gather(*users)
+
+    # Stream a block into the BRAM after the users' blocks, in packets that are all data, and stream it back
+    addr = rounds * 16
+    data = bytes((addr + j * 7) & 0xFF for j in range(dma))
+    await bram.write(addr.to_bytes(2, "big"), flags=2)
+    await asyncio.gather(*[bram.write(data[k:k + c.room], flags=3) for k in range(0, dma, c.room)])
+    await bram.write(addr.to_bytes(2, "big") + dma.to_bytes(2, "big"), flags=2)
+    got = b""
+    while len(got) < dma:
+        got += (await bram.read()).data
+    if got != data:
+        errors.append(("bram stream", got))
+
+    # The led is always ready, and with a CRC and no credits, the CRC of the status covers the reply before it
+    try:
+        st = await c.read_status()
+        if not st["rx_rdy"] & 1:
+            errors.append(("status", st))
+    except IOError as e:
+        errors.append(("status", str(e)))
+
+    return errors
+
+async def model_session(options, rounds, depth):
+    d = model.Dispatcher(**options)
+    depth = depth if d.credits else None
+    d.register(0, model.Led(), True, False, rx_fifo_depth=depth)
+    d.register(1, model.Loopback(), True, True, rx_fifo_depth=depth)
+    d.register(2, model.BramPeriph(), True, True, rx_fifo_depth=depth)
+    # The uart has an rx fifo, so that the dispatcher is not kept waiting for it while the bytes it echoes arrive
+    d.register(3, model.UartLoopback(), True, True, rx_fifo_depth=2)
+    msgs = model.MessageLoopback()
+    d.register(4, msgs, True, True, rx_fifo_depth=depth)
+    # The stream loopback has an rx fifo in every mode, so that bursts to it can go without credits
+    d.register(5, model.Loopback(), True, True, rx_fifo_depth=STREAM_DEPTH)
+
+    transport = ModelTransport(d)
+    rx_depth = {i: depth for i in range(5)} if d.credits else {}
+    rx_depth[3] = 2
+    rx_depth[5] = STREAM_DEPTH
+
+    async with Client(transport, rx_depth=rx_depth, **options) as c:
+        errors = await session(c, rounds)
+    if msgs.errors:
+        errors.append(("message loopback", "errors", msgs.errors))
+    if d.burst_overrun:
+        errors.append(("burst overrun",))
+    return c, transport, errors
+
+async def cosim_session(path, rounds):
+    transport = await SocketTransport.connect(path)
+    config = await transport.config()
+    async with Client(transport, rx_depth=config["rx_depth"], **config["options"]) as c:
+        errors = await session(c, rounds, with_uart=False, with_msgs=False, with_stream=False, dma=128)
+        stats = await transport.stats()
+    return c, transport, errors, stats
+
+def report(name, c, transport, errors, t):
+    print("{}: {}, {} packets sent, {} bursts, {} received, {} not ready, {} transactions, {:.0f} transactions/s".format(
+          name, "ok" if not errors else errors[:3], c.sent, c.bursts, c.received, c.not_ready,
+          transport.txns, transport.txns / t))
+
+def run(name, rounds=40, depth=2, **options):
+    t = time.time()
+    c, transport, errors = asyncio.run(model_session(options, rounds, depth))
+    report(name, c, transport, errors, time.time() - t)
+
+def run_cosim(path, rounds):
+    t = time.time()
+    c, transport, errors, stats = asyncio.run(cosim_session(path, rounds))
+    report("Co-simulation", c, transport, errors, time.time() - t)
+    print("Link: {} bytes in {} transactions, {:.0f} bytes/s simulated, {:.3f} bytes per SCLK cycle, "
+          "{:.0f} bytes/s on the wall clock, {:.0f} cycles/s".format(
+          stats["bytes"], stats["transactions"], stats["sim_bytes_per_s"] or 0, stats["sim_bytes_per_sclk"] or 0,
+          stats["wall_bytes_per_s"] or 0, stats["cycles_per_s"] or 0))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="QSPIE client session")
+    parser.add_argument("--socket", help="the co-simulation server's socket, instead of the model")
+    parser.add_argument("--rounds", type=int, help="rounds of requests, 40 with the model, and 8 with the server")
+    args = parser.parse_args()
+
+    if args.socket:
+        # The server's BRAM has 256 bytes, which holds 8 rounds, and the block streamed after them
+        run_cosim(args.socket, args.rounds or 8)
+    else:
+        rounds = args.rounds or 40
+        run("Default", rounds)
+        run("Merged reads", rounds, merged_tx=True)
+        run("Bursts", rounds, burst=True)
+        run("Credits", rounds, credits=True)
+        run("Credits and bursts", rounds, credits=True, burst=True)
+        run("Credits with CRC-16", rounds, credits=True, crc=16)
+        run("Credits with CRC-8, deep FIFOs", rounds, depth=16, credits=True, crc=8)
+        run("Extended addressing", rounds, ext_addr=True)
+        run("CRC-8", rounds, crc=8)